@@ -8,6 +8,8 @@ accessig the Dose metadata in CERR coordinate system.
 """
 
 from dataclasses import dataclass, field
+import hashlib
+import weakref
 import numpy as np
 from pydicom import dcmread
 from cerr.dataclasses import scan as scn
@@ -22,6 +24,11 @@ def get_empty_list():
 def get_empty_np_array():
     return np.empty((0,0,0))
 
+# Dose resampled on scan grids, keyed by (doseUID, scanUID, bounding box, dose hash)
+doseOnScanCache = {}
+# Hash of doseArray keyed by doseUID, along with a weak reference, shape and dtype of the hashed array
+doseArrayHashCache = {}
+
 @dataclass
 class Dose:
     caseNumber: int = 0
@@ -193,6 +200,10 @@ class Dose:
 
     def getDoseAt(self,xV,yV,zV):
         xVD, yVD, zVD = self.getDoseXYZVals()
+        # copy to avoid modifying zValues in place
+        zVD = np.array(zVD, dtype=float)
+        # Clamp z to the dose extent so that points beyond the first/last slice take its value
+        zV = np.clip(zV, np.min(zVD), np.max(zVD))
         delta = 1e-8
         zVD[0] = zVD[0] - 1e-3
         zVD[-1] = zVD[-1] + 1e-3
@@ -202,6 +213,31 @@ class Dose:
         doseV = finterp3(xV,yV,zV,self.doseArray,xFieldV,yFieldV,zFieldV)
         return doseV
 
+    def resampleToScanGrid(self, scanObj, bboxV=None):
+        """
+        Returns dose interpolated at voxel centers of the input scan.
+        INPUTS -
+            scanObj - Scan object whose grid is used for resampling
+            bboxV - optional [minr, maxr, minc, maxc, mins, maxs] (inclusive) extents
+                    of the scan sub-grid. Defaults to the entire scan grid.
+        OUTPUT - 3D array of dose values on the (sub) grid of scanObj
+        """
+        xV, yV, zV = scanObj.getScanXYZVals()
+        if bboxV is None:
+            bboxV = [0, len(yV)-1, 0, len(xV)-1, 0, len(zV)-1]
+        minr, maxr, minc, maxc, mins, maxs = [int(lim) for lim in bboxV]
+        xV = xV[minc:maxc+1]
+        yV = yV[minr:maxr+1]
+        zV = zV[mins:maxs+1]
+        xM, yM = np.meshgrid(xV, yV)
+        dose3M = np.empty((len(yV), len(xV), len(zV)))
+        # Interpolate slice-by-slice to bound memory. As in getDoseAt, slices outside
+        # the z-extent of dose are clamped to the first/last dose slice.
+        for slc in range(len(zV)):
+            zM = zV[slc] * np.ones_like(xM)
+            dose3M[:,:,slc] = self.getDoseAt(xM, yM, zM).reshape(xM.shape)
+        return dose3M
+
 def load_dose(file_list):
     dose_list = []
     for file in file_list:
@@ -292,3 +328,74 @@ def getDoseNumFromUID(assocDoseUID,planC) -> int:
         return uid_list.index(assocDoseUID)
     else:
         return None
+
+
+def getDoseHash(doseObj):
+    """
+    Returns a hash of dose values and grid. The hash of doseArray is cached per doseUID
+    and recomputed only when doseArray is replaced or its shape or dtype changes.
+    Call clearDoseOnScanCache after modifying doseArray in place.
+    """
+    doseArray = doseObj.doseArray
+    arrayInfo = (doseArray.shape, doseArray.dtype)
+    cached = doseArrayHashCache.get(doseObj.doseUID)
+    if cached is None or cached[0]() is not doseArray or cached[1] != arrayInfo:
+        arrayHash = hashlib.sha1(np.ascontiguousarray(doseArray).tobytes()).digest()
+        cached = (weakref.ref(doseArray), arrayInfo, arrayHash)
+        doseArrayHashCache[doseObj.doseUID] = cached
+    hashObj = hashlib.sha1(cached[2])
+    for gridV in doseObj.getDoseXYZVals():
+        hashObj.update(np.ascontiguousarray(gridV, dtype=float).tobytes())
+    return hashObj.hexdigest()
+
+
+def getDoseOnScanGrid(doseNum, scanNum, planC, bboxV=None):
+    """
+    Returns dose resampled on the grid of a scan (or a bounding sub-grid of it).
+    Resampled doses are cached by dose and scan UIDs so that subsequent calls
+    index the cached array instead of interpolating. Cached entries are validated
+    against getDoseHash and replaced when the dose changes.
+    INPUTS -
+        doseNum - index of dose in planC.dose
+        scanNum - index of scan in planC.scan
+        planC - An instance of PlanC
+        bboxV - optional [minr, maxr, minc, maxc, mins, maxs] (inclusive) extents
+                of the scan sub-grid. Defaults to the entire scan grid.
+    OUTPUT - 3D array of dose values on the (sub) grid of the scan
+    """
+    doseObj = planC.dose[doseNum]
+    scanObj = planC.scan[scanNum]
+    doseHash = getDoseHash(doseObj)
+
+    # Drop entries resampled from earlier versions of this dose
+    for staleKey in [k for k in doseOnScanCache if k[0] == doseObj.doseUID and k[3] != doseHash]:
+        del doseOnScanCache[staleKey]
+
+    fullKey = (doseObj.doseUID, scanObj.scanUID, None, doseHash)
+    if fullKey in doseOnScanCache:
+        dose3M = doseOnScanCache[fullKey]
+        if bboxV is None:
+            return dose3M
+        minr, maxr, minc, maxc, mins, maxs = [int(lim) for lim in bboxV]
+        return dose3M[minr:maxr+1, minc:maxc+1, mins:maxs+1]
+    if bboxV is not None:
+        bboxV = tuple(int(lim) for lim in bboxV)
+    key = (doseObj.doseUID, scanObj.scanUID, bboxV, doseHash)
+    if key not in doseOnScanCache:
+        doseOnScanCache[key] = doseObj.resampleToScanGrid(scanObj, bboxV)
+    return doseOnScanCache[key]
+
+
+def clearDoseOnScanCache(doseUID=None):
+    """
+    Removes cached dose resampled on scan grids along with cached dose hashes.
+    Call when the doseArray is modified in place.
+    Clears all cached entries when doseUID is not specified.
+    """
+    if doseUID is None:
+        doseOnScanCache.clear()
+        doseArrayHashCache.clear()
+        return
+    for key in [k for k in doseOnScanCache if k[0] == doseUID]:
+        del doseOnScanCache[key]
+    doseArrayHashCache.pop(doseUID, None)
@@ -0,0 +1,140 @@
+"""
+This module defines routines to accumulate multiple dose distributions onto a common grid.
+Doses can be scaled (e.g. by number of fractions) and converted to BED or EQD2 before summation.
+"""
+
+import copy
+import numpy as np
+from cerr.dataclasses import dose as rtds
+from cerr.dataclasses import scan as scn
+from cerr.utils import uid
+
+
+def getTargetGrid(planC, targetDoseNum=None, targetScanNum=None):
+    """
+    Returns x,y,z coordinates of the target grid along with a Dose object
+    holding the geometry of that grid.
+    """
+    if targetScanNum is not None:
+        scanObj = planC.scan[targetScanNum]
+        xV, yV, zV = scanObj.getScanXYZVals()
+        gridDose = rtds.Dose()
+        gridDose.coord1OFFirstPoint = xV[0]
+        gridDose.coord2OFFirstPoint = yV[0]
+        gridDose.horizontalGridInterval = xV[1] - xV[0]
+        gridDose.verticalGridInterval = yV[1] - yV[0]
+        gridDose.sizeOfDimension1 = len(xV)
+        gridDose.sizeOfDimension2 = len(yV)
+        gridDose.sizeOfDimension3 = len(zV)
+        gridDose.zValues = np.array(zV, dtype=float)
+        gridDose.Image2PhysicalTransM = scanObj.Image2PhysicalTransM.copy()
+        gridDose.cerrDcmSliceDirMatch = not scn.flipSliceOrderFlag(scanObj)
+        gridDose.assocScanUID = scanObj.scanUID
+        gridDose.frameOfReferenceUID = scanObj.scanInfo[0].frameOfReferenceUID
+    else:
+        if targetDoseNum is None:
+            targetDoseNum = 0
+        refDose = planC.dose[targetDoseNum]
+        xV, yV, zV = refDose.getDoseXYZVals()
+        gridDose = copy.deepcopy(refDose)
+        gridDose.doseArray = rtds.get_empty_np_array()
+    return np.asarray(xV), np.asarray(yV), np.array(zV, dtype=float), gridDose
+
+
+def convertPhysicalDose(dose3M, numFractions, abRatio, conversion):
+    """
+    Converts physical dose to biologically effective dose ('BED') or
+    equivalent dose in 2 Gy fractions ('EQD2') using the linear-quadratic model.
+    """
+    if conversion is None:
+        return dose3M
+    conversion = conversion.upper()
+    bed3M = dose3M * (1 + dose3M / numFractions / abRatio)
+    if conversion == 'BED':
+        return bed3M
+    elif conversion == 'EQD2':
+        return bed3M / (1 + 2 / abRatio)
+    raise ValueError("Invalid conversion '" + conversion + "'. Supported conversions are 'BED' and 'EQD2'.")
+
+
+def sumDose(doseNumV, planC, targetDoseNum=None, targetScanNum=None, scaleFactorV=None,
+            numFractionsV=None, abRatio=None, conversion=None, blockSize=8, fractionGroupID='SUM'):
+    """
+    Sums multiple dose distributions onto a common target grid and returns the result
+    as a new Dose object. Doses are resampled block by block (blockSize slices of
+    the target grid at a time) to keep memory bounded.
+
+    INPUTS -
+        doseNumV - list of indices of doses in planC.dose to sum
+        planC - An instance of PlanC
+        targetDoseNum - index of dose whose grid is used for the sum. Defaults to doseNumV[0].
+        targetScanNum - index of scan whose grid is used for the sum. Overrides targetDoseNum.
+        scaleFactorV - optional multiplicative factor per dose (e.g. number of times a
+                       fraction is delivered). Defaults to 1.
+        numFractionsV - number of fractions per (scaled) dose. Required for BED/EQD2.
+                        Defaults to numberOfTx of each dose.
+        abRatio - alpha/beta ratio (Gy). Required for BED/EQD2.
+        conversion - None (physical dose), 'BED' or 'EQD2' (case-insensitive). Sets
+                     doseSummationType of the sum to 'PLAN', 'BED' or 'EQD2'.
+        blockSize - number of target slices resampled at a time
+        fractionGroupID - fractionGroupID of the summed dose
+    OUTPUT - Dose object. Use planC.dose.append() to add it to planC.
+
+    Example:
+        sumDoseObj = sumDose([0, 1], planC, conversion='EQD2', abRatio=3, numFractionsV=[25, 5])
+        planC.dose.append(sumDoseObj)
+    """
+    doseNumV = list(doseNumV)
+    numDoses = len(doseNumV)
+    if scaleFactorV is None:
+        scaleFactorV = np.ones(numDoses)
+    if conversion is not None:
+        conversion = conversion.upper()
+        if conversion not in ['BED', 'EQD2']:
+            raise ValueError("Invalid conversion '" + conversion + "'. Supported conversions are 'BED' and 'EQD2'.")
+        if abRatio is None:
+            raise ValueError("abRatio is required for " + conversion + " conversion")
+        if numFractionsV is None:
+            numFractionsV = [planC.dose[doseNum].numberOfTx for doseNum in doseNumV]
+        if np.any(np.asarray(numFractionsV) <= 0):
+            raise ValueError("numFractionsV must be positive for " + conversion + " conversion")
+    if targetDoseNum is None and targetScanNum is None:
+        targetDoseNum = doseNumV[0]
+
+    xV, yV, zV, sumDoseObj = getTargetGrid(planC, targetDoseNum, targetScanNum)
+    xM, yM = np.meshgrid(xV, yV)
+    numSlcs = len(zV)
+    sum3M = np.zeros((len(yV), len(xV), numSlcs), dtype=float)
+
+    for iDose, doseNum in enumerate(doseNumV):
+        doseObj = planC.dose[doseNum]
+        _, _, zDoseV = doseObj.getDoseXYZVals()
+        zMin, zMax = np.min(zDoseV), np.max(zDoseV)
+        for start in range(0, numSlcs, blockSize):
+            stop = min(start + blockSize, numSlcs)
+            # Skip slices outside the dose's z-extent since getDoseAt clamps z
+            slcV = np.arange(start, stop)
+            slcV = slcV[(zV[slcV] >= zMin - 1e-3) & (zV[slcV] <= zMax + 1e-3)]
+            if len(slcV) == 0:
+                continue
+            numPts = xM.size
+            x1V = np.tile(xM.ravel(), len(slcV))
+            y1V = np.tile(yM.ravel(), len(slcV))
+            z1V = np.repeat(zV[slcV], numPts)
+            block3M = doseObj.getDoseAt(x1V, y1V, z1V)
+            block3M = np.nan_to_num(block3M, nan=0.0) * scaleFactorV[iDose]
+            block3M = block3M.reshape(len(slcV), xM.shape[0], xM.shape[1]).transpose(1, 2, 0)
+            if conversion is not None:
+                block3M = convertPhysicalDose(block3M, numFractionsV[iDose], abRatio, conversion)
+            sum3M[:, :, slcV] += block3M
+
+    sumDoseObj.doseArray = sum3M
+    sumDoseObj.doseUID = uid.createUID("dose")
+    sumDoseObj.doseSummationType = "PLAN" if conversion is None else conversion
+    sumDoseObj.doseUnits = "GRAYS"
+    sumDoseObj.fractionGroupID = fractionGroupID
+    sumDoseObj.doseScale = 1
+    if conversion is None and numFractionsV is not None:
+        sumDoseObj.numberOfTx = int(np.sum(numFractionsV))
+
+    return sumDoseObj
@@ -1,11 +1,21 @@
+import hashlib
 import numpy as np
 from cerr.dataclasses import scan as scn
+from cerr.dataclasses import dose as rtds
+from cerr.contour import rasterseg as rs
+from cerr.utils.bbox import compute_boundingbox
 
-def getDVH(structNum, doseNum, planC):
+# Dose-volume histograms keyed by (strUID, doseUID, binWidth, useDoseOnScanCache, rasterSegHash, doseHash)
+dvhCache = {}
+
+def getDVH(structNum, doseNum, planC, useDoseOnScanCache=False):
     """
     Returns DVH vectors for a specified structure and dose set, where
     dosesV is a vector of dose values at a voxel and volsV is a vector of
     volumes of the corresponding voxel in dosesV.
+    When useDoseOnScanCache is True, dose is resampled once on the grid of the
+    structure's associated scan (see dose.getDoseOnScanGrid) and looked up by
+    voxel index instead of interpolating at every voxel.
     """
 
     # Get the scan number associated with the requested structure.
@@ -27,6 +37,10 @@ def getDVH(structNum, doseNum, planC):
         isError = 1
     numSegs = segmentsM.shape[0]
 
+    if useDoseOnScanCache and not isError:
+        dosesV, volsV = getDosesFromScanGridCache(segmentsM, deltaY, doseNum, scanSet, planC)
+        return dosesV, volsV, isError
+
     # Relative sampling of ROI voxels in this place, compared to CT spacing.
     # Set when rasterSegments are generated (usually on import).
     sampleRate = 1
@@ -100,6 +114,157 @@ def getDVH(structNum, doseNum, planC):
 
     return dosesV, volsV, isError
 
+def getDosesFromScanGridCache(segmentsM, deltaY, doseNum, scanNum, planC):
+    """
+    Returns dose and volume of voxels within raster segments, using dose cached
+    on the grid of the associated scan. As in getDVH, voxels beyond the z-extent of
+    dose take the value of the first/last dose slice.
+    """
+    slcV = segmentsM[:, 5].astype(int)
+    rowV = segmentsM[:, 6].astype(int)
+    colStartV = segmentsM[:, 7].astype(int)
+    colStopV = segmentsM[:, 8].astype(int)
+    bboxV = [rowV.min(), rowV.max(), colStartV.min(), colStopV.max(), slcV.min(), slcV.max()]
+    dose3M = rtds.getDoseOnScanGrid(doseNum, scanNum, planC, bboxV)
+
+    # Expand segments to voxel indices relative to the bounding box
+    numVoxV = colStopV - colStartV + 1
+    segIndV = np.repeat(np.arange(len(numVoxV)), numVoxV)
+    offsetV = np.arange(segIndV.size) - np.repeat(np.cumsum(numVoxV) - numVoxV, numVoxV)
+    dosesV = dose3M[rowV[segIndV] - bboxV[0],
+                    colStartV[segIndV] + offsetV - bboxV[2],
+                    slcV[segIndV] - bboxV[4]]
+    volsV = (segmentsM[:, 4] * deltaY * segmentsM[:, 9])[segIndV]
+    return np.asarray(dosesV, dtype=float), np.asarray(volsV, dtype=float)
+
+def getVoxelEdges(centersV, widthsV=None):
+    """
+    Returns lower and upper edges of voxels centered at centersV. Widths default to the
+    distance between neighbouring voxel centers.
+    """
+    centersV = np.asarray(centersV, dtype=float)
+    if widthsV is None:
+        if len(centersV) == 1:
+            widthsV = np.ones(1)
+        else:
+            midV = (centersV[1:] + centersV[:-1]) / 2
+            loV = np.append(2 * centersV[0] - midV[0], midV)
+            hiV = np.append(midV, 2 * centersV[-1] - midV[-1])
+            return np.minimum(loV, hiV), np.maximum(loV, hiV)
+    widthsV = np.abs(np.asarray(widthsV, dtype=float)) * np.ones(len(centersV))
+    return centersV - widthsV / 2, centersV + widthsV / 2
+
+def getOverlapWeights(srcLoV, srcHiV, dstLoV, dstHiV):
+    """
+    Returns (numDst x numSrc) matrix of overlap lengths between source and destination voxels.
+    """
+    overlapM = np.minimum(dstHiV[:, None], srcHiV[None, :]) - np.maximum(dstLoV[:, None], srcLoV[None, :])
+    return np.clip(overlapM, 0, None)
+
+def getDoseGridDVH(structNum, doseNum, planC):
+    """
+    Returns DVH vectors for a specified structure and dose set computed on the dose grid.
+    The structure mask is resampled onto the dose grid using fractional (partial-volume)
+    coverage of each dose voxel, so that dosesV holds dose at dose voxels and volsV the
+    volume of the structure within those voxels. Requires far fewer samples than getDVH
+    when the dose grid is coarser than the scan.
+    """
+    assocScanUID = planC.structure[structNum].assocScanUID
+    scanNum = scn.getScanNumFromUID(assocScanUID,planC)
+    scanObj = planC.scan[scanNum]
+    doseObj = planC.dose[doseNum]
+
+    isError = 0
+    mask3M = rs.getStrMask(structNum, planC)
+    if not np.any(mask3M):
+        isError = 1
+        return np.array([]), np.array([]), isError
+
+    # Crop mask to its bounding box
+    minr, maxr, minc, maxc, mins, maxs, _ = compute_boundingbox(mask3M)
+    mask3M = mask3M[minr:maxr+1, minc:maxc+1, mins:maxs+1].astype(float)
+    xV, yV, zV = scanObj.getScanXYZVals()
+    thicknessV = np.array([scanObj.scanInfo[slc].voxelThickness for slc in range(mins, maxs+1)])
+    xLoV, xHiV = getVoxelEdges(xV[minc:maxc+1], scanObj.scanInfo[0].grid2Units)
+    yLoV, yHiV = getVoxelEdges(yV[minr:maxr+1], scanObj.scanInfo[0].grid1Units)
+    zLoV, zHiV = getVoxelEdges(zV[mins:maxs+1], thicknessV)
+
+    # Partial-volume weights along each axis of the dose grid
+    xDoseV, yDoseV, zDoseV = doseObj.getDoseXYZVals()
+    xDoseLoV, xDoseHiV = getVoxelEdges(xDoseV, doseObj.horizontalGridInterval)
+    yDoseLoV, yDoseHiV = getVoxelEdges(yDoseV, doseObj.verticalGridInterval)
+    zDoseLoV, zDoseHiV = getVoxelEdges(zDoseV)
+    wxM = getOverlapWeights(xLoV, xHiV, xDoseLoV, xDoseHiV)
+    wyM = getOverlapWeights(yLoV, yHiV, yDoseLoV, yDoseHiV)
+    wzM = getOverlapWeights(zLoV, zHiV, zDoseLoV, zDoseHiV)
+
+    # Restrict to dose voxels overlapping the structure
+    colV = np.where(wxM.sum(axis=1) > 0)[0]
+    rowV = np.where(wyM.sum(axis=1) > 0)[0]
+    slcV = np.where(wzM.sum(axis=1) > 0)[0]
+    wxM, wyM, wzM = wxM[colV, :], wyM[rowV, :], wzM[slcV, :]
+
+    # Structure volume within each dose voxel by separable contraction of the mask
+    vol3M = np.tensordot(wyM, mask3M, axes=(1, 0))
+    vol3M = np.tensordot(vol3M, wxM, axes=(1, 1))
+    vol3M = np.tensordot(vol3M, wzM, axes=(1, 1))
+    indV = np.nonzero(vol3M > 0)
+
+    dose3M = doseObj.doseArray[np.ix_(rowV, colV, slcV)]
+    dosesV = np.asarray(dose3M[indV], dtype=float)
+    volsV = np.asarray(vol3M[indV], dtype=float)
+
+    return dosesV, volsV, isError
+
+def getRasterSegHash(segmentsM):
+    """ Returns a hash of raster segment contents """
+    return hashlib.sha1(np.ascontiguousarray(segmentsM, dtype=float).tobytes()).hexdigest()
+
+def getCachedDoseHist(structNum, doseNum, binWidth, planC, useDoseOnScanCache=False):
+    """
+    Returns doseBinsV, volsHistV for a specified structure, dose and bin width.
+    Histograms are memoised in dvhCache by structure UID, dose UID, bin width,
+    useDoseOnScanCache and content hashes of the raster segments and dose, so
+    changes to either input invalidate the cached result. The dose hash is cached
+    per dose (see dose.getDoseHash). See plan_container.saveToH5 to persist
+    the cache along with planC.
+    UIDs are regenerated when a plan is re-imported, so on a UID miss, a histogram
+    with the same bin width, sampling and content hashes is reused and stored
+    under the current UIDs.
+    """
+    strObj = planC.structure[structNum]
+    doseObj = planC.dose[doseNum]
+    segHash = getRasterSegHash(strObj.rasterSegments)
+    doseHash = rtds.getDoseHash(doseObj)
+    key = (strObj.strUID, doseObj.doseUID, float(binWidth), bool(useDoseOnScanCache), segHash, doseHash)
+    if key in dvhCache:
+        return dvhCache[key]
+
+    # Match on contents (e.g. cache loaded from H5 for a re-imported plan)
+    for cachedKey in [k for k in dvhCache if k[2:] == key[2:]]:
+        dvhCache[key] = dvhCache[cachedKey]
+        return dvhCache[key]
+
+    # Drop stale entries for this structure, dose, bin width and sampling
+    for staleKey in [k for k in dvhCache if k[:4] == key[:4]]:
+        del dvhCache[staleKey]
+
+    dosesV, volsV, isError = getDVH(structNum, doseNum, planC, useDoseOnScanCache)
+    if isError:
+        return np.array([]), np.array([])
+    doseBinsV, volsHistV = doseHist(dosesV, volsV, binWidth)
+    dvhCache[key] = (doseBinsV, volsHistV)
+    return doseBinsV, volsHistV
+
+def clearDVHCache(strUID=None, doseUID=None):
+    """
+    Removes cached histograms for the specified structure and/or dose UIDs.
+    Clears all cached entries when neither is specified.
+    """
+    for key in list(dvhCache.keys()):
+        if (strUID is None or key[0] == strUID) and (doseUID is None or key[1] == doseUID):
+            del dvhCache[key]
+
 def accumulate(V1, V2, indV):
     for i in range(len(V2)):
         V1[indV[i]] += V2[i]
@@ -188,7 +353,7 @@ def Vx(doseBinsV,volsHistV,doseCutoff,volumeType):
     cumVols2V = cumVolsV[-1] - cumVolsV
     ind = np.argmax(doseBinsV >= doseCutoff)
 
-    if ind is None:
+    if not np.any(doseBinsV >= doseCutoff):
         vx = 0
     else:
         vx = cumVols2V[ind]
@@ -216,9 +381,10 @@ def Dx(doseBinsV,volsHistV,x,volType):
 
     cumVolsV = np.cumsum(volsHistV)
     cumVols2V = cumVolsV[-1] - cumVolsV
-    ind = np.argmin(np.array(cumVols2V) / cumVolsV[-1] < x / 100)
+    belowV = np.array(cumVols2V) / cumVolsV[-1] < x / 100
+    ind = np.argmax(belowV)
 
-    if ind is None:
+    if not np.any(belowV):
         dx = 0
     else:
         dx = doseBinsV[ind]
@@ -247,3 +413,108 @@ def medianDose(doseBinsV,volsHistV):
     ind2 = int(np.ceil(ind))
 
     return (doseBinsV[ind1] + doseBinsV[ind2]) / 2
+
+
+class CumulativeDVH:
+    """
+    Cumulative DVH computed once from a dose-volume histogram. Metrics accept
+    scalar or vector thresholds and are evaluated in a single call using
+    np.searchsorted on the cached cumulative volumes.
+
+    Usage:
+        doseBinsV, volsHistV = doseHist(dosesV, volsV, binWidth)
+        cumDVH = CumulativeDVH(doseBinsV, volsHistV)
+        v20V = cumDVH.Vx([5, 10, 20], volumeType=1)
+        d95 = cumDVH.Dx(95)
+    """
+
+    def __init__(self, doseBinsV, volsHistV):
+        self.doseBinsV = np.asarray(doseBinsV, dtype=float)
+        self.volsHistV = np.asarray(volsHistV, dtype=float)
+        cumVolsV = np.cumsum(self.volsHistV)
+        self.totalVol = cumVolsV[-1]
+        # Volume above each bin, volume at or above each bin (padded with 0 at the end)
+        self.cumVols2V = self.totalVol - cumVolsV
+        self.volsAtOrAboveV = np.append(self.totalVol - cumVolsV + self.volsHistV, 0)
+        self.fracAboveV = self.cumVols2V / self.totalVol
+        # Running sums of dose*volume and volume from either end for MOHx and MOCx
+        doseVolV = self.doseBinsV * self.volsHistV
+        self.cumDoseVolV = np.append(0, np.cumsum(doseVolV))
+        self.cumVolsV = np.append(0, cumVolsV)
+        self.revCumDoseVolV = np.append(np.cumsum(doseVolV[::-1])[::-1], 0)
+        self.revCumVolsV = np.append(np.cumsum(self.volsHistV[::-1])[::-1], 0)
+        self.nonZeroIndV = np.where(self.volsHistV != 0)[0]
+
+    @staticmethod
+    def _toOutput(valV, scalarFlag):
+        if scalarFlag:
+            return valV[0]
+        return valV
+
+    def Vx(self, doseCutoffV, volumeType=1):
+        """
+        Volume receiving at least doseCutoffV. Returns fractional volume when
+        volumeType is 1, absolute volume otherwise.
+        """
+        scalarFlag = np.ndim(doseCutoffV) == 0
+        doseCutoffV = np.atleast_1d(np.asarray(doseCutoffV, dtype=float))
+        indV = np.searchsorted(self.doseBinsV, doseCutoffV, side='left')
+        vxV = self.volsAtOrAboveV[indV]
+        if volumeType == 1:
+            vxV = vxV / self.totalVol
+        return self._toOutput(vxV, scalarFlag)
+
+    def Dx(self, xV, volType=1):
+        """
+        Minimum dose to the hottest xV percent volume (absolute volume when
+        volType is 0).
+        """
+        scalarFlag = np.ndim(xV) == 0
+        xV = np.atleast_1d(np.asarray(xV, dtype=float))
+        if not volType:
+            xV = xV / self.totalVol * 100
+        # first bin where fraction of volume above drops below x
+        indV = np.searchsorted(-self.fracAboveV, -xV / 100, side='right')
+        foundV = indV < len(self.doseBinsV)
+        dxV = np.zeros(len(xV))
+        dxV[foundV] = self.doseBinsV[indV[foundV]]
+        return self._toOutput(dxV, scalarFlag)
+
+    def MOHx(self, percentV):
+        """ Mean dose to the hottest percentV volume """
+        scalarFlag = np.ndim(percentV) == 0
+        percentV = np.atleast_1d(np.asarray(percentV, dtype=float))
+        # first bin where fraction of volume above is within percent
+        indV = np.searchsorted(-self.fracAboveV, -percentV / 100, side='left')
+        mohV = np.zeros(len(percentV))
+        foundV = indV < len(self.doseBinsV)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mohV[foundV] = self.revCumDoseVolV[indV[foundV]] / self.revCumVolsV[indV[foundV]]
+        return self._toOutput(mohV, scalarFlag)
+
+    def MOCx(self, percentV):
+        """ Mean dose to the coldest percentV volume """
+        scalarFlag = np.ndim(percentV) == 0
+        percentV = np.atleast_1d(np.asarray(percentV, dtype=float))
+        # number of bins where fraction of volume above is at least (100-percent)
+        numV = np.searchsorted(-self.fracAboveV, -(100 - percentV) / 100, side='right')
+        mocV = np.zeros(len(percentV))
+        foundV = numV > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mocV[foundV] = self.cumDoseVolV[numV[foundV]] / self.cumVolsV[numV[foundV]]
+        return self._toOutput(mocV, scalarFlag)
+
+    def meanDose(self):
+        return self.cumDoseVolV[-1] / self.totalVol
+
+    def minDose(self):
+        return self.doseBinsV[self.nonZeroIndV[0]]
+
+    def maxDose(self):
+        return self.doseBinsV[self.nonZeroIndV[-1]]
+
+    def medianDose(self):
+        ind = np.median(self.nonZeroIndV)
+        ind1 = int(np.floor(ind))
+        ind2 = int(np.ceil(ind))
+        return (self.doseBinsV[ind1] + self.doseBinsV[ind2]) / 2
@@ -23,6 +23,7 @@ from cerr.dataclasses import deform as dfrm
 from cerr.dataclasses import structure as structr
 from cerr.dataclasses.structure import Contour
 from cerr.dataclasses import header as headr
+from cerr import dvh
 
 def get_empty_list():
     return []
@@ -68,7 +69,14 @@ def addToH5Grp(h5Grp,structDict,key):
     return h5Grp
 
 
-def saveToH5(planC, h5File, scanNumV=[], structNumV=[], doseNumV=[], deformNumV=[]):
+def saveToH5(planC, h5File, scanNumV=[], structNumV=[], doseNumV=[], deformNumV=[], saveDVHCacheFlag=False):
+    """
+    Writes the requested scans, structures, doses and deforms of planC to an HDF5 file.
+    When saveDVHCacheFlag is True, DVHs memoised by dvh.getCachedDoseHist are also
+    written so that they need not be recomputed after reloading. Doses are not
+    restored by loadFromH5 and UIDs change when a plan is re-imported, so cached DVHs
+    are matched to structures and doses by their contents (see dvh.getCachedDoseHist).
+    """
     dt = datetime.now()
     planC.header.dateLastSaved = dt.strftime("%Y%m%d")
     with h5py.File(h5File, 'w') as f:
@@ -83,6 +91,9 @@ def saveToH5(planC, h5File, scanNumV=[], structNumV=[], doseNumV=[], deformNumV=
         structGrp = saveH5Structure(structGrp, structNumV, planC)
         doseGrp = saveH5Dose(doseGrp, doseNumV, planC)
         deformGrp = saveH5Deform(deformGrp, deformNumV, planC)
+        if saveDVHCacheFlag:
+            dvhCacheGrp = planCGrp.create_group('dvhCache')
+            dvhCacheGrp = saveH5DVHCache(dvhCacheGrp, planC)
     return 0
 
 def loadFromH5(h5File, initplanC=''):
@@ -106,6 +117,9 @@ def loadFromH5(h5File, initplanC=''):
         if 'dose' in f['planC']:
             doseGrp = f['planC']['dose']
             #planC = loadH5Dose(doseGrp, planC)
+        if 'dvhCache' in f['planC']:
+            dvhCacheGrp = f['planC']['dvhCache']
+            loadH5DVHCache(dvhCacheGrp)
     return planC
 
 def saveH5Header(headerGrp, planC):
@@ -155,6 +169,40 @@ def saveH5Deform(deformGrp, deformNumV, planC):
             deformItem = addToH5Grp(deformItem,deformDict,key)
     return deformGrp
 
+def saveH5DVHCache(dvhCacheGrp, planC):
+    dvhKeys = ['strUID', 'doseUID', 'binWidth', 'useDoseOnScanCache', 'rasterSegHash', 'doseHash']
+    strUIDs = [s.strUID for s in planC.structure]
+    doseUIDs = [d.doseUID for d in planC.dose]
+    dvhCount = 0
+    for key, (doseBinsV, volsHistV) in dvh.dvhCache.items():
+        # Save DVHs for structures and doses of this planC only
+        if key[0] not in strUIDs or key[1] not in doseUIDs:
+            continue
+        dvhDict = dict(zip(dvhKeys, key))
+        dvhDict['doseBinsV'] = doseBinsV
+        dvhDict['volsHistV'] = volsHistV
+        itemGrpName = 'Item_' + str(dvhCount)
+        dvhCount += 1
+        dvhItem = dvhCacheGrp.create_group(itemGrpName)
+        for dictKey in list(dvhDict.keys()):
+            dvhItem = addToH5Grp(dvhItem, dvhDict, dictKey)
+    return dvhCacheGrp
+
+def loadH5DVHCache(dvhCacheGrp):
+    dvhItems = getSortedItems(list(dvhCacheGrp.keys()))
+    for dvhItem in dvhItems:
+        attrs = dvhCacheGrp[dvhItem].attrs
+        keyVals = []
+        for attrName in ['strUID', 'doseUID', 'rasterSegHash', 'doseHash']:
+            attribVal = attrs[attrName]
+            if isinstance(attribVal, np.bytes_):
+                attribVal = attribVal.decode('UTF-8')
+            keyVals.append(attribVal)
+        useDoseOnScanCache = bool(attrs['useDoseOnScanCache']) if 'useDoseOnScanCache' in attrs else False
+        key = (keyVals[0], keyVals[1], float(attrs['binWidth']), useDoseOnScanCache, keyVals[2], keyVals[3])
+        dvh.dvhCache[key] = (dvhCacheGrp[dvhItem]['doseBinsV'][:],
+                             dvhCacheGrp[dvhItem]['volsHistV'][:])
+
 def saveH5Structure(structGrp, structNumV, planC):
     strCount = 0
     for structNum in structNumV:
@@ -11,6 +11,9 @@ import cerr.dataclasses.scan as scn
 import cerr.plan_container as pc
 from cerr.utils.statistics_utils import quantile, prctile
 
+# Default maximum number of histogram bins for streamed first-order statistics
+defaultHistNumBins = 2**16
+
 def radiomics_first_order_stats(planC, structNum, offsetForEnergy=0, binWidth=None, binNum=None):
     """
 
@@ -142,3 +145,270 @@ def radiomics_first_order_stats(planC, structNum, offsetForEnergy=0, binWidth=No
     RadiomicsFirstOrderS['coeffVariation'] = RadiomicsFirstOrderS['std'] / (RadiomicsFirstOrderS['mean'] + np.finfo(float).eps)
 
     return RadiomicsFirstOrderS
+
+
+def getROIChunks(scan3M, mask3M, slicesPerChunk=16):
+    """
+    Yields intensities of ROI voxels from slabs of slicesPerChunk slices. scan3M and mask3M
+    may be any arrays supporting slicing along the 3rd dimension (e.g. np.memmap, h5py datasets),
+    so that only one slab is read into memory at a time. NaN intensities are skipped.
+    """
+    numSlcs = scan3M.shape[2]
+    for start in range(0, numSlcs, slicesPerChunk):
+        stop = min(start + slicesPerChunk, numSlcs)
+        maskSlab3M = np.asarray(mask3M[:, :, start:stop]).astype(bool)
+        if not np.any(maskSlab3M):
+            continue
+        valV = np.asarray(scan3M[:, :, start:stop], dtype=float)[maskSlab3M]
+        yield valV[~np.isnan(valV)]
+
+
+def combineMoments(momA, momB):
+    """
+    Combines (count, mean, M2, M3, M4) central moment sums of two sets of values (Pebay, 2008).
+    """
+    nA, meanA, M2A, M3A, M4A = momA
+    nB, meanB, M2B, M3B, M4B = momB
+    if nA == 0:
+        return momB
+    if nB == 0:
+        return momA
+    n = nA + nB
+    delta = meanB - meanA
+    mean = meanA + delta * nB / n
+    M2 = M2A + M2B + delta**2 * nA * nB / n
+    M3 = M3A + M3B + delta**3 * nA * nB * (nA - nB) / n**2 \
+         + 3 * delta * (nA * M2B - nB * M2A) / n
+    M4 = M4A + M4B + delta**4 * nA * nB * (nA**2 - nA * nB + nB**2) / n**3 \
+         + 6 * delta**2 * (nA**2 * M2B + nB**2 * M2A) / n**2 \
+         + 4 * delta * (nA * M3B - nB * M3A) / n
+    return n, mean, M2, M3, M4
+
+
+def histPrctile(valV, countV, p):
+    """
+    Equivalent to prctile for values valV (sorted) occurring countV times. Interpolates between
+    the same nodes as cerr.utils.statistics_utils.quantile, without expanding the values.
+    """
+    n = np.sum(countV)
+    cumCountV = np.cumsum(countV)
+    qV = np.atleast_1d(np.array(p, dtype=float) / 100)
+    if n == 1:
+        prctV = np.full(qV.shape, valV[0], dtype=float)
+    else:
+        start = 1 / (2 * n)
+        stop = (2 * n - 1) / (2 * n)
+        step = (stop - start) / (n - 1)
+        prctV = np.empty(qV.shape)
+        for i, q in enumerate(qV):
+            j = int(np.clip(np.floor((q - start) / step), 0, n - 1))
+            rankV = np.unique(np.clip(np.arange(j - 1, j + 3), 0, n - 1))
+            nodeV = rankV * step + start
+            nodeV[rankV == n - 1] = stop
+            yV = valV[np.searchsorted(cumCountV, rankV, side='right')]
+            prctV[i] = np.interp(q, nodeV, yV)
+    return prctV if np.ndim(p) else prctV[0]
+
+
+def mergeHistograms(keyV, countV, sumV, chunkKeyV, chunkCountV, chunkSumV):
+    """
+    Returns histogram (keyV, countV, sumV) with (chunkKeyV, chunkCountV, chunkSumV) added. Keys of both
+    histograms are sorted and unique; keys of the chunk are located in keyV by binary search.
+    """
+    posV = np.searchsorted(keyV, chunkKeyV)
+    foundV = posV < len(keyV)
+    foundV[foundV] = keyV[posV[foundV]] == chunkKeyV[foundV]
+    countV = countV.copy()
+    sumV = sumV.copy()
+    countV[posV[foundV]] += chunkCountV[foundV]
+    sumV[posV[foundV]] += chunkSumV[foundV]
+    newV = ~foundV
+    keyV = np.insert(keyV, posV[newV], chunkKeyV[newV])
+    countV = np.insert(countV, posV[newV], chunkCountV[newV])
+    sumV = np.insert(sumV, posV[newV], chunkSumV[newV])
+    return keyV, countV, sumV
+
+
+def groupByKey(keyV, countV, sumV):
+    """
+    Returns sorted unique keys of keyV along with the total of countV and sumV for each key.
+    """
+    keyV, invV = np.unique(keyV, return_inverse=True)
+    countV = np.bincount(invV, weights=countV, minlength=len(keyV)).astype(np.int64)
+    sumV = np.bincount(invV, weights=sumV, minlength=len(keyV))
+    return keyV, countV, sumV
+
+
+def firstOrderStatsFromChunks(chunks, VoxelVol, offsetForEnergy=0, binWidth=None, binNum=None, histBinWidth=None,
+                              histNumBins=defaultHistNumBins):
+    """
+
+    This routine calculates the features of radiomics_first_order_stats in a single pass over
+    chunks of ROI intensities. Moments are accumulated chunk-wise and percentile, deviation and
+    entropy features are derived from a histogram of intensities.
+
+    Args:
+        chunks (iterable): 1-D np.ndarrays of ROI intensities.
+        VoxelVol (float): voxel volume in mm^3.
+        offsetForEnergy(float): optional, value to add to scan for computing the Energy, TotalEnergy and RMS features
+        binWidth(float): optional, bin width for discretizing the input scan (entropy).
+        binNum(int): optional, number of bins to discretize the input scan (entropy).
+        histBinWidth(float): optional, fixed width of histogram bins. The number of bins is then
+                                not bounded. Overrides histNumBins.
+        histNumBins(int): optional, maximum number of histogram bins (default defaultHistNumBins). Bin widths are
+                                powers of 2, doubled as needed to cover the range of intensities with at most
+                                histNumBins bins. None bins distinct intensities (exact, but memory grows
+                                with the number of distinct intensities).
+                                Values within a bin are represented by their mean, so percentiles (median,
+                                P10, P90, IQR, coeffDispersion), mean/median/robust absolute deviations and
+                                entropy are approximate at the resolution of the histogram (error below the
+                                bin width). Moments, min, max and energy features are exact. Images with
+                                distinct intensities spaced more widely than the bin width (e.g. integer CT
+                                with fewer than histNumBins/2 levels) reproduce radiomics_first_order_stats.
+    Returns:
+        dict: dictionary of features
+
+    """
+
+    if offsetForEnergy is None:
+        offsetForEnergy = 0
+
+    momS = (0, 0.0, 0.0, 0.0, 0.0)
+    xmin = np.inf
+    xmax = -np.inf
+    sumSqOffset = 0.0
+    keyV = np.array([])
+    countV = np.array([], dtype=np.int64)
+    sumV = np.array([])
+    exactFlag = histBinWidth is None and histNumBins is None
+    histWidth = histBinWidth
+    for valV in chunks:
+        valV = np.asarray(valV, dtype=float).ravel()
+        if valV.size == 0:
+            continue
+
+        # Moments, extrema and energy
+        meanChunk = np.mean(valV)
+        devV = valV - meanChunk
+        devSqV = devV**2
+        momChunk = (valV.size, meanChunk, np.sum(devSqV), np.sum(devSqV * devV), np.sum(devSqV**2))
+        momS = combineMoments(momS, momChunk)
+        xmin = min(xmin, np.min(valV))
+        xmax = max(xmax, np.max(valV))
+        sumSqOffset += np.sum((valV + offsetForEnergy) ** 2)
+
+        # Histogram (count and sum of intensities per bin)
+        if exactFlag:
+            chunkKeyV = valV
+        else:
+            if histBinWidth is None:
+                # Bounded no. of bins. Widths are powers of 2, so that doubling merges pairs of bins.
+                if histWidth is None:
+                    minWidth = max((xmax - xmin) / histNumBins, max(abs(xmin), abs(xmax)) * 2.0**-40,
+                                   np.finfo(float).tiny)
+                    histWidth = 2.0 ** np.ceil(np.log2(minWidth))
+                numDoubling = 0
+                while np.floor(xmax / histWidth) - np.floor(xmin / histWidth) + 1 > histNumBins:
+                    histWidth *= 2
+                    numDoubling += 1
+                if numDoubling > 0 and len(keyV) > 0:
+                    keyV, countV, sumV = groupByKey(np.floor(keyV / 2**numDoubling), countV, sumV)
+            chunkKeyV = np.floor(valV / histWidth)
+        chunkKeyV, chunkCountV, chunkSumV = groupByKey(chunkKeyV, np.ones(valV.size), valV)
+        keyV, countV, sumV = mergeHistograms(keyV, countV, sumV, chunkKeyV, chunkCountV, chunkSumV)
+
+    n, meanVal, M2, M3, M4 = momS
+    if n == 0:
+        raise ValueError("ROI contains no voxels")
+    valV = keyV if exactFlag else sumV / countV
+
+    RadiomicsFirstOrderS = dict()
+    RadiomicsFirstOrderS['min'] = xmin
+    RadiomicsFirstOrderS['max'] = xmax
+    RadiomicsFirstOrderS['mean'] = meanVal
+    RadiomicsFirstOrderS['range'] = xmax - xmin
+    RadiomicsFirstOrderS['std'] = np.sqrt(M2 / n)
+    RadiomicsFirstOrderS['var'] = M2 / n
+    RadiomicsFirstOrderS['median'] = histPrctile(valV, countV, 50)
+
+    # Skewness and kurtosis (biased estimates, as scipy.stats)
+    if M2 > 0:
+        RadiomicsFirstOrderS['skewness'] = np.sqrt(n) * M3 / M2**1.5
+        RadiomicsFirstOrderS['kurtosis'] = n * M4 / M2**2 - 3
+    else:
+        RadiomicsFirstOrderS['skewness'] = np.nan
+        RadiomicsFirstOrderS['kurtosis'] = np.nan
+
+    # Entropy
+    if binWidth is None and binNum is not None:
+        binWidth = (xmax - xmin) / binNum
+    elif binWidth is None:
+        binWidth = 25
+    if binWidth == 0:
+        RadiomicsFirstOrderS['entropy'] = 0
+    else:
+        offsetForEntropy = -np.min(xmin,0)
+        edgeMax = xmax + offsetForEntropy + binWidth/2
+        counts, _ = np.histogram(valV + offsetForEntropy, bins=np.arange(0, edgeMax, binWidth), weights=countV)
+        RadiomicsFirstOrderS['entropy'] = entropy(counts, base=2)
+
+    # Root mean square (RMS), Energy and Total Energy
+    RadiomicsFirstOrderS['rms'] = np.sqrt(sumSqOffset / n)
+    RadiomicsFirstOrderS['energy'] = sumSqOffset
+    RadiomicsFirstOrderS['totalEnergy'] = sumSqOffset * VoxelVol
+
+    # Mean and median absolute deviation
+    RadiomicsFirstOrderS['meanAbsDev'] = np.sum(countV * np.abs(valV - meanVal)) / n
+    RadiomicsFirstOrderS['medianAbsDev'] = np.sum(countV * np.abs(valV - RadiomicsFirstOrderS['median'])) / n
+
+    # P10, P90
+    p10, p25, p75, p90 = histPrctile(valV, countV, [10, 25, 75, 90])
+    RadiomicsFirstOrderS['P10'] = p10
+    RadiomicsFirstOrderS['P90'] = p90
+
+    # Robust Mean and Median Absolute Deviation (intensities within [P10, P90])
+    idx10_90 = (valV >= p10) & (valV <= p90)
+    val10_90V = valV[idx10_90]
+    count10_90V = countV[idx10_90]
+    n10_90 = np.sum(count10_90V)
+    mean10_90 = np.sum(count10_90V * val10_90V) / n10_90
+    median10_90 = histPrctile(val10_90V, count10_90V, 50)
+    RadiomicsFirstOrderS['robustMeanAbsDev'] = np.sum(count10_90V * np.abs(val10_90V - mean10_90)) / n10_90
+    RadiomicsFirstOrderS['robustMedianAbsDev'] = np.sum(count10_90V * np.abs(val10_90V - median10_90)) / n10_90
+
+    # Inter-Quartile Range (IQR) and Quartile coefficient of Dispersion
+    RadiomicsFirstOrderS['interQuartileRange'] = p75 - p25
+    RadiomicsFirstOrderS['coeffDispersion'] = (p75 - p25) / (p75 + p25)
+
+    # Coefficient of variation
+    RadiomicsFirstOrderS['coeffVariation'] = RadiomicsFirstOrderS['std'] / (RadiomicsFirstOrderS['mean'] + np.finfo(float).eps)
+
+    return RadiomicsFirstOrderS
+
+
+def radiomics_first_order_stats_chunked(scan3M, mask3M, VoxelVol, offsetForEnergy=0, binWidth=None, binNum=None,
+                                        histBinWidth=None, histNumBins=defaultHistNumBins, slicesPerChunk=16):
+    """
+
+    This routine calculates 1st order statistical features (see radiomics_first_order_stats) by streaming
+    slabs of slices of the scan, without copying ROI intensities out in full. Suitable for large ROIs
+    and chunked or lazily loaded scans (e.g. np.memmap, h5py datasets).
+
+    Args:
+        scan3M (np.ndarray or array-like): 3D scan.
+        mask3M (np.ndarray or array-like): 3D binary mask for segmentation that matches the scan dimensions.
+        VoxelVol (float): voxel volume in mm^3.
+        offsetForEnergy(float): optional, value to add to scan for computing the Energy, TotalEnergy and RMS features
+        binWidth(float): optional, bin width for discretizing the input scan (entropy).
+        binNum(int): optional, number of bins to discretize the input scan (entropy).
+        histBinWidth(float): optional, fixed width of histogram bins. See firstOrderStatsFromChunks.
+        histNumBins(int): optional, maximum number of histogram bins, or None to bin distinct intensities
+                                (exact). See firstOrderStatsFromChunks.
+        slicesPerChunk(int): optional, number of slices read at a time.
+    Returns:
+        dict: dictionary of features
+
+    """
+
+    return firstOrderStatsFromChunks(getROIChunks(scan3M, mask3M, slicesPerChunk), VoxelVol,
+                                     offsetForEnergy, binWidth, binNum, histBinWidth, histNumBins)
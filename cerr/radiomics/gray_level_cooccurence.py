@@ -1,305 +1,344 @@
 import numpy as np
-from scipy.sparse import lil_matrix
-
-
-def calcCooccur(quantizedM, offsetsM, nL, cooccurType=1):
-    # Default to building cooccurrence by combining all offsets
-    numColsPad = 1
-    numRowsPad = 1
-    numSlcsPad = 1
-
-    # Get the size of the quantized image
-    numRows, numCols, numSlices = quantizedM.shape
-
-    # Pad quantizedM
-    q = np.pad(quantizedM, ((numRowsPad, numRowsPad), (numColsPad, numColsPad), (numSlcsPad, numSlcsPad)), constant_values=0)
-    q[q==0] = nL + 1  # Replace NaN values with lq
-
-    q = q.astype(np.uint32)  # q is the quantized image
-    if q.max() > 65535:
+from scipy import sparse
+
+# Number of quantized levels above which sparse co-occurrence matrices are suggested (memory of the
+# dense matrix grows with nL*nL). Sparse features are computed in double precision and may differ from
+# the single precision dense path by ~1e-5 (relative), so the sparse path is opt-in.
+sparseLevelsThreshold = 256
+
+# Leave the p(x+y) term for i+j=2 out of sum entropy, as the original level-wise implementation did
+# (its check on the indices of that term always failed). Kept for parity with earlier feature values.
+# Set to False for the IBSI definition. Both agree with IBSI1 reference values within tolerance.
+sumEntropyExcludeLowestSum = True
+
+glcmFeatureNames = ['energy', 'jointEntropy', 'jointMax', 'jointAvg', 'jointVar', 'sumAvg', 'sumVar',
+                    'sumEntropy', 'contrast', 'invDiffMom', 'invDiffMomNorm', 'invDiff', 'invDiffNorm',
+                    'invVar', 'dissimilarity', 'diffEntropy', 'diffVar', 'diffAvg', 'corr', 'clustTendency',
+                    'clustShade', 'clustPromin', 'haralickCorr', 'autoCorr', 'firstInfCorr', 'secondInfCorr']
+
+
+def getOffsetSlices(offset, siz):
+    """
+    Returns slices selecting voxel pairs (x[i], x[i - offset]) for which both voxels
+    lie within an array of size siz.
+    """
+    slc1 = []
+    slc2 = []
+    for off, n in zip(offset, siz):
+        off = int(off)
+        if off >= 0:
+            slc1.append(slice(off, n))
+            slc2.append(slice(0, n - off))
+        else:
+            slc1.append(slice(0, n + off))
+            slc2.append(slice(-off, n))
+    return tuple(slc1), tuple(slc2)
+
+
+def calcCooccur(quantizedM, offsetsM, nL, cooccurType=1, sparseFlag=False, textureContext=None):
+    """
+    Returns normalized (nL*nL, 1) cooccurrence matrix combined across offsets when
+    cooccurType=1, or (nL*nL, numOffsets) matrices per offset when cooccurType=2.
+    Voxels with level 0 (outside the ROI) are ignored.
+    When sparseFlag is True, a scipy.sparse CSC matrix holding only the observed level
+    pairs is returned. Use for fine discretisation (e.g. nL > sparseLevelsThreshold). In ibsi1, set
+    "sparseCooccur": "yes" in the texture settings.
+    When a TextureContext is passed, its ROI-cropped volume is used instead of quantizedM.
+    """
+    nL = int(nL)
+    if nL > 65535:
         raise Exception('Number of quantized levels greater than 65535. Increase binWidth to reduce discretized levels')
+    if sparseFlag:
+        return calcSparseCooccur(quantizedM, offsetsM, nL, cooccurType, textureContext)
 
-    # Number of offsets
-    numOffsets = offsetsM.shape[0]
-
-    # Indices of last level to filter out
+    # Smallest integer types able to hold the levels and linear indices.
+    # Level 0 (outside the ROI) is kept as an extra row/column that is dropped after counting.
+    levelType = np.uint8 if nL < 2**8 else np.uint16
     lq = nL + 1
-    nanIndV = np.zeros(lq*lq, dtype=bool)
-    nanIndV[lq-1:lq*lq-lq:lq] = True
-    nanIndV[lq*lq-lq-1:lq*lq] = True
+    numCoOcs = lq * lq
+    indType = np.uint32 if numCoOcs < 2**32 else np.uint64
+    if textureContext is not None:
+        quantizedM = textureContext.quantized3M
+    q = quantizedM.astype(levelType, copy=False)
+    siz = q.shape
 
-    # Build linear indices column/row-wise for Symmetry
-    indRowV = np.zeros(lq*lq)
-    for i in range(1, lq + 1):
-        indRowV[(i-1)*lq:i*lq] = np.arange(i, lq*lq+1, lq)
+    # Number of offsets
+    numOffsets = offsetsM.shape[0]
 
-    # Initialize cooccurrence matrix (vectorized for speed)
-    numCoOcs = lq * lq
-    # if cooccurType == 1:
-    #     cooccurM = lil_matrix((numCoOcs, 1), dtype=np.float32)
-    # else:
-    #     cooccurM = lil_matrix((numCoOcs, numOffsets), dtype=np.float32)
+    # Accumulate voxel pairs of all offsets into one (1 or numOffsets, lq*lq) array
     if cooccurType == 1:
-        cooccurM = np.zeros((numCoOcs,1), dtype=np.float32)
+        countM = np.zeros((1, numCoOcs), dtype=np.float32)
     else:
-        cooccurM = np.zeros((numCoOcs, numOffsets), dtype=np.float32)
-
-    slc1M = q[numRowsPad:(numRowsPad+numRows+1), numColsPad:(numColsPad+numCols+1), numSlcsPad:(numSlcsPad+numSlices+1)]
+        countM = np.zeros((numOffsets, numCoOcs), dtype=np.float32)
     for off in range(numOffsets):
-        offset = offsetsM[off, :]
-        slc2M = np.roll(q, offset, axis=(0, 1, 2))
-        slc2M = slc2M[numRowsPad:(numRowsPad+numRows+1), numColsPad:(numColsPad+numCols+1), numSlcsPad:(numSlcsPad+numSlices+1)] + \
-                (slc1M - 1) * lq
-        coccurForOffV = np.bincount(slc2M.flatten(), minlength=numCoOcs)[1:]
-        if cooccurType == 1:
-            cooccurM += np.array(np.reshape(coccurForOffV,(numCoOcs,1)))
-        else:
-            cooccurM[:,off] = coccurForOffV
+        slc1, slc2 = getOffsetSlices(offsetsM[off, :], siz)
+        indM = q[slc1].astype(indType) * lq
+        indM += q[slc2]
+        countM[min(off, countM.shape[0] - 1), :] += np.bincount(indM.ravel(), minlength=numCoOcs)
 
-    # Ensure symmetry
-    cooccurM += cooccurM[indRowV.astype(int)-1, :]
-
-    # Remove rows and columns with NaN
-    #cooccurM = cooccurM.tocsr()
-    cooccurM = cooccurM[~nanIndV, :]
+    # Remove pairs outside the ROI and ensure symmetry
+    countM = countM.reshape(countM.shape[0], lq, lq)[:, 1:, 1:]
+    countM = countM + countM.transpose(0, 2, 1)
+    cooccurM = np.ascontiguousarray(countM.reshape(countM.shape[0], nL * nL).T)
 
     # Normalize the cooccurrence matrix
-    #col_sum = np.asarray(cooccurM.sum(axis=0))
     col_sum = cooccurM.sum(axis=0)
     col_sum[col_sum == 0] = 1  # Avoid division by zero
-    for off in range(cooccurM.shape[1]):
-        cooccurM[:,off] /= col_sum[off]
+    cooccurM = cooccurM / col_sum
 
-    #return cooccurM.toarray()
     return cooccurM
 
 
-def cooccurToScalarFeatures(cooccurM):
-    ''''
-    Calculate scalar texture features from cooccurM
-    '''''
-
-    # Initialize featureS dictionaries
-    # Calculate the number of cooccur matrices (number of columns in cooccurM)
-    numCooccurs = cooccurM.shape[1]
-    featureS = {
-        'energy': np.zeros(numCooccurs),
-        'jointEntropy': np.zeros(numCooccurs),
-        'jointMax': np.zeros(numCooccurs),
-        'jointAvg': np.zeros(numCooccurs),
-        'jointVar': np.zeros(numCooccurs),
-        'sumAvg': np.zeros(numCooccurs),
-        'sumVar': np.zeros(numCooccurs),
-        'sumEntropy': np.zeros(numCooccurs),
-        'contrast': np.zeros(numCooccurs),
-        'invDiffMom': np.zeros(numCooccurs),
-        'invDiffMomNorm': np.zeros(numCooccurs),
-        'invDiff': np.zeros(numCooccurs),
-        'invDiffNorm': np.zeros(numCooccurs),
-        'invVar': np.zeros(numCooccurs),
-        'dissimilarity': np.zeros(numCooccurs),
-        'diffEntropy': np.zeros(numCooccurs),
-        'diffVar': np.zeros(numCooccurs),
-        'diffAvg': np.zeros(numCooccurs),
-        'sumAvg': np.zeros(numCooccurs),
-        'sumVar': np.zeros(numCooccurs),
-        'sumEntropy': np.zeros(numCooccurs),
-        'corr': np.zeros(numCooccurs),
-        'clustTendency': np.zeros(numCooccurs),
-        'clustShade': np.zeros(numCooccurs),
-        'clustPromin': np.zeros(numCooccurs),
-        'haralickCorr': np.zeros(numCooccurs),
-        'autoCorr': np.zeros(numCooccurs),
-        'firstInfCorr': np.zeros(numCooccurs),
-        'secondInfCorr': np.zeros(numCooccurs),
-    }
+def sumDuplicatePairs(indV, countV):
+    """
+    Returns unique pair indices (sorted) and the summed counts for each.
+    """
+    pairIndV, invV = np.unique(indV, return_inverse=True)
+    return pairIndV, np.bincount(invV.ravel(), weights=countV, minlength=len(pairIndV))
+
+
+def calcSparseCooccur(quantizedM, offsetsM, nL, cooccurType=1, textureContext=None):
+    """
+    Sparse counterpart of calcCooccur. Memory scales with the number of observed
+    level pairs rather than with nL*nL.
+    """
+    nL = int(nL)
+    levelType = np.uint8 if nL < 2**8 else np.uint16
+    indType = np.uint32 if nL * nL < 2**32 else np.uint64
+    if textureContext is not None:
+        quantizedM = textureContext.quantized3M
+    q = quantizedM.astype(levelType, copy=False)
+    siz = q.shape
+    numOffsets = offsetsM.shape[0]
 
-    nL = int(np.sqrt(cooccurM.shape[0]))
+    pairIndC = []
+    countC = []
+    for off in range(numOffsets):
+        slc1, slc2 = getOffsetSlices(offsetsM[off, :], siz)
+        lev1V = q[slc1].ravel()
+        lev2V = q[slc2].ravel()
+        validV = (lev1V > 0) & (lev2V > 0)
+        indV = (lev1V[validV].astype(indType) - 1) * nL + (lev2V[validV] - 1)
+        pairIndV, countV = np.unique(indV, return_counts=True)
+        # Ensure symmetry
+        symIndV = (pairIndV % nL) * nL + pairIndV // nL
+        pairIndV, countV = sumDuplicatePairs(np.concatenate((pairIndV, symIndV)),
+                                             np.concatenate((countV, countV)))
+        pairIndC.append(pairIndV)
+        countC.append(countV)
 
-    # Build levels vector for mu, sig
-    levRowV = np.tile(np.arange(1, nL + 1), (1,nL))
-    levColV = np.tile(np.arange(1, nL + 1), (nL,1))
-    levColV = levColV.flatten(order = "F")
-    levColV = levColV[None,:]
+    if cooccurType == 1:
+        pairIndV, countV = sumDuplicatePairs(np.concatenate(pairIndC), np.concatenate(countC))
+        pairIndC = [pairIndV]
+        countC = [countV]
 
-    # Build list of indices for px and contrast calculation
-    indCtrstC = {}
-    indPxC = {}
-    px = np.zeros((nL, cooccurM.shape[1]))
-    pXminusY = np.zeros((nL, cooccurM.shape[1]))
-    pXminusYlogPXminusY = np.zeros((nL, cooccurM.shape[1]))
+    # Normalize the cooccurrence matrix
+    for col in range(len(countC)):
+        col_sum = np.sum(countC[col])
+        if col_sum > 0:
+            countC[col] = countC[col] / col_sum
 
-    for n in range(nL):
-        # indices for p(x-y), contrast
-        indCtrst1V = np.arange(0, nL - n, dtype = np.uint64)
-        indCtrst2V = np.arange(0 + n, nL, dtype = np.uint64)
-        indCtrstTmpV = np.concatenate((indCtrst1V + indCtrst2V * nL, indCtrst2V + indCtrst1V * nL))
-        indCtrstC[n] = np.unique(indCtrstTmpV)
+    indptrV = np.concatenate(([0], np.cumsum([len(pairIndV) for pairIndV in pairIndC])))
+    cooccurM = sparse.csc_matrix((np.concatenate(countC), np.concatenate(pairIndC).astype(np.int64), indptrV),
+                                 shape=(nL * nL, len(countC)))
 
-        # indices for px
-        indPxC[n] = np.arange(nL * n, nL * (n + 1), dtype = np.uint64)
+    return cooccurM
 
-        for col in range(cooccurM.shape[1]):
-            px[n, col] = np.sum(cooccurM[indPxC[n], col])
-            pXminusY[n, col] = np.sum(cooccurM[indCtrstC[n], col])
 
-            if np.any(indCtrstC[n]):
-                pXminusYlogPXminusY[n, col] = pXminusY[n, col] * np.log2(pXminusY[n, col] + np.finfo(float).eps)
-            else:
-                pXminusYlogPXminusY[n, col] = 0
+def distributionsToFeatures(pXminusY, pXplusY, nL):
+    """
+    Returns difference and sum features from the (nL, numCooccurs) p(x-y) and
+    (2*nL, numCooccurs) p(x+y) distributions.
+    """
+    eps = np.finfo(float).eps
+    diffV = np.arange(nL)[:, None]
+    sumV = np.arange(1, 2 * nL + 1)[:, None]
+    featureS = {}
+    featureS['contrast'] = np.sum(diffV**2 * pXminusY, axis=0)
+    featureS['dissimilarity'] = np.sum(diffV * pXminusY, axis=0)
+    featureS['invDiffMom'] = np.sum(pXminusY / (1 + diffV**2), axis=0)
+    featureS['invDiffMomNorm'] = np.sum(pXminusY / (1 + (diffV / nL)**2), axis=0)
+    featureS['invDiff'] = np.sum(pXminusY / (1 + diffV), axis=0)
+    featureS['invDiffNorm'] = np.sum(pXminusY / (1 + diffV / nL), axis=0)
+    featureS['invVar'] = np.sum(pXminusY[1:, :] / diffV[1:]**2, axis=0)
+    featureS['diffEntropy'] = -np.sum(pXminusY * np.log2(pXminusY + eps), axis=0)
+    featureS['diffVar'] = np.sum((diffV - featureS['dissimilarity'])**2 * pXminusY, axis=0)
+    featureS['diffAvg'] = featureS['dissimilarity']
+    featureS['sumAvg'] = np.sum(sumV * pXplusY, axis=0)
+    featureS['sumVar'] = np.sum((sumV - featureS['sumAvg'])**2 * pXplusY, axis=0)
+    sumEntropyTermsM = pXplusY * np.log2(pXplusY + eps)
+    if sumEntropyExcludeLowestSum:
+        # row 1 of pXplusY holds i+j=2 (see sumV)
+        sumEntropyTermsM[1, :] = 0
+    featureS['sumEntropy'] = -np.sum(sumEntropyTermsM, axis=0)
+    return featureS
 
-    levRowColSum = levRowV + levColV
-    indPxPlusYc = [np.where(levRowColSum == n)[1] for n in range(1, 2 * nL + 1)]
 
+def pxToCorrFeatures(px, autoCorr, nL):
+    """
+    Returns Haralick and auto correlation from the marginal px and sum(i*j*p(i,j)).
+    """
+    eps = np.finfo(float).eps
+    muX = 1 / nL
+    sigX = np.sum((px - muX)**2, axis=0) / nL
+    featureS = {}
+    featureS['haralickCorr'] = ((autoCorr - muX**2) / (sigX + eps))[None, :]
+    featureS['autoCorr'] = autoCorr[None, :]
+    return featureS
 
-    # Angular Second Moment (Energy)
-    featureS['energy'] = np.sum(cooccurM**2, axis=0)
 
-    # Joint Entropy
-    featureS['jointEntropy'] = -np.sum(cooccurM * np.log2(cooccurM + np.finfo(float).eps), axis=0)
+def pxToInfCorrFeatures(px, logPx, HXY1, jointEntropy):
+    """
+    Returns the first and second measures of information correlation.
+    """
+    featureS = {}
+    HX = -np.sum(px * logPx, axis=0)
+    featureS['firstInfCorr'] = ((jointEntropy - HXY1) / HX)[None, :]
+    # The sum over all (i,j) of px(i)px(j)log2(px(i)px(j)) factorizes into marginal sums
+    HXY2 = -2 * np.sum(px, axis=0) * np.sum(px * logPx, axis=0)
+    secondInfCorr = 1 - np.exp(-2 * (HXY2 - jointEntropy))
+    secondInfCorr[secondInfCorr <= 0] = 0
+    featureS['secondInfCorr'] = np.sqrt(secondInfCorr)[None, :]
+    return featureS
 
-    # Joint Max
-    featureS['jointMax'] = np.max(cooccurM, axis=0)
 
-    # Joint Average
-    # featureS['jointAvg'] = np.zeros(cooccurM.shape[1])
-    featureS['jointAvg'] = np.sum(cooccurM.T * levRowV, axis = 1)
-    # for off in range(cooccurM.shape[1]):
-    #     featureS['jointAvg'][off] = np.sum(cooccurM[:,off,None] * levRowV[:,None].reshape((levRowV.shape[1],1)))
-
-    # Joint Variance
-    xMinusMu = np.zeros(cooccurM.shape)
-    for off in range(len(featureS['jointAvg'])):
-        xMinusMu[:,off] = levRowV - featureS['jointAvg'][off]
-    featureS['jointVar'] = np.sum(xMinusMu**2 * cooccurM, axis=0)
-
-    # Contrast
-    featureS['contrast'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(nL):
-            featureS['contrast'][off] += np.sum(n**2 * cooccurM[indCtrstC[n], off], axis=0)
-
-    # Dissimilarity
-    featureS['dissimilarity'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(nL):
-            featureS['dissimilarity'][off] += np.sum(n * cooccurM[indCtrstC[n], off], axis=0)
-
-    # Inverse Difference Moment
-    featureS['invDiffMom'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(nL):
-            featureS['invDiffMom'][off] += np.sum((1 / (1 + n**2)) * cooccurM[indCtrstC[n], off], axis=0)
-
-    # Inverse Difference Moment (Normalized)
-    featureS['invDiffMomNorm'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(nL):
-            featureS['invDiffMomNorm'][off] += np.sum((1 / (1 + (n / nL)**2)) * cooccurM[indCtrstC[n], off], axis=0)
-
-    # Inverse Difference
-    featureS['invDiff'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(nL):
-            featureS['invDiff'][off] += np.sum((1 / (1 + n)) * cooccurM[indCtrstC[n], off], axis=0)
-
-    # Inverse Difference (Normalized)
-    featureS['invDiffNorm'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(nL):
-            featureS['invDiffNorm'][off] += np.sum((1 / (1 + n / nL)) * cooccurM[indCtrstC[n], off], axis=0)
-
-    # Inverse Variance
-    featureS['invVar'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(1, nL):
-            featureS['invVar'][off] += np.sum((1 / n**2) * cooccurM[indCtrstC[n], off], axis=0)
-
-    # Difference Entropy
-    featureS['diffEntropy'] = - np.sum(pXminusYlogPXminusY, axis=0)
-
-    # Difference Variance
-    featureS['diffVar'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(nL):
-            featureS['diffVar'][off] += (n - featureS['dissimilarity'][off])**2 * pXminusY[n, off]
-
-    # Difference Average
-    featureS['diffAvg'] = featureS['dissimilarity']
+def sparseCooccurToScalarFeatures(cooccurM):
+    """
+    Calculate scalar texture features from a sparse cooccurM using its non-zero entries only.
+    Features are returned in the same format as cooccurToScalarFeatures.
+    """
+    cooccurM = sparse.csc_matrix(cooccurM)
+    numCooccurs = cooccurM.shape[1]
+    nL = int(np.sqrt(cooccurM.shape[0]))
+    eps = np.finfo(float).eps
 
-    pXplusY = np.zeros((2 * nL, numCooccurs))
-    pXplusYlogPXplusY = np.zeros((2 * nL, numCooccurs))
+    pV = cooccurM.data.astype(float)
+    offV = np.repeat(np.arange(numCooccurs), np.diff(cooccurM.indptr))
+    levIV = cooccurM.indices % nL + 1
+    levJV = cooccurM.indices // nL + 1
 
-    featureS['sumAvg'] = np.zeros(cooccurM.shape[1])
-    featureS['sumEntropy'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(1, 2 * nL + 1):
-            # Calculate p(x+y)
-            pXplusY[n - 1, off] = np.sum(cooccurM[indPxPlusYc[n - 1], off], axis=0)
+    def sumPerOffset(valV):
+        return np.bincount(offV, weights=valV, minlength=numCooccurs)
 
-            # Calculate p(x+y) log2(p(x+y))
-            if np.any(indPxPlusYc[n - 1]):
-                pXplusYlogPXplusY[n - 1, off] = pXplusY[n - 1, off] * np.log2(pXplusY[n - 1, off] + np.finfo(float).eps)
-            else:
-                pXplusYlogPXplusY[n - 1, off] = 0 #np.zeros(numCooccurs)
+    def distribution(binV, numBins):
+        return np.bincount(binV * numCooccurs + offV, weights=pV,
+                           minlength=numBins * numCooccurs).reshape(numBins, numCooccurs)
 
-            # Calculate Sum Average
-            featureS['sumAvg'][off] += n * pXplusY[n - 1, off]
+    # p(x), p(x-y) and p(x+y)
+    px = distribution(levJV - 1, nL)
+    pXminusY = distribution(np.abs(levIV - levJV), nL)
+    pXplusY = distribution(levIV + levJV - 1, 2 * nL)
 
-            # Calculate Sum Entropy
-            featureS['sumEntropy'][off] -= pXplusYlogPXplusY[n - 1, off]
+    featureS = dict.fromkeys(glcmFeatureNames)
+    featureS['energy'] = sumPerOffset(pV * pV)
+    featureS['jointEntropy'] = -sumPerOffset(pV * np.log2(pV + eps))
+    featureS['jointMax'] = cooccurM.max(axis=0).toarray().ravel()
+    featureS['jointAvg'] = sumPerOffset(pV * levIV)
+    levIMinusAvgV = levIV - featureS['jointAvg'][offV]
+    featureS['jointVar'] = sumPerOffset(levIMinusAvgV * levIMinusAvgV * pV)
 
-    # Calculate Sum Variance
-    featureS['sumVar'] = np.zeros(cooccurM.shape[1])
-    for off in range(cooccurM.shape[1]):
-        for n in range(1, 2 * nL + 1):
-            featureS['sumVar'][off] += (n - featureS['sumAvg'][off])**2 * pXplusY[n - 1, off]
+    # Features of p(x-y) and p(x+y)
+    featureS.update(distributionsToFeatures(pXminusY, pXplusY, nL))
 
     # Weighted Pixel Average (mu), Weighted Pixel Variance (sig)
-    mu = np.matmul(np.reshape(np.arange(1,nL+1, dtype = np.uint64),(1,nL)),px)
-    sig = np.reshape(np.arange(1,nL+1, dtype = np.uint64),(nL,1)) - mu
-    sig = np.sum(sig * sig * px, axis = 0)
-    sig = sig[:,None]
+    levV = np.arange(1, nL + 1)[:, None]
+    mu = np.sum(levV * px, axis=0)
+    sig = np.sum((levV - mu)**2 * px, axis=0)
+
+    # Correlation and cluster features
+    levIMinusMuV = levIV - mu[offV]
+    levJMinusMuV = levJV - mu[offV]
+    featureS['corr'] = (sumPerOffset(levIMinusMuV * levJMinusMuV * pV) / (sig + eps))[None, :]
+    clstrV = levIMinusMuV + levJMinusMuV
+    clstrSqV = clstrV * clstrV
+    featureS['clustTendency'] = sumPerOffset(clstrSqV * pV)
+    featureS['clustShade'] = sumPerOffset(clstrSqV * clstrV * pV)
+    featureS['clustPromin'] = sumPerOffset(clstrSqV * clstrSqV * pV)
+
+    # Haralick Correlation, Auto Correlation
+    autoCorr = sumPerOffset(levIV * levJV * pV)
+    featureS.update(pxToCorrFeatures(px, autoCorr, nL))
+
+    # Measures of Information Correlation
+    logPx = np.log2(px + eps)
+    HXY1 = -sumPerOffset(pV * (logPx[levIV - 1, offV] + logPx[levJV - 1, offV]))
+    featureS.update(pxToInfCorrFeatures(px, logPx, HXY1, featureS['jointEntropy']))
 
-    # Correlation
-    levIMinusMu = levRowV.T - mu
-    levJMinusMu = levColV.T - mu
-    featureS['corr'] = np.reshape(np.sum(levIMinusMu * levJMinusMu * cooccurM, axis=0), sig.shape) / (sig + np.finfo(float).eps)
-    featureS['corr'] = featureS['corr'].T
+    return featureS
 
-    clstrV = levIMinusMu + levJMinusMu
 
-    # Cluster Tendency
-    featureS['clustTendency'] = np.sum(clstrV**2 * cooccurM, axis=0)
+def cooccurToScalarFeatures(cooccurM):
+    ''''
+    Calculate scalar texture features from cooccurM
+    '''''
 
-    # Cluster Shade
-    featureS['clustShade'] = np.sum(clstrV**3 * cooccurM, axis=0)
+    if sparse.issparse(cooccurM):
+        return sparseCooccurToScalarFeatures(cooccurM)
 
-    # Cluster Prominence
-    featureS['clustPromin'] = np.sum(clstrV**4 * cooccurM, axis=0)
+    # Calculate the number of cooccur matrices (number of columns in cooccurM)
+    numCooccurs = cooccurM.shape[1]
+    nL = int(np.sqrt(cooccurM.shape[0]))
+    eps = np.finfo(float).eps
+    cooccurM = cooccurM.astype(float)
 
-    # Haralick Correlation
-    muX = 1 / nL
-    sigX = px - muX
-    sigX = np.sum(sigX**2, axis=0) / nL
-    featureS['haralickCorr'] = (np.matmul(levRowV * levColV,
-                                   cooccurM) - muX**2) / (sigX + np.finfo(float).eps)
-
-    # Auto Correlation
-    featureS['autoCorr'] =  np.matmul((levRowV * levColV),cooccurM)
-
-    # First Measure of Information Correlation
-    logTerm = np.log2((px[levRowV-1, :] + np.finfo(float).eps) * (px[levColV-1, :] + np.finfo(float).eps))
-    HXY1 = -np.sum(cooccurM * logTerm, axis=1)
-    HX = -np.sum(px * np.log2(px + np.finfo(float).eps), axis=0)
-    featureS['firstInfCorr'] = (featureS['jointEntropy'] - HXY1) / HX
-
-    # Second Measure of Information Correlation
-    HXY2 = -np.sum(px[levRowV-1, :] * px[levColV-1, :] * np.log2((px[levRowV-1, :]
-                + np.finfo(float).eps) * (px[levColV-1, :] + np.finfo(float).eps)), axis=1)
-    featureS['secondInfCorr'] = 1 - np.exp(-2 * (HXY2 - featureS['jointEntropy']))
-    indZerosV = featureS['secondInfCorr'] <= 0
-    featureS['secondInfCorr'][indZerosV] = 0
-    featureS['secondInfCorr'] = np.sqrt(featureS['secondInfCorr'])
+    # Row (i) and column (j) levels of each element of the nL x nL matrices
+    levIV = np.tile(np.arange(1, nL + 1), nL)
+    levJV = np.repeat(np.arange(1, nL + 1), nL)
+
+    # p(x) from the (nL, nL, numCooccurs) tensor, p(x-y) and p(x+y) via index bincounts
+    px = cooccurM.reshape(nL, nL, numCooccurs).sum(axis=1)
+    offV = np.arange(numCooccurs)
+
+    def distribution(binV, numBins):
+        return np.bincount((binV[:, None] * numCooccurs + offV).ravel(), weights=cooccurM.ravel(),
+                           minlength=numBins * numCooccurs).reshape(numBins, numCooccurs)
+
+    pXminusY = distribution(np.abs(levIV - levJV), nL)
+    pXplusY = distribution(levIV + levJV - 1, 2 * nL)
+
+    featureS = dict.fromkeys(glcmFeatureNames)
+
+    # Angular Second Moment (Energy)
+    featureS['energy'] = np.sum(cooccurM * cooccurM, axis=0)
+
+    # Joint Entropy
+    featureS['jointEntropy'] = -np.sum(cooccurM * np.log2(cooccurM + eps), axis=0)
+
+    # Joint Max
+    featureS['jointMax'] = np.max(cooccurM, axis=0)
+
+    # Joint Average, Joint Variance
+    featureS['jointAvg'] = levIV @ cooccurM
+    levIMinusAvgM = levIV[:, None] - featureS['jointAvg']
+    featureS['jointVar'] = np.sum(levIMinusAvgM * levIMinusAvgM * cooccurM, axis=0)
+
+    # Features of p(x-y) and p(x+y)
+    featureS.update(distributionsToFeatures(pXminusY, pXplusY, nL))
+
+    # Weighted Pixel Average (mu), Weighted Pixel Variance (sig)
+    levV = np.arange(1, nL + 1)[:, None]
+    mu = np.sum(levV * px, axis=0)
+    sig = np.sum((levV - mu)**2 * px, axis=0)
+
+    # Correlation
+    levIMinusMuM = levIV[:, None] - mu
+    levJMinusMuM = levJV[:, None] - mu
+    featureS['corr'] = (np.sum(levIMinusMuM * levJMinusMuM * cooccurM, axis=0) / (sig + eps))[None, :]
+
+    # Cluster Tendency, Shade and Prominence
+    clstrM = levIMinusMuM + levJMinusMuM
+    clstrSqM = clstrM * clstrM
+    featureS['clustTendency'] = np.sum(clstrSqM * cooccurM, axis=0)
+    featureS['clustShade'] = np.sum(clstrSqM * clstrM * cooccurM, axis=0)
+    featureS['clustPromin'] = np.sum(clstrSqM * clstrSqM * cooccurM, axis=0)
+
+    # Haralick Correlation, Auto Correlation
+    autoCorr = (levIV * levJV) @ cooccurM
+    featureS.update(pxToCorrFeatures(px, autoCorr, nL))
+
+    # Measures of Information Correlation
+    logPx = np.log2(px + eps)
+    HXY1 = -np.sum(cooccurM * (logPx[levIV - 1, :] + logPx[levJV - 1, :]), axis=0)
+    featureS.update(pxToInfCorrFeatures(px, logPx, HXY1, featureS['jointEntropy']))
 
     return featureS
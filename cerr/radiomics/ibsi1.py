@@ -1,7 +1,11 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
 from cerr.radiomics import first_order, gray_level_cooccurence, run_length,\
     size_zone, neighbor_gray_level_dependence, neighbor_gray_tone
+from cerr.radiomics.texture_context import TextureContext
 from cerr.utils.bbox import compute_boundingbox
 from cerr.radiomics import preprocess, textureUtils
 import json
@@ -34,7 +38,48 @@ def getDirectionOffsets(direction):
     return offsetsM
 
 
+textureFeatureClasses = ['glcm', 'glrlm', 'glszm', 'gldm', 'gtdm']
+
+def isFeatureClassRequested(paramS, featClass):
+    """
+    Returns True when featClass is listed in paramS['featureClass'] with a non-empty featureList.
+    """
+    return featClass in paramS['featureClass'] and \
+        paramS['featureClass'][featClass]["featureList"] not in ({}, [], '')
+
+def getRequestedFeatures(paramS, featClass, featNames):
+    """
+    Returns the list of features requested for featClass, or None when all features are requested
+    (featureList: ["all"]). Features may be specified by their CERR or IBSI names. IBSI names are
+    mapped to the CERR names in featNames.
+    """
+    featList = paramS['featureClass'][featClass]["featureList"]
+    if isinstance(featList, str):
+        featList = [featList]
+    if any(feat.lower() == 'all' for feat in featList):
+        return None
+    __, mapFeatDict = getIBSINameMap()
+    ibsiToCerrDict = {mapFeatDict[feat]: feat for feat in featNames if feat in mapFeatDict}
+    return [feat if feat in featNames else ibsiToCerrDict.get(feat, feat) for feat in featList]
+
+def selectRequestedFeatures(featS, featList, featClass):
+    """
+    Returns features from featS that are in featList. All features are returned when featList is None.
+    """
+    if featList is None:
+        return featS
+    invalidFeatures = set(featList) - set(featS.keys())
+    if invalidFeatures:
+        raise ValueError('Invalid ' + featClass + ' features: ' + ', '.join(sorted(invalidFeatures)))
+    return {feat: featS[feat] for feat in featS if feat in featList}
+
+
 def calcRadiomicsForImgType(volToEval, maskBoundingBox3M, morphMask3M, gridS, paramS):
+    """
+    Returns a dictionary of features per feature class for the image type volToEval.
+    Only feature classes with a non-empty featureList are computed. Matrices and
+    intermediates (e.g. quantization, shape mesh) are skipped unless a requested feature needs them.
+    """
 
     featDict = {}
 
@@ -44,6 +89,7 @@ def calcRadiomicsForImgType(volToEval, maskBoundingBox3M, morphMask3M, gridS, pa
     firstOrderEntropyBinNum = None
     textureBinNum = None
     textureBinWidth = None
+    sparseCooccurFlag = False
     if 'binWidthEntropy' in paramS['settings']['firstOrder'] \
         and isinstance(paramS['settings']['firstOrder']['binWidthEntropy'], (int, float)):
         firstOrderEntropyBinWidth = paramS['settings']['firstOrder']['binWidthEntropy']
@@ -62,6 +108,10 @@ def calcRadiomicsForImgType(volToEval, maskBoundingBox3M, morphMask3M, gridS, pa
         if 'binNum' in paramS['settings']['texture'] \
             and isinstance(paramS['settings']['texture']['binNum'], (int, float)):
             textureBinNum = paramS['settings']['texture']['binNum']
+        # Optional sparse co-occurrence matrices for fine discretisation (see gray_level_cooccurence.calcCooccur)
+        if 'sparseCooccur' in paramS['settings']['texture'] and \
+                paramS['settings']['texture']['sparseCooccur'].lower() == "yes":
+            sparseCooccurFlag = True
         if (textureBinNum is not None) and (textureBinWidth is not None):
             raise Exception("Please specify either the number of bins or bin-width for quantization")
         if any(name in ['glcm','glrlm','glszm'] for name in paramS['featureClass'].keys()):
@@ -92,15 +142,17 @@ def calcRadiomicsForImgType(volToEval, maskBoundingBox3M, morphMask3M, gridS, pa
             maxClipIntensity = paramS['settings']['texture']['maxClipIntensity']
 
     # Shape  features
-    if 'shape' in paramS['featureClass'] and paramS['featureClass']['shape']["featureList"] != {}:
-        from cerr.radiomics.shape import compute_shape_features
-        featDict['shape'] = compute_shape_features(morphMask3M,gridS['xValsV'],gridS['yValsV'],gridS['zValsV'])
+    if isFeatureClassRequested(paramS, 'shape'):
+        from cerr.radiomics.shape import compute_shape_features, shapeFeatureNames
+        featDict['shape'] = compute_shape_features(morphMask3M,gridS['xValsV'],gridS['yValsV'],gridS['zValsV'],
+                                                   getRequestedFeatures(paramS, 'shape', shapeFeatureNames))
 
     # Assign nan values outside the mask, so that min/max within the mask are used for quantization
     volToEval[~maskBoundingBox3M] = np.nan
 
     # Texture-based scalar features
-    if 'texture' in paramS['settings']:
+    if 'texture' in paramS['settings'] and \
+            any(isFeatureClassRequested(paramS, featClass) for featClass in textureFeatureClasses):
         # Quantization
         quantized3M = preprocess.imquantize_cerr(volToEval, num_level=textureBinNum,\
                                                  xmin=minClipIntensity, xmax=maxClipIntensity, binwidth=textureBinWidth)
@@ -109,50 +161,115 @@ def calcRadiomicsForImgType(volToEval, maskBoundingBox3M, morphMask3M, gridS, pa
         if any(name in ['glcm','glrlm','glszm'] for name in paramS['featureClass'].keys()):
             offsetsM = getDirectionOffsets(direction)
             offsetsM = offsetsM * glcmVoxelOffset
+
+        # Cropped volume, ROI mask, level groups, line orderings and neighbour counts
+        # shared by the texture feature families
+        texContext = TextureContext(quantized3M, nL)
     else:
         quantized3M = volToEval
 
      # First order features
-    if 'firstOrder' in paramS['featureClass'] and paramS['featureClass']['firstOrder']["featureList"] != {}:
+    if isFeatureClassRequested(paramS, 'firstOrder'):
         voxelVol = np.prod(gridS["PixelSpacingV"]) * 1000 # units of mm
         scanV = volToEval[maskBoundingBox3M]
         featDict['firstOrder'] = first_order.radiomics_first_order_stats(scanV, voxelVol,
                                         firstOrderOffsetEnergy, firstOrderEntropyBinWidth, firstOrderEntropyBinNum)
 
     # GLCM
-    if 'glcm' in paramS['featureClass'] and paramS['featureClass']['glcm']["featureList"] != {}:
-        glcmM = gray_level_cooccurence.calcCooccur(quantized3M, offsetsM, nL, cooccurType)
+    if isFeatureClassRequested(paramS, 'glcm'):
+        glcmM = gray_level_cooccurence.calcCooccur(quantized3M, offsetsM, nL, cooccurType,
+                                                    sparseFlag=sparseCooccurFlag, textureContext=texContext)
         featDict['glcm'] = gray_level_cooccurence.cooccurToScalarFeatures(glcmM)
 
     # RLM
-    if 'glrlm' in paramS['featureClass'] and paramS['featureClass']['glrlm']["featureList"] != {}:
-        rlmM = run_length.calcRLM(quantized3M,offsetsM,nL,rlmType)
+    if isFeatureClassRequested(paramS, 'glrlm'):
+        rlmM = run_length.calcRLM(quantized3M,offsetsM,nL,rlmType,textureContext=texContext)
         numVoxels = np.sum(maskBoundingBox3M.astype(int))
         if rlmType == 1: # merged RLMs for offsets
             numVoxels *= offsetsM.shape[0]
         featDict['glrlm'] = run_length.rlmToScalarFeatures(rlmM, numVoxels)
 
     # SZM
-    if 'glszm' in paramS['featureClass'] and paramS['featureClass']['glszm']["featureList"] != {}:
-        szmM = size_zone.calcSZM(quantized3M,nL,szmDir)
+    if isFeatureClassRequested(paramS, 'glszm'):
+        szmM = size_zone.calcSZM(quantized3M,nL,szmDir,textureContext=texContext)
         numVoxels = np.sum(maskBoundingBox3M.astype(int))
         featDict['glszm'] = size_zone.szmToScalarFeatures(szmM, numVoxels)
 
     # NGLDM
-    if 'gldm' in paramS['featureClass'] and paramS['featureClass']['gldm']["featureList"] != {}:
-        s = neighbor_gray_level_dependence.calcNGLDM(quantized3M, patch_radius, nL, difference_threshold)
+    if isFeatureClassRequested(paramS, 'gldm'):
+        numVoxels = np.sum(maskBoundingBox3M.astype(int))
+        s = neighbor_gray_level_dependence.calcNGLDM(quantized3M, patch_radius, nL, difference_threshold,
+                                                     textureContext=texContext)
         featDict['gldm'] = neighbor_gray_level_dependence.ngldmToScalarFeatures(s, numVoxels)
 
     # NGTDM
-    if 'gtdm' in paramS['featureClass'] and paramS['featureClass']['gtdm']["featureList"] != {}:
-        s,p,Nvc = neighbor_gray_tone.calcNGTDM(quantized3M, patch_radius, nL)
+    if isFeatureClassRequested(paramS, 'gtdm'):
+        s,p,Nvc = neighbor_gray_tone.calcNGTDM(quantized3M, patch_radius, nL, textureContext=texContext)
         featDict['gtdm'] = neighbor_gray_tone.ngtdmToScalarFeatures(s,p,Nvc)
 
+    # Keep requested features
+    for featClass in featDict:
+        if featClass != 'shape':
+            featList = getRequestedFeatures(paramS, featClass, list(featDict[featClass].keys()))
+            featDict[featClass] = selectRequestedFeatures(featDict[featClass], featList, featClass)
+
     return featDict
 
 
 
-def computeScalarFeatures(scanNum, structNum, settingsFile, planC):
+# Environment variables limiting threads used by numpy/scipy backends in worker processes
+threadLimitEnvVars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                      'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# Scan, masks and settings shared by image types, set once per worker process by initFeatureWorker
+workerJobArgs = ()
+
+def initFeatureWorker(jobArgs):
+    global workerJobArgs
+    workerJobArgs = jobArgs
+
+def calcFlatFeaturesInWorker(imgType, filterParamS):
+    return calcFlatFeaturesForImgType(imgType, filterParamS, *workerJobArgs)
+
+def calcFlatFeaturesForImgType(imgType, filterParamS, processedScan3M, processedMask3M, morphMask3M,
+                               gridS, radiomicsSettingS, avgType, directionality, mapToIBSI):
+    """
+    Returns a flat dictionary of features for image type imgType (with filter parameters
+    filterParamS) computed from the pre-processed scan and mask.
+    """
+    minr,maxr,minc,maxc,mins,maxs,__ = compute_boundingbox(processedMask3M)
+    maskBoundingBox3M = processedMask3M[minr:maxr+1, minc:maxc+1, mins:maxs+1]
+    if imgType.lower() == "original":
+        imgFeatName = 'original'
+        # Calc. radiomic features
+        croppedScan3M = processedScan3M[minr:maxr+1, minc:maxc+1, mins:maxs+1].copy()
+        featDict = calcRadiomicsForImgType(croppedScan3M, maskBoundingBox3M, morphMask3M, gridS, radiomicsSettingS)
+    else:
+        # Filter response over mask bounding box
+        responseS = textureUtils.processImage(imgType, processedScan3M, processedMask3M, filterParamS,
+                                              fullMapFlag=False)
+        filterName = list(responseS.keys())[0] # must be single output
+        filteredScan3M = responseS[filterName]
+        filteredScan3M[~maskBoundingBox3M] = np.nan
+        # Calc. radiomic features
+        featDict = calcRadiomicsForImgType(filteredScan3M, maskBoundingBox3M, morphMask3M, gridS, radiomicsSettingS)
+        imgFeatName = createFieldNameFromParameters(imgType, filterParamS)
+
+    return createFlatFeatureDict(featDict, imgFeatName, avgType, directionality, mapToIBSI)
+
+
+def computeScalarFeatures(scanNum, structNum, settingsFile, planC, numWorkers=1):
+    """
+    Returns a flat dictionary of radiomic features for all image types in settingsFile, along
+    with diagnostic features.
+
+    numWorkers > 1 computes image types in parallel in a pool of worker processes (spawned, so calling
+    scripts need an if __name__ == '__main__' guard). Threads used by numpy/scipy backends in each
+    worker are limited to os.cpu_count() // numWorkers. Features are returned in the same order as
+    with numWorkers = 1. The pre-processed scan and masks are copied once to each worker, and each
+    worker imports cerr, so numWorkers > 1 pays off for settings with several filtered image types
+    and not for a single image type.
+    """
 
     with open(settingsFile, ) as settingsFid:
         radiomicsSettingS = json.load(settingsFid)
@@ -160,7 +277,6 @@ def computeScalarFeatures(scanNum, structNum, settingsFile, planC):
     # Pre-process Image
     (processedScan3M, processedMask3M, morphMask3M, gridS, radiomicsSettingS, diagS) = \
        preprocess.preProcessForRadiomics(scanNum, structNum, radiomicsSettingS, planC)
-    minr,maxr,minc,maxc,mins,maxs,__ = compute_boundingbox(processedMask3M)
     voxSizeV = gridS["PixelSpacingV"]
 
     ############################################
@@ -190,16 +306,11 @@ def computeScalarFeatures(scanNum, structNum, settingsFile, planC):
             'directionality' in radiomicsSettingS['settings']['texture']:
         directionality = radiomicsSettingS['settings']['texture']['directionality']
 
-    # Loop over image filters
-    featDictAllTypes = diagS
+    # List image types & filter parameters
+    imgTypeParamList = []
     for imgType in imgTypes:
         if imgType.lower() == "original":
-            imgFeatName = 'original'
-            # Calc. radiomic features
-            maskBoundingBox3M = processedMask3M[minr:maxr+1, minc:maxc+1, mins:maxs+1]
-            croppedScan3M = processedScan3M[minr:maxr+1, minc:maxc+1, mins:maxs+1]
-            featDict = calcRadiomicsForImgType(croppedScan3M, maskBoundingBox3M, morphMask3M, gridS, radiomicsSettingS)
-            featDictAllTypes = {**featDictAllTypes, **createFlatFeatureDict(featDict, imgFeatName, avgType, directionality, mapToIBSI)}
+            imgTypeParamList.append((imgType, None))
         else:
             # Extract filter & padding parameters
             filterTypeParamS = radiomicsSettingS['imageType'][imgType]
@@ -209,7 +320,6 @@ def computeScalarFeatures(scanNum, structNum, settingsFile, planC):
                 padSizeV = radiomicsSettingS["settings"]["padding"]["size"]
                 padMethod = radiomicsSettingS["settings"]["padding"]["method"]
 
-            # Apply image filters
             if not isinstance(filterTypeParamS,list):
                 filterTypeParamS = [filterTypeParamS]
 
@@ -217,21 +327,40 @@ def computeScalarFeatures(scanNum, structNum, settingsFile, planC):
                 filterParamS = filterTypeParamS[nFilt]
                 filterParamS["VoxelSize_mm"]  = voxSizeV * 10
                 filterParamS["Padding"] = {"Size":padSizeV,"Method": padMethod,"Flag":False}
+                imgTypeParamList.append((imgType, filterParamS))
+
+    # Apply image filters & calc. radiomic features
+    jobArgs = (processedScan3M, processedMask3M, morphMask3M, gridS, radiomicsSettingS,
+               avgType, directionality, mapToIBSI)
+    numWorkers = min(numWorkers, len(imgTypeParamList))
+    if numWorkers > 1:
+        # Limit threads per worker to avoid oversubscription. Variables are read when
+        # numpy is imported in the spawned workers.
+        numThreads = str(max(1, (os.cpu_count() or 1) // numWorkers))
+        origEnvS = {var: os.environ.get(var) for var in threadLimitEnvVars}
+        os.environ.update({var: numThreads for var in threadLimitEnvVars})
+        try:
+            # Pass the scan and masks once per worker rather than with each image type
+            with ProcessPoolExecutor(max_workers=numWorkers,
+                                     mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=initFeatureWorker, initargs=(jobArgs,)) as executor:
+                futureList = [executor.submit(calcFlatFeaturesInWorker, imgType, filterParamS)
+                              for imgType, filterParamS in imgTypeParamList]
+                flatDictList = [future.result() for future in futureList]
+        finally:
+            for var, val in origEnvS.items():
+                if val is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = val
+    else:
+        flatDictList = [calcFlatFeaturesForImgType(imgType, filterParamS, *jobArgs)
+                        for imgType, filterParamS in imgTypeParamList]
 
-                paddedResponseS = textureUtils.processImage(imgType, processedScan3M, processedMask3M, filterParamS)
-                filterName = list(paddedResponseS.keys())[0] # must be single output
-                filteredPadScan3M = paddedResponseS[filterName]
-
-                # Remove padding
-                maskBoundingBox3M = processedMask3M[minr:maxr+1, minc:maxc+1, mins:maxs+1]
-                filteredScan3M = filteredPadScan3M[minr:maxr+1, minc:maxc+1, mins:maxs+1]
-                filteredScan3M[~maskBoundingBox3M] = np.nan
-                # Calc. radiomic features
-                featDict = calcRadiomicsForImgType(filteredScan3M, maskBoundingBox3M, morphMask3M, gridS, radiomicsSettingS)
-
-                # Aggregate features
-                imgFeatName = createFieldNameFromParameters(imgType, filterParamS)
-                featDictAllTypes = {**featDictAllTypes, **createFlatFeatureDict(featDict, imgFeatName, avgType, directionality, mapToIBSI)}
+    # Aggregate features
+    featDictAllTypes = diagS
+    for flatDict in flatDictList:
+        featDictAllTypes = {**featDictAllTypes, **flatDict}
 
     return featDictAllTypes, diagS
 
@@ -1,85 +1,74 @@
 import numpy as np
+from cerr.radiomics.texture_context import TextureContext
+
+# Maximum number of voxels in the stack of level indicator images processed at a time
+maxChunkVoxels = 2**25
+
+def getBoxSum(ind4M, patch_size):
+    """
+    Returns the sum of each (numImages, rows, cols, slices) indicator image over a
+    (2*patch_size+1) box around each voxel, treating voxels outside the image as 0.
+    The box kernel is applied separably as shifted sums along each axis.
+    """
+    maxSum = np.prod(2 * np.asarray(patch_size, dtype=int) + 1)
+    sum4M = ind4M.astype(np.uint8 if maxSum < 2**8 else np.uint16)
+    for axis, radius in zip((1, 2, 3), patch_size):
+        radius = int(radius)
+        if radius == 0:
+            continue
+        padWidth = [(0, 0)] * 4
+        padWidth[axis] = (radius, radius)
+        pad4M = np.pad(sum4M, padWidth, mode='constant', constant_values=0)
+        numVox = sum4M.shape[axis]
+        slc = [slice(None)] * 4
+        for shift in range(2 * radius + 1):
+            slc[axis] = slice(shift, shift + numVox)
+            if shift == 0:
+                sum4M = pad4M[tuple(slc)].copy()
+            else:
+                sum4M += pad4M[tuple(slc)]
+    return sum4M
+
+
+def calcNGLDM(scan_array, patch_size, num_grayscale_levels, a, textureContext=None):
+    """
+    Returns the (num_grayscale_levels, max_nbhood_size+1) NGLDM, where element (i, k) is the
+    number of voxels of level i+1 having k neighbours within a (2*patch_size+1) box whose
+    levels differ by at most a. Voxels with level 0 (outside the ROI) are ignored.
+    Dependence counts are obtained by convolving indicator images of the levels present
+    in the ROI with the neighbourhood box, a bounded chunk of levels at a time.
+    """
 
-def calcNGLDM(scan_array, patch_size, num_grayscale_levels, a):
-
-    # Get indices of non-NaN voxels
-    calc_ind = scan_array > 0
-
-    # Grid resolution
-    slc_window = 2 * patch_size[2] + 1
-    row_window = 2 * patch_size[0] + 1
-    col_window = 2 * patch_size[1] + 1
-
-    # Build distance matrices
-    num_cols_pad = col_window // 2
-    num_rows_pad = row_window // 2
-    num_slcs_pad = slc_window // 2
-
-    # Get number of voxels per slice
-    num_rows, num_cols, num_slices = scan_array.shape
-    num_voxels = num_rows * num_cols
-
-    # Pad q for sliding window
-    q = np.pad(scan_array, ((num_rows_pad, num_rows_pad), (num_cols_pad, num_cols_pad), (num_slcs_pad, num_slcs_pad)),
-               mode='constant', constant_values=(0,))
-
-    calc_ind = np.pad(calc_ind, ((0, 0), (0, 0), (num_slcs_pad, num_slcs_pad)), mode='constant', constant_values=0)
-
-     # Index calculation adapted from
-     # http://stackoverflow.com/questions/25449279/efficient-implementation-of-im2col-and-col2im
-    (m,n,_) = q.shape
-    start_ind = np.arange(1,m-row_window+2)[None,:] + (np.arange(0,n-col_window+1)*m)[:,None]
-    start_ind = start_ind.T.ravel(order="F")[:,None]
-
-    # Row indices
-    lin_row = start_ind + np.arange(0,row_window).T
-    lin_row = np.moveaxis(lin_row[:,:,None],[0,1,2],[2,0,1])
-
-    # Get linear indices based on row and col indices and get desired output
-    indM = lin_row + np.arange(0,col_window)[None,:,None]*m
-    indM = np.reshape(indM,(row_window*col_window,indM.shape[2]),order="F") - 1
-    # Initialize the s (NGLDM) matrix
     max_nbhood_size = (2 * patch_size[0] + 1) * (2 * patch_size[1] + 1) * (2 * patch_size[2] + 1) - 1
-
-    s = np.zeros((num_grayscale_levels, max_nbhood_size+1), dtype=np.uint32)
-    #p = np.zeros((num_grayscale_levels, 1), dtype=np.uint32)
-
-    for slc_num in range(num_slcs_pad, num_slices + num_slcs_pad):
-        calc_slc_ind = calc_ind[:, :, slc_num].ravel(order="F")
-        num_calc_voxels = np.sum(calc_slc_ind)
-        indSlcM = indM[:,calc_slc_ind]
-        #ind_slc = np.where(calc_slc_ind)[0]
-        slc_v = np.arange(slc_num - patch_size[2], slc_num + patch_size[2] + 1)
-        nbhood_size = indSlcM.shape[0]
-
-        slcNeighborSiz = slc_v.size * nbhood_size
-
-        q_m = np.zeros((slcNeighborSiz, num_calc_voxels), dtype=np.float32)
-        m_m = np.zeros((slcNeighborSiz, num_calc_voxels), dtype=np.float32)
-
-        count = 0
-        for i_slc in slc_v:
-            q_slc = q[:, :, i_slc]
-            mask_slc_m = np.pad(calc_ind[:, :, i_slc], ((num_rows_pad, num_rows_pad), (num_cols_pad, num_cols_pad)),
-                               mode='constant', constant_values=0)
-            q_m[count * nbhood_size:(count + 1) * nbhood_size, :] = q_slc.ravel(order="F")[indSlcM]
-            m_m[count * nbhood_size:(count + 1) * nbhood_size, :] = mask_slc_m.ravel(order="F")[indSlcM]
-            count += 1
-
-        current_voxel_index = nbhood_size * slc_v.size // 2
-        vox_val_v = q_m[current_voxel_index, :].copy()
-        vox_mask_v = m_m[current_voxel_index, :].copy()
-        q_m = np.delete(q_m, current_voxel_index, axis=0)
-        m_m = np.delete(m_m, current_voxel_index, axis=0)
-        #q_m[np.isnan(q_m)] = 0
-        q_m = np.abs(q_m - vox_val_v) <= a
-        q_m[m_m==0] = 0
-        q_m = np.sum(q_m, axis=0)
-
-        for lev in range(1, num_grayscale_levels + 1):
-            ind_lev_v = (vox_val_v == lev) & vox_mask_v.astype(bool)
-            vals_v = q_m[ind_lev_v]
-            s[lev - 1, :] += np.bincount(vals_v + 1, minlength=slcNeighborSiz + 1)[1:].astype(s.dtype)
+    numCols = max_nbhood_size + 1
+    s = np.zeros((num_grayscale_levels, numCols), dtype=np.uint32)
+
+    if textureContext is None:
+        textureContext = TextureContext(scan_array, num_grayscale_levels)
+    lev3M = textureContext.quantized3M
+
+    # ROI voxels grouped by level
+    roiIndV, levV, levelsV, levStartV, levStopV = textureContext.getLevelGroups()
+    if len(levV) == 0:
+        return s
+
+    depV = np.zeros(len(levV), dtype=np.int64)
+    chunkSize = max(1, maxChunkVoxels // lev3M.size)
+    for start in range(0, len(levelsV), chunkSize):
+        chunkLevelsV = levelsV[start:start + chunkSize]
+        # Indicator images of ROI voxels (level >= 1) with levels within a of each level in the chunk
+        lowV = np.maximum(chunkLevelsV - a, 1)[:, None, None, None]
+        highV = (chunkLevelsV + a)[:, None, None, None]
+        ind4M = (lev3M[None, :, :, :] >= lowV) & (lev3M[None, :, :, :] <= highV)
+        count4M = getBoxSum(ind4M, patch_size)
+        for iLev in range(len(chunkLevelsV)):
+            levSlc = slice(levStartV[start + iLev], levStopV[start + iLev])
+            depV[levSlc] = count4M[iLev].ravel()[roiIndV[levSlc]]
+
+    # Exclude the voxel itself
+    depV -= int(a >= 0)
+    s += np.bincount((levV - 1) * numCols + depV,
+                     minlength=num_grayscale_levels * numCols).reshape(s.shape).astype(s.dtype)
 
     return s
 
@@ -1,77 +1,42 @@
 import numpy as np
-
-def calcRLM(quantizedM, offsetsM, nL, rlmType=1):
-    if rlmType != 1:
-        rlmOut = []
-
-    pad_width = [(1, 1)] * quantizedM.ndim
-    quantizedM = np.pad(quantizedM, pad_width, mode='constant', constant_values=0)
-
-    numRowsPad, numColsPad, numSlcsPad = 1, 1, 1
-    q = np.pad(quantizedM, ((numRowsPad, numRowsPad), (numColsPad, numColsPad), (numSlcsPad, numSlcsPad)),
-               mode='constant', constant_values=0)
-    q[np.isnan(q)] = 0
-    q = q.astype(np.uint16)
+from cerr.radiomics.texture_context import TextureContext
+
+
+def calcRLM(quantizedM, offsetsM, nL, rlmType=1, textureContext=None):
+    """
+    Returns the (nL, maxRunLen) run length matrix combined across offsets when rlmType=1,
+    or a list of matrices per offset when rlmType=2. Voxels with level 0 (outside the ROI)
+    are ignored.
+    For each offset, the volume is traversed as a set of 1D lines along that offset and
+    runs of all levels are found at once from change points between successive voxels.
+    Line orderings are reused from textureContext when it is passed.
+    """
+    if textureContext is None:
+        textureContext = TextureContext(quantizedM, nL)
+    qV = textureContext.quantized3M.ravel()
 
     numOffsets = offsetsM.shape[0]
-    maxRunLen = int(np.ceil(np.max(quantizedM.shape)*2))
-    #maxRunLen = 1000
-    #print('Max Run Length = ' + str(maxRunLen))
-
-    rlmM = np.zeros((nL, maxRunLen))
-    if rlmType == 2:
-        rlmOut = [np.zeros((nL, maxRunLen)) for i in range(numOffsets)]
-
-    siz = np.array(q.shape)
-    rowV = np.arange(siz[0],dtype = np.uint16)[:,None]
-    colV = np.arange(siz[1],dtype = np.uint16)[None,:]
-
-    rowIndM = np.repeat(rowV,siz[1], axis = 1)[:,:,None]
-    colIndM = np.repeat(colV,siz[0], axis = 0)[:,:,None]
-    rowIndM = np.repeat(rowIndM, siz[2], axis = 2)
-    colIndM = np.repeat(colIndM, siz[2], axis = 2)
-    slcIndM = np.zeros(siz,dtype = np.uint16)
-    for slc in range(siz[2]):
-        slcIndM[:,:,slc] = slc
-
+    maxRunLen = int(np.ceil((np.max(textureContext.origShape) + 2) * 2))
 
+    rlmOut = []
     for off in range(numOffsets):
-        if rlmType == 2:
-            rlmM = rlmOut[off]
+        orderedIndV, lineStartV = textureContext.getLineOrder(offsetsM[off])
+        levV = qV[orderedIndV]
 
-        offset = offsetsM[off]
-        rolled_q = np.roll(q, offset, axis=(0, 1, 2))
-        for level in range(1, nL + 1):
-            #t = time.time()
-            prevM = (q == level).astype(int)
-            # diffM = prevM - np.roll(prevM, offset, axis=(0, 1, 2))
-            diffM = prevM - (rolled_q == level).astype(int)
-            startM = diffM == 1
-            #startIndV = np.where(startM)
-            #convergedV = np.full(len(startIndV[0]),False,dtype=bool)
-            rowStartV = rowIndM[startM]
-            colStartV = colIndM[startM]
-            slcStartV = slcIndM[startM]
-            startIndV = (rowStartV, colStartV, slcStartV)
-            stopM = diffM == -1
-            convergedV = np.full(len(rowStartV),False,dtype=bool)
-            count = 0
-            while not np.all(convergedV):
-                count += 1
-                nextIndV = startIndV + count * offset[:,None]
-                nextIndV[nextIndV < 0] = 0
-                nextIndV[nextIndV >= siz[:,None]] = 0 # assign 0 as it will have value of 0
-                newConvergedV = stopM[nextIndV[0,:],nextIndV[1,:],nextIndV[2,:]]
-                numConverged = (~convergedV[newConvergedV]).sum()
-                convergedV[newConvergedV] = True
-                rlmM[level - 1, count-1] += numConverged
+        # Runs start at the first voxel of a line or where the level changes
+        runStartV = lineStartV.copy()
+        runStartV[1:] |= np.diff(levV) != 0
+        runStartIndV = np.flatnonzero(runStartV)
+        runLenV = np.diff(np.append(runStartIndV, len(levV)))
+        runLevV = levV[runStartIndV].astype(np.int64)
 
-        if rlmType == 2:
-            #rlmOut.append(rlmM)
-            rlmOut[off] = rlmM
+        validV = (runLevV > 0) & (runLevV <= nL)
+        countV = np.bincount((runLevV[validV] - 1) * maxRunLen + runLenV[validV] - 1,
+                             minlength=nL * maxRunLen)
+        rlmOut.append(countV.reshape(nL, maxRunLen).astype(float))
 
     if rlmType == 1:
-        rlmOut = rlmM
+        rlmOut = np.sum(rlmOut, axis=0) if numOffsets > 0 else np.zeros((nL, maxRunLen))
 
     return rlmOut
 
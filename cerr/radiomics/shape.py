@@ -1,6 +1,6 @@
 import numpy as np
 from cerr.utils.mask import getSurfacePoints
-from scipy.spatial import distance
+from scipy.spatial import distance, ConvexHull, QhullError
 from skimage import measure
 from cerr.utils import bbox
 
@@ -27,7 +27,68 @@ def eig(a):
 def sepsq(a, b):
     return np.sum((a - b)**2, axis=0)
 
-def compute_shape_features(mask3M, xValsV, yValsV, zValsV):
+# Smaller point sets are searched directly, without a convex hull
+minPointsForHull = 64
+
+def getMaxPairwiseDistance(ptsM, maxChunkSize=2**22):
+    """
+    Returns the maximum Euclidean distance between rows of ptsM. The farthest pair of points
+    lies on the convex hull, so distances are computed between hull vertices only, in chunks
+    of at most maxChunkSize pairs.
+    """
+    ptsM = np.unique(ptsM, axis=0)
+    if ptsM.shape[0] < 2:
+        return 0
+    if ptsM.shape[0] > minPointsForHull:
+        try:
+            ptsM = ptsM[ConvexHull(ptsM).vertices]
+        except QhullError:
+            # Degenerate (e.g. coplanar/collinear) points, use all points
+            pass
+    numPts = ptsM.shape[0]
+    chunkSiz = max(1, maxChunkSize // numPts)
+    maxDistSq = 0
+    for start in range(0, numPts, chunkSiz):
+        distSqM = distance.cdist(ptsM[start:start+chunkSiz], ptsM, 'sqeuclidean')
+        maxDistSq = max(maxDistSq, np.max(distSqM))
+    return np.sqrt(maxDistSq)
+
+def getMaxPlanarDiameter(ptsM, planeV):
+    """
+    Returns the maximum over planes of the maximum distance between points of ptsM
+    lying in the same plane. planeV holds the plane index of each point.
+    """
+    orderV = np.argsort(planeV, kind='stable')
+    __, startV = np.unique(planeV[orderV], return_index=True)
+    dmax = 0
+    for indV in np.split(orderV, startV[1:]):
+        dmax = max(dmax, getMaxPairwiseDistance(ptsM[indV]))
+    return dmax
+
+shapeFeatureNames = ['majorAxis', 'minorAxis', 'leastAxis', 'flatness', 'elongation',
+                     'max2dDiameterAxialPlane', 'max2dDiameterSagittalPlane', 'max2dDiameterCoronalPlane',
+                     'surfArea', 'max3dDiameter', 'volume', 'filledVolume', 'volumeDensityAABB',
+                     'Compactness1', 'Compactness2', 'spherDisprop', 'sphericity', 'surfToVolRatio']
+pcaFeatureNames = ['majorAxis', 'minorAxis', 'leastAxis', 'flatness', 'elongation']
+diameter2dFeatureNames = ['max2dDiameterAxialPlane', 'max2dDiameterSagittalPlane', 'max2dDiameterCoronalPlane']
+meshFeatureNames = ['surfArea', 'max3dDiameter', 'Compactness1', 'Compactness2',
+                    'spherDisprop', 'sphericity', 'surfToVolRatio']
+
+def compute_shape_features(mask3M, xValsV, yValsV, zValsV, featureList=None):
+    """
+    Returns a dictionary of shape features of mask3M. featureList optionally restricts the
+    output to a subset of shapeFeatureNames, in which case the PCA, 2D diameter and
+    marching-cubes mesh computations are skipped unless a requested feature needs them.
+    """
+
+    if featureList is None:
+        featureList = shapeFeatureNames
+    invalidFeatures = set(featureList) - set(shapeFeatureNames)
+    if invalidFeatures:
+        raise ValueError('Invalid shape features: ' + ', '.join(sorted(invalidFeatures)))
+    calcPCA = any(feat in featureList for feat in pcaFeatureNames)
+    calc2dDiameter = any(feat in featureList for feat in diameter2dFeatureNames)
+    calcMesh = any(feat in featureList for feat in meshFeatureNames)
 
     # Convert grid from cm to mm
     xValsV = xValsV * 10
@@ -51,103 +112,74 @@ def compute_shape_features(mask3M, xValsV, yValsV, zValsV):
     # Axis Aligned bounding Box (AABB) volume
     volumeAABB = (rmax-rmin+1) * (cmax-cmin+1) * (smax-smin+1) * voxel_volume
 
-    # Get x/y/z coordinates of all the voxels
-    indM = np.argwhere(maskForShape3M)
-
-    xV = xValsV[indM[:, 1]]
-    yV = yValsV[indM[:, 0]]
-    zV = zValsV[indM[:, 2]]
-    xyzM = np.column_stack((xV, yV, zV))
-    meanV = np.mean(xyzM, axis=0)
-    xyzM = (xyzM - meanV) / np.sqrt(xyzM.shape[0])
-    eig_valV = eig(np.dot(xyzM.T, xyzM))
     shapeS = {}
-    shapeS['majorAxis'] = 4 * np.sqrt(eig_valV[2])
-    shapeS['minorAxis'] = 4 * np.sqrt(eig_valV[1])
-    shapeS['leastAxis'] = 4 * np.sqrt(eig_valV[0])
-    shapeS['flatness'] = np.sqrt(eig_valV[0] / eig_valV[2])
-    shapeS['elongation'] = np.sqrt(eig_valV[1] / eig_valV[2])
-
-    # Get the surface points for the structure mask
-    surf_points = getSurfacePoints(maskForShape3M)
-    sample_rate = 1
-    dx = abs(np.median(np.diff(xValsV)))
-    dz = abs(np.median(np.diff(zValsV)))
-    while surf_points.shape[0] > 50000:
-        sample_rate += 1
-        if dz / dx < 2:
-            surf_points = getSurfacePoints(maskForShape3M, sample_rate, sample_rate)
-        else:
-            surf_points = getSurfacePoints(maskForShape3M, sample_rate, 1)
-
-    xSurfV = xValsV[surf_points[:, 1]]
-    ySurfV = yValsV[surf_points[:, 0]]
-    zSurfV = zValsV[surf_points[:, 2]]
-    #distM = sepsq(np.column_stack((xSurfV, ySurfV, zSurfV)), np.column_stack((xSurfV, ySurfV, zSurfV)))
-    ptsM = np.column_stack((xSurfV, ySurfV, zSurfV))
-    distM = distance.cdist(ptsM, ptsM, 'euclidean')
-    #shapeS['max3dDiameter'] = np.max(distM)
-
-    rowV = np.unique(surf_points[:, 0])
-    colV = np.unique(surf_points[:, 1])
-    slcV = np.unique(surf_points[:, 2])
-
-    # Max diameter along slices
-    dmax = 0
-    for i in range(len(slcV)):
-        slc = slcV[i]
-        indV = surf_points[:, 2] == slc
-        distSlcM = distM[indV][:, indV]
-        dmax = max(dmax, np.max(distSlcM))
-    shapeS['max2dDiameterAxialPlane'] = dmax
-
-    # Max diameter along cols
-    dmax = 0
-    for i in range(len(colV)):
-        col = colV[i]
-        indV = surf_points[:, 1] == col
-        distColM = distM[indV][:, indV]
-        dmax = max(dmax, np.max(distColM))
-    shapeS['max2dDiameterSagittalPlane'] = dmax
-
-    # Max diameter along rows
-    dmax = 0
-    for i in range(len(rowV)):
-        row = rowV[i]
-        indV = surf_points[:, 0] == row
-        distRowM = distM[indV][:, indV]
-        dmax = max(dmax, np.max(distRowM))
-    shapeS['max2dDiameterCoronalPlane'] = dmax
-
-    # Surface Area
-    # Pad mask to account for contribution from edge slices
-    maskForShape3M = np.pad(maskForShape3M, ((1,1),(1,1),(1,1)),
-                            mode='constant', constant_values=((0, 0),))
-    verts, faces, normals, values = measure.marching_cubes(maskForShape3M, level=0.5, spacing=voxel_siz)
-    shapeS['surfArea'] = trimeshSurfaceArea(verts,faces)
-
-    distSurfM = distance.cdist(verts, verts, 'euclidean')
-    shapeS['max3dDiameter'] = np.max(distSurfM)
+    if calcPCA:
+        # Get x/y/z coordinates of all the voxels
+        indM = np.argwhere(maskForShape3M)
+
+        xV = xValsV[indM[:, 1]]
+        yV = yValsV[indM[:, 0]]
+        zV = zValsV[indM[:, 2]]
+        xyzM = np.column_stack((xV, yV, zV))
+        meanV = np.mean(xyzM, axis=0)
+        xyzM = (xyzM - meanV) / np.sqrt(xyzM.shape[0])
+        eig_valV = eig(np.dot(xyzM.T, xyzM))
+        shapeS['majorAxis'] = 4 * np.sqrt(eig_valV[2])
+        shapeS['minorAxis'] = 4 * np.sqrt(eig_valV[1])
+        shapeS['leastAxis'] = 4 * np.sqrt(eig_valV[0])
+        shapeS['flatness'] = np.sqrt(eig_valV[0] / eig_valV[2])
+        shapeS['elongation'] = np.sqrt(eig_valV[1] / eig_valV[2])
+
+    if calc2dDiameter:
+        # Get the surface points for the structure mask
+        surf_points = getSurfacePoints(maskForShape3M)
+        xSurfV = xValsV[surf_points[:, 1]]
+        ySurfV = yValsV[surf_points[:, 0]]
+        zSurfV = zValsV[surf_points[:, 2]]
+
+        # Max diameter along slices
+        shapeS['max2dDiameterAxialPlane'] = getMaxPlanarDiameter(np.column_stack((xSurfV, ySurfV)),
+                                                                 surf_points[:, 2])
+        # Max diameter along cols
+        shapeS['max2dDiameterSagittalPlane'] = getMaxPlanarDiameter(np.column_stack((ySurfV, zSurfV)),
+                                                                    surf_points[:, 1])
+        # Max diameter along rows
+        shapeS['max2dDiameterCoronalPlane'] = getMaxPlanarDiameter(np.column_stack((xSurfV, zSurfV)),
+                                                                   surf_points[:, 0])
+
+    if calcMesh:
+        # Surface Area
+        # Pad mask to account for contribution from edge slices
+        maskForShape3M = np.pad(maskForShape3M, ((1,1),(1,1),(1,1)),
+                                mode='constant', constant_values=((0, 0),))
+        verts, faces, normals, values = measure.marching_cubes(maskForShape3M, level=0.5, spacing=voxel_siz)
+        shapeS['surfArea'] = trimeshSurfaceArea(verts,faces)
+
+        shapeS['max3dDiameter'] = getMaxPairwiseDistance(verts)
 
     shapeS['volume'] = volume
     shapeS['filledVolume'] = filled_volume
 
     shapeS['volumeDensityAABB'] = volume / volumeAABB
 
-    # Compactness 1 (V/(pi*A^(3/2))
-    shapeS['Compactness1'] = shapeS['volume'] / (np.pi**0.5 * shapeS['surfArea']**1.5)
+    if calcMesh:
+        # Compactness 1 (V/(pi*A^(3/2))
+        shapeS['Compactness1'] = shapeS['volume'] / (np.pi**0.5 * shapeS['surfArea']**1.5)
+
+        # Compactness 2 (36*pi*V^2/A^3)
+        shapeS['Compactness2'] = 36 * np.pi * shapeS['volume']**2 / shapeS['surfArea']**3
 
-    # Compactness 2 (36*pi*V^2/A^3)
-    shapeS['Compactness2'] = 36 * np.pi * shapeS['volume']**2 / shapeS['surfArea']**3
+        # Spherical disproportion (A/(4*pi*R^2)
+        R = (shapeS['volume']*3/4/np.pi)**(1/3)
+        shapeS['spherDisprop'] = shapeS['surfArea'] / (4*np.pi*R**2)
 
-    # Spherical disproportion (A/(4*pi*R^2)
-    R = (shapeS['volume']*3/4/np.pi)**(1/3)
-    shapeS['spherDisprop'] = shapeS['surfArea'] / (4*np.pi*R**2)
+        # Sphericity
+        shapeS['sphericity'] = np.pi**(1/3) * (6*shapeS['volume'])**(2/3) / shapeS['surfArea']
 
-    # Sphericity
-    shapeS['sphericity'] = np.pi**(1/3) * (6*shapeS['volume'])**(2/3) / shapeS['surfArea']
+        # Surface to volume ratio
+        shapeS['surfToVolRatio'] = shapeS['surfArea'] / shapeS['volume']
 
-    # Surface to volume ratio
-    shapeS['surfToVolRatio'] = shapeS['surfArea'] / shapeS['volume']
+    # Keep requested features, in the order of computation
+    shapeS = {feat: shapeS[feat] for feat in shapeS if feat in featureList}
 
     return shapeS
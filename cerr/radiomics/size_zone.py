@@ -1,33 +1,40 @@
 import numpy as np
 from scipy.ndimage import label
-
-def calcSZM(quantized3M, nL, szmType):
+from cerr.radiomics.texture_context import TextureContext
+
+def calcSZM(quantized3M, nL, szmType, textureContext=None):
+    """
+    Returns the (nL, maxZoneSize) size zone matrix. Zones are 26-connected in 3D for
+    szmType=1 and 8-connected within each slice for szmType=2. Voxels with level 0
+    (outside the ROI) are ignored.
+    Only levels present within the bounding box of the ROI are labelled, and (level, zoneSize)
+    pairs are accumulated into a matrix trimmed to the largest zone.
+    """
     if szmType == 1:
         s = np.ones((3,3,3))
     else:
-        s = np.ones((3,3))
-
-    sizeV = quantized3M.shape
-    szmM = np.zeros((nL, quantized3M.size), dtype=int)
-    maxSiz = 0
-    for level in range(1, nL+1):
-        if szmType == 1:
-            connM, num_features = label(quantized3M == level, structure=s)
-        else:
-            connM = np.zeros(sizeV, dtype=int)
-            featOffset = 0
-            for slc in range(sizeV[2]):
-                connSlcM, num_features = label(quantized3M[:,:,slc] == level, structure=s)
-                indNoZero = connSlcM > 0
-                connSlcM[indNoZero] += featOffset
-                connM[:,:,slc] = connSlcM
-                featOffset += num_features
-        regionSizV = np.bincount(connM[connM > 0])
-        if len(regionSizV) > 0:
-            maxSiz = max(maxSiz, max(regionSizV))
-        counts = np.bincount(regionSizV)[1:]
-        szmM[level - 1, :len(counts)] = counts
-    szmM = szmM[:, :maxSiz]
+        # In-plane connectivity only
+        s = np.zeros((3,3,3))
+        s[:,:,1] = 1
+
+    if textureContext is None:
+        textureContext = TextureContext(quantized3M, nL)
+    q3M = textureContext.quantized3M
+    __, __, levelsV, __, __ = textureContext.getLevelGroups()
+
+    levelC = []
+    sizeC = []
+    for level in levelsV:
+        connM, numZones = label(q3M == level, structure=s)
+        zoneSizeV = np.bincount(connM.ravel(), minlength=numZones+1)[1:]
+        levelC.append(np.full(numZones, level, dtype=np.int64))
+        sizeC.append(zoneSizeV)
+
+    levelV = np.concatenate(levelC) if levelC else np.zeros(0, dtype=np.int64)
+    sizeV = np.concatenate(sizeC) if sizeC else np.zeros(0, dtype=np.int64)
+    maxSiz = int(np.max(sizeV)) if len(sizeV) > 0 else 0
+    szmM = np.bincount((levelV - 1) * maxSiz + sizeV - 1,
+                       minlength=nL * maxSiz).reshape(nL, maxSiz).astype(int)
     return szmM
 
 
@@ -1,17 +1,167 @@
 """
  This module contains definitions of image texture filters and a wrapper function to apply any of them.
- Supported filters include: "mean", "sobel", "LoG", "gabor", "gabor3d", "laws", "lawsEnergy"
- "rotationInvariantLaws", "rotationInvariantLawsEnergy"
+ Supported filters include: "mean", "sobel", "LoG", "gabor", "gabor3d", "laws", "lawsEnergy", "wavelets"
+ "rotationInvariantLaws", "rotationInvariantLawsEnergy", "rotationInvariantWavelets"
 """
 import pywt
 import numpy as np
+from itertools import product, permutations
 from scipy.signal import convolve2d
-from scipy.signal import convolve
-from scipy.ndimage import rotate
+from scipy.signal import convolve, fftconvolve
+from scipy.fft import fft, ifft, fft2, next_fast_len
+from scipy.ndimage import convolve1d
 from cerr.radiomics.preprocess import padScan
 from cerr.utils.bbox import compute_boundingbox
 
 
+### Convolution backend
+
+# Non-separable kernels with at most this many elements are convolved directly
+directMaxKernelSize = 125
+# Approximate cost of FFT-based convolution per padded voxel per log2(no. padded voxels),
+# in units of the cost of one 1-D filter tap per voxel
+fftCostFactor = 4
+
+
+def convolve1dSame(scan3M, filtV, axis):
+    """
+    Returns 1-D convolution of scan3M with filtV along axis, zero-filled outside the scan and
+    centered as scipy.signal.convolve(..., mode='same'). Each output voxel is computed from its
+    neighbours only (no running sums), so the response does not depend on the extent of scan3M.
+    """
+    filtV = np.asarray(filtV, dtype=float)
+    origin = -1 if len(filtV) % 2 == 0 else 0
+    return convolve1d(scan3M, filtV, axis=axis, mode='constant', cval=0.0, origin=origin)
+
+
+def getSeparableFactors(filtM, rtol=1e-6):
+    """
+    Returns 1-D factors [f0, f1, ...] such that filtM = outer(f0, f1, ...),
+    or None if filtM is not separable (rank-1).
+    """
+    filtM = np.asarray(filtM, dtype=float)
+    maxAbs = np.max(np.abs(filtM), initial=0)
+    if maxAbs == 0:
+        return None
+    pivotV = np.unravel_index(np.argmax(np.abs(filtM)), filtM.shape)
+    pivot = filtM[pivotV]
+    factorList = []
+    for dim in range(filtM.ndim):
+        idx = list(pivotV)
+        idx[dim] = slice(None)
+        factorV = filtM[tuple(idx)]
+        if dim > 0:
+            factorV = factorV / pivot
+        factorList.append(factorV)
+    outerM = factorList[0]
+    for factorV in factorList[1:]:
+        outerM = np.multiply.outer(outerM, factorV)
+    if np.max(np.abs(outerM - filtM)) > rtol * maxAbs:
+        return None
+    return factorList
+
+
+def convolveSeparable(scan3M, termList):
+    """
+    Returns convolution of scan3M (zero-filled, 'same' size) with a kernel specified as a sum of
+    separable terms. Each term is a list of 1-D kernels along rows, cols and (optionally) slices.
+    Terms with 2 factors are applied in-plane (slice-wise).
+    """
+    out3M = np.zeros(scan3M.shape, dtype=float)
+    for factorList in termList:
+        term3M = scan3M.astype(float)
+        for axis, factorV in enumerate(factorList):
+            if len(factorV) == 1:
+                term3M = term3M * float(factorV[0])
+            else:
+                term3M = convolve1dSame(term3M, factorV, axis)
+        out3M += term3M
+    return out3M
+
+
+def getSeparableCost(termList):
+    """ Returns no. 1-D filter taps per voxel for convolveSeparable """
+    cost = 0
+    for factorList in termList:
+        for factorV in factorList:
+            if len(factorV) > 1:
+                cost += len(factorV)
+    return cost
+
+
+def getFFTCost(scanSizeV, filtSizeV):
+    """ Returns approximate cost per voxel of FFT-based convolution, in 1-D filter taps """
+    padSizeV = [scanSiz + filtSiz - 1 for scanSiz, filtSiz in zip(scanSizeV, filtSizeV)]
+    numPad = np.prod(padSizeV, dtype=float)
+    return fftCostFactor * numPad * np.log2(numPad) / np.prod(scanSizeV, dtype=float)
+
+
+def convolveFilter(scan3M, filtM, method='auto', termList=None):
+    """
+    Returns convolution of scan3M with filtM (zero-filled, 'same' size). 2-D kernels are applied slice-wise.
+
+    method   : 'auto' (default), 'separable', 'fft' or 'direct'. 'auto' uses 1-D passes for separable
+               kernels unless FFT-based convolution is estimated to be faster, direct convolution for small
+               non-separable kernels (up to directMaxKernelSize elements) and FFT-based convolution otherwise.
+    termList : Optional decomposition of filtM into a sum of separable terms (see convolveSeparable).
+               By default, filtM is tested for separability.
+    """
+    filtM = np.asarray(filtM)
+    scan3M = np.asarray(scan3M, dtype=float)
+    axesV = list(range(filtM.ndim))
+    filt3M = filtM[:, :, np.newaxis] if filtM.ndim == 2 else filtM
+
+    if termList is None and method in ['auto', 'separable']:
+        factorList = getSeparableFactors(filtM)
+        if factorList is not None:
+            termList = [factorList]
+    if method == 'separable' and termList is None:
+        raise ValueError("Kernel is not separable")
+    if method == 'auto':
+        if termList is not None and \
+                getSeparableCost(termList) <= getFFTCost(scan3M.shape[:filtM.ndim], filtM.shape):
+            method = 'separable'
+        elif filtM.size <= directMaxKernelSize:
+            method = 'direct'
+        else:
+            method = 'fft'
+
+    if method == 'separable':
+        return convolveSeparable(scan3M, termList)
+    elif method == 'fft':
+        return fftconvolve(scan3M, filt3M.astype(float), mode='same', axes=axesV)
+    elif method == 'direct':
+        return convolve(scan3M, filt3M.astype(float), mode='same', method='direct')
+    else:
+        raise ValueError("Invalid convolution method " + method)
+
+
+def applySeparablePasses(scan3M, passS, kernelS):
+    """
+    Returns dictionary of responses of scan3M to a bank of separable filters, each defined by a sequence
+    of 1-D passes passS[name] = [(axis, kernelName), ...] with kernels kernelS[kernelName] (see convolve1dSame).
+    Intermediate results are shared between filters with the same leading passes. Filters are visited
+    in order of their pass sequence, so that only the current chain of intermediates is kept.
+    """
+    scan3M = np.asarray(scan3M, dtype=float)
+    outS = {}
+    chain = []
+    for name in sorted(passS, key=lambda name: passS[name]):
+        passList = passS[name]
+        level = 0
+        while level < len(chain) and level < len(passList) - 1 and chain[level][0] == passList[level]:
+            level += 1
+        del chain[level:]
+        partial3M = scan3M if level == 0 else chain[-1][1]
+        for axis, kernelName in passList[level:-1]:
+            partial3M = convolve1dSame(partial3M, kernelS[kernelName], axis)
+            chain.append(((axis, kernelName), partial3M))
+        axis, kernelName = passList[-1]
+        outS[name] = convolve1dSame(partial3M, kernelS[kernelName], axis)
+
+    return outS
+
+
 def meanFilter(scan3M, kernelSize, absFlag=False):
     """meanFilter
     Returns  mean filter response.
@@ -22,7 +172,10 @@ def meanFilter(scan3M, kernelSize, absFlag=False):
     """
 
     # Generate mean filter kernel
-    filt3M = np.ones(kernelSize, like=scan3M)
+    if len(kernelSize) == 3 and kernelSize[2] != 0:  # 3d
+        filt3M = np.ones(kernelSize, like=scan3M)
+    elif len(kernelSize) == 2 or kernelSize[2] == 0:  # 2d (applied slice-wise)
+        filt3M = np.ones(kernelSize[:2], like=scan3M)
     filt3M = filt3M / np.sum(filt3M)
 
     # Support absolute mean (e.g. for energy calc.)
@@ -30,12 +183,7 @@ def meanFilter(scan3M, kernelSize, absFlag=False):
         scan3M = np.abs(scan3M)
 
     # Generate filter response
-    if len(kernelSize) == 3 and kernelSize[2] != 0:  # 3d
-        out3M = convolve(scan3M, filt3M, mode='same')
-    elif len(kernelSize) == 2 or kernelSize[2] == 0:  # 2d
-        out3M = np.empty_like(scan3M)
-        for slc in range(scan3M.shape[2]):
-            out3M[:, :, slc] = convolve2d(scan3M[:, :, slc], filt3M, mode='same', boundary='fill', fillvalue=0)
+    out3M = convolveFilter(scan3M, filt3M)
 
     return out3M
 
@@ -63,6 +211,30 @@ def sobelFilter(scan3M):
     return outMag3M, outDiR3M
 
 
+def getLoGSeparableTerms(gridList, sig2List, sumH, shift):
+    """
+    Returns the LoG kernel of LoGFilter as a list of separable terms (see convolveSeparable).
+
+    gridList : 1-D voxel coordinates along each axis
+    sig2List : Squared Gaussian widths along each axis (voxel units)
+    sumH     : Sum of the Gaussian kernel
+    shift    : Constant subtracted from the kernel so that it sums to 0
+    """
+    gaussList = [np.exp(-gridV ** 2 / (2 * sig2)) for gridV, sig2 in zip(gridList, sig2List)]
+    if sumH != 0:
+        gaussList[0] = gaussList[0] / sumH
+    sumInvSig2 = np.sum([1 / sig2 for sig2 in sig2List])
+    termList = []
+    for dim, (gridV, sig2) in enumerate(zip(gridList, sig2List)):
+        factorList = list(gaussList)
+        # Constant (-sum of 1/sig^2) term is folded into the first axis
+        quadV = gridV ** 2 / sig2 ** 2 - (sumInvSig2 if dim == 0 else 0)
+        factorList[dim] = factorList[dim] * quadV
+        termList.append(factorList)
+    termList.append([-shift * np.ones(len(gridList[0]))] + [np.ones(len(gridV)) for gridV in gridList[1:]])
+    return termList
+
+
 def LoGFilter(scan3M, sigmaV, cutoffV, voxelSizeV):
     """LoGFilter
     Returns IBSI-compatible Laplacian of Gaussian filter response
@@ -96,9 +268,12 @@ def LoGFilter(scan3M, sigmaV, cutoffV, voxelSizeV):
         if sumH != 0:
             h = h / sumH
         h1 = h * (x ** 2 / xSig2 ** 2 + y ** 2 / ySig2 ** 2 + z ** 2 / zSig2 ** 2 - 1 / xSig2 - 1 / ySig2 - 1 / zSig2)
-        h = h1 - h1.sum() / np.prod(filtSizeV)  # Shift to ensure sum result=0 on homogeneous regions
+        shift = h1.sum() / np.prod(filtSizeV)  # Shift to ensure sum result=0 on homogeneous regions
+        h = h1 - shift
         # Apply LoG filter
-        out3M = convolve(scan3M, h, mode='same')
+        termList = getLoGSeparableTerms([y[:, 0, 0], x[0, :, 0], z[0, 0, :]],
+                                        [ySig2, xSig2, zSig2], sumH, shift)
+        out3M = convolveFilter(scan3M, h, termList=termList)
 
     elif len(sigmaV) == 2:  # 2D
         # Calculate filter weights
@@ -114,11 +289,11 @@ def LoGFilter(scan3M, sigmaV, cutoffV, voxelSizeV):
         if sumH != 0:
             h = h / sumH
         h1 = h * (x ** 2 / xSig2 ** 2 + y ** 2 / ySig2 ** 2 - 1 / xSig2 - 1 / ySig2)
-        h = h1 - h1.sum() / np.prod(filtSizeV)  # Shift to ensure sum result=0 on homogeneous regions
-        # Apply LoG filter
-        out3M = np.zeros_like(scan3M)
-        for slcNum in range(scan3M.shape[2]):
-            out3M[:, :, slcNum] = convolve(scan3M[:, :, slcNum], h, mode='same')
+        shift = h1.sum() / np.prod(filtSizeV)  # Shift to ensure sum result=0 on homogeneous regions
+        h = h1 - shift
+        # Apply LoG filter slice-wise
+        termList = getLoGSeparableTerms([y[:, 0], x[0, :]], [ySig2, xSig2], sumH, shift)
+        out3M = convolveFilter(scan3M, h, termList=termList)
 
     return out3M
 
@@ -166,6 +341,26 @@ def gaborFilter(scan3M, sigma, wavelength, gamma, thetaV, aggS=None, radius=None
     else:
         x, y = np.meshgrid(np.arange(-radius[1], radius[1] ,1), np.arange(-radius[0], radius[0] ,1))
 
+    # FFT of each slice, zero-padded so that the 'same'-size output of the (circular)
+    # convolution is free of wrap-around
+    filtSizeV = x.shape
+    startV = [(filtSiz - 1) // 2 for filtSiz in filtSizeV]
+    padSizeV = [next_fast_len(scanSizeV[dim] + filtSizeV[dim] - 1 - startV[dim]) for dim in range(2)]
+    # (slices are moved to the 1st dimension so that each slice is contiguous)
+    scanFft3M = fft2(np.moveaxis(scan3M, 2, 0), s=padSizeV, axes=(1, 2))
+
+    # Aggregate responses across orientations as they are computed
+    aggMethod = None
+    if aggS is not None and 'OrientationAggregation' in aggS:
+        if aggS['OrientationAggregation'] not in ['max', 'average', 'std']:
+            raise ValueError(f"Invalid OrientationAggregation {aggS['OrientationAggregation']}. "
+                             f"Supported methods are 'max', 'average', 'std'.")
+        if len(thetaV) > 1:
+            aggMethod = aggS['OrientationAggregation']
+    numAgg = 0
+    agg3M = None
+    aggM2_3M = None
+
     # Loop over input orientations
     outS = dict()
     gaborEvenFilters = dict()
@@ -181,37 +376,53 @@ def gaborFilter(scan3M, sigma, wavelength, gamma, thetaV, aggS=None, radius=None
         hGaborOdd = hGaussian * np.sin(2 * np.pi * xTheta / wavelength)
         h = hGaborEven + 1j * hGaborOdd
 
-        # Apply slice-wise
-        out3M = np.zeros_like(scan3M)
-        for slcNum in range(scanSizeV[2]):
-            scanM = scan3M[:, :, slcNum]
-            outM = convolve2d(scanM, h, mode='same', boundary='fill', fillvalue=0)
-            # Return modulus
-            out3M[:, :, slcNum] = np.abs(outM)
+        # Apply slice-wise (multiply by filter transfer function, inverse transform all slices at once,
+        # keeping rows of the 'same'-size output before transforming along columns)
+        outFull3M = ifft(scanFft3M * fft2(h, s=padSizeV), axis=1)
+        outFull3M = ifft(outFull3M[:, startV[0]:startV[0] + scanSizeV[0], :], axis=2)
+        # Return modulus
+        out3M = np.moveaxis(np.abs(outFull3M[:, :, startV[1]:startV[1] + scanSizeV[1]]), 0, 2)
+        del outFull3M
+
         fieldName = f'gabor_{str(theta)}'
-        outS[fieldName] = out3M
         gaborEvenFilters[fieldName] = hGaborEven
         gaborOddFilters[fieldName] = hGaborOdd
+        if aggMethod is None:
+            outS[fieldName] = out3M
+            continue
+
+        # Update running mean/max/variance (Welford)
+        numAgg += 1
+        if aggMethod == 'max':
+            if agg3M is None:
+                agg3M = out3M
+            else:
+                np.maximum(agg3M, out3M, out=agg3M)
+        else:
+            if agg3M is None:
+                agg3M = out3M
+                if aggMethod == 'std':
+                    aggM2_3M = np.zeros_like(out3M)
+            else:
+                delta3M = out3M - agg3M
+                agg3M += delta3M / numAgg
+                if aggMethod == 'std':
+                    aggM2_3M += delta3M * (out3M - agg3M)
 
     # Aggregate responses across orientations
     gaborThetas = dict()
-    if len(thetaV) > 1:
-        if 'OrientationAggregation' in aggS:
-            gaborThetas4M = [filt_response3M for theta, filt_response3M in outS.items()]
-            aggMethod = aggS['OrientationAggregation']
-            if aggMethod == 'average':
-                gaborAggThetaS3M = np.mean(gaborThetas4M, axis=0)
-            elif aggMethod == 'max':
-                gaborAggThetaS3M = np.max(gaborThetas4M, axis=0)
-            elif aggMethod == 'std':
-                gaborAggThetaS3M = np.std(gaborThetas4M, axis=0)
-
-            angleStr = '_'.join(map(lambda x: str(x).replace('.', 'p').replace('-', 'M'), thetaV))
-            fieldName = f'gabor_{angleStr}_{aggMethod}'
-            # if len(fieldName) > 39:
-            #    fieldName = fieldName[:39]
-            gaborThetas[fieldName] = gaborAggThetaS3M
-            fieldName = [fieldName]
+    if aggMethod is not None:
+        if aggMethod == 'std':
+            gaborAggThetaS3M = np.sqrt(aggM2_3M / numAgg)
+        else:
+            gaborAggThetaS3M = agg3M
+
+        angleStr = '_'.join(map(lambda x: str(x).replace('.', 'p').replace('-', 'M'), thetaV))
+        fieldName = f'gabor_{angleStr}_{aggMethod}'
+        # if len(fieldName) > 39:
+        #    fieldName = fieldName[:39]
+        gaborThetas[fieldName] = gaborAggThetaS3M
+        fieldName = [fieldName]
     else:
         gaborThetas = outS
 
@@ -334,6 +545,62 @@ def get3dLawsMask(x, y, z):
     return conved3M
 
 
+def getLaws1dKernels(normFlag=False):
+    """getLaws1dKernels
+    Return dictionary of 1-D Laws kernels L3, E3, S3, L5, E5, S5, R5, W5
+
+    normFlag   :  False - no normalization (default) True - normalize to unit norm
+    """
+
+    kernelS = {'L3': np.array([1, 2, 1], dtype=np.double),
+               'E3': np.array([-1, 0, 1], dtype=np.double),
+               'S3': np.array([-1, 2, -1], dtype=np.double),
+               'L5': np.array([1, 4, 6, 4, 1], dtype=np.double),
+               'E5': np.array([-1, -2, 0, 2, 1], dtype=np.double),
+               'S5': np.array([-1, 0, 2, 0, -1], dtype=np.double),
+               'R5': np.array([1, -4, 6, -4, 1], dtype=np.double),
+               'W5': np.array([-1, 2, 0, -2, 1], dtype=np.double)}
+
+    if normFlag:
+        for kernelName in kernelS:
+            kernelS[kernelName] /= np.sqrt(np.sum(kernelS[kernelName] ** 2))
+
+    return kernelS
+
+
+def getLawsMaskFactors(lawsMask, kernelS, rtol=1e-6):
+    """getLawsMaskFactors
+    Return names of 1-D Laws kernels in kernelS whose outer product is lawsMask (one per axis),
+    or None if lawsMask cannot be factored into them.
+    """
+
+    factorList = getSeparableFactors(lawsMask)
+    if factorList is None:
+        return None
+    nameList = []
+    for factorV in factorList:
+        matchName = None
+        for kernelName, kernelV in kernelS.items():
+            if len(kernelV) != len(factorV):
+                continue
+            scale = np.dot(factorV, kernelV) / np.dot(kernelV, kernelV)
+            if scale != 0 and np.allclose(factorV, scale * kernelV, rtol=0, atol=rtol * np.max(np.abs(factorV))):
+                matchName = kernelName
+                break
+        if matchName is None:
+            return None
+        nameList.append(matchName)
+
+    # Check product of kernels (incl. scale)
+    outerM = kernelS[nameList[0]]
+    for kernelName in nameList[1:]:
+        outerM = np.multiply.outer(outerM, kernelS[kernelName])
+    if not np.allclose(outerM, lawsMask, rtol=0, atol=rtol * np.max(np.abs(lawsMask))):
+        return None
+
+    return nameList
+
+
 def getLawsMasks(direction='all', filterType='all', normFlag=False):
     """getLawsMasks
     Return Laws filter kernels
@@ -345,30 +612,22 @@ def getLawsMasks(direction='all', filterType='all', normFlag=False):
     """
 
     filterType = filterType.upper()
+    direction = direction.lower()
 
     # Define 1-D filter kernels
-    L3 = np.array([1, 2, 1], dtype=np.double)
-    E3 = np.array([-1, 0, 1], dtype=np.double)
-    S3 = np.array([-1, 2, -1], dtype=np.double)
-    L5 = np.array([1, 4, 6, 4, 1], dtype=np.double)
-    E5 = np.array([-1, -2, 0, 2, 1], dtype=np.double)
-    S5 = np.array([-1, 0, 2, 0, -1], dtype=np.double)
-    R5 = np.array([1, -4, 6, -4, 1], dtype=np.double)
-    W5 = np.array([-1, 2, 0, -2, 1], dtype=np.double)
-
-    if normFlag:
-        L3 /= np.sqrt(6)
-        E3 /= np.sqrt(2)
-        S3 /= np.sqrt(6)
-        L5 /= np.sqrt(70)
-        E5 /= np.sqrt(10)
-        S5 /= np.sqrt(6)
-        R5 /= np.sqrt(70)
-        W5 /= np.sqrt(10)
+    kernelS = getLaws1dKernels(normFlag)
+    L3 = kernelS['L3']
+    E3 = kernelS['E3']
+    S3 = kernelS['S3']
+    L5 = kernelS['L5']
+    E5 = kernelS['E5']
+    S5 = kernelS['S5']
+    R5 = kernelS['R5']
+    W5 = kernelS['W5']
 
     lawsMasks = {}
 
-    if filterType not in ['3', '5', 'all']:
+    if filterType not in ['3', '5', 'ALL']:
         f1 = eval(filterType[0:2])
         f2 = eval(filterType[2:4])
         if len(filterType) == 4:  # 2d
@@ -377,7 +636,7 @@ def getLawsMasks(direction='all', filterType='all', normFlag=False):
             f3 = eval(filterType[4:6])
             lawsMasks[filterType] = get3dLawsMask(f1, f2, f3)
     else:
-        if filterType in ['3', 'all'] and direction in ['2d', 'all']:
+        if filterType in ['3', 'ALL'] and direction in ['2d', 'all']:
             # 2-d (length 3)
             lawsMasks['L3E3'] = np.outer(L3, E3)
             lawsMasks['L3S3'] = np.outer(L3, S3)
@@ -390,7 +649,7 @@ def getLawsMasks(direction='all', filterType='all', normFlag=False):
             lawsMasks['S3L3'] = np.outer(S3, L3)
             lawsMasks['S3E3'] = np.outer(S3, E3)
 
-        if type in ['5', 'all'] and direction in ['2d', 'all']:
+        if filterType in ['5', 'ALL'] and direction in ['2d', 'all']:
             # 2-d (length 5)
             lawsMasks['L5L5'] = np.outer(L5, L5)
             lawsMasks['L5E5'] = np.outer(L5, E5)
@@ -422,7 +681,7 @@ def getLawsMasks(direction='all', filterType='all', normFlag=False):
             lawsMasks['W5L5'] = np.outer(W5, L5)
             lawsMasks['W5E5'] = np.outer(W5, E5)
 
-        if type in ['3', 'all'] and direction in ['3d', 'all']:
+        if filterType in ['3', 'ALL'] and direction in ['3d', 'all']:
             # 3-d (length 3)
             lawsMasks['E3E3E3'] = get3dLawsMask(E3, E3, E3)
             lawsMasks['E3E3L3'] = get3dLawsMask(E3, E3, L3)
@@ -452,7 +711,7 @@ def getLawsMasks(direction='all', filterType='all', normFlag=False):
             lawsMasks['S3S3L3'] = get3dLawsMask(S3, S3, L3)
             lawsMasks['S3S3S3'] = get3dLawsMask(S3, S3, S3)
 
-        if type in ['5', 'all'] and direction in ['3d', 'all']:
+        if filterType in ['5', 'ALL'] and direction in ['3d', 'all']:
             # 3-d (Length 5)
             lawsMasks['L5L5L5'] = get3dLawsMask(L5, L5, L5)
             lawsMasks['L5L5E5'] = get3dLawsMask(L5, L5, E5)
@@ -599,22 +858,27 @@ def lawsFilter(scan3M, direction, filterDim, normFlag):
 
     # Get Laws kernel(s)
     lawsMasks = getLawsMasks(direction, filterDim, normFlag)
+    kernelS = getLaws1dKernels(normFlag)
 
     # Compute features
     fieldNames = list(lawsMasks.keys())
-    num_features = len(fieldNames)
 
+    # Sequence of 1-D passes (axis, kernel) for each mask. 3D masks are applied along slices, rows
+    # and then cols, 2D masks along rows and then cols (slice-wise).
+    passS = {}
     out_dict = {}
+    for fieldName in fieldNames:
+        factorNames = getLawsMaskFactors(lawsMasks[fieldName], kernelS)
+        if factorNames is None:
+            out_dict[fieldName] = convolveFilter(scan3M, lawsMasks[fieldName])
+        else:
+            axisOrder = [2, 0, 1] if len(factorNames) == 3 else [0, 1]
+            passS[fieldName] = [(axis, factorNames[axis]) for axis in axisOrder]
+
+    # Apply 1-D passes, re-using intermediate results of masks that share their leading passes
+    out_dict.update(applySeparablePasses(scan3M, passS, kernelS))
 
-    for i in range(num_features):
-        filter_weights = lawsMasks[fieldNames[i]]
-        if direction.lower() == '3d':
-            response3M = convolve(scan3M, filter_weights, mode='same')
-        elif direction.lower() == '2d':
-            response3M = np.empty_like(scan3M)
-            for slc in range(scan3M.shape[2]):
-                response3M[:, :, slc] = convolve2d(scan3M[:, :, slc], filter_weights, mode='same')
-        out_dict[fieldNames[i]] = response3M
+    out_dict = {fieldName: out_dict[fieldName] for fieldName in fieldNames}
 
     return out_dict
 
@@ -736,6 +1000,58 @@ def rotationInvariantLawsFilter(scan3M, direction, filterDim, normFlag, rotS):
     return out3M
 
 
+def rotationInvariantWaveletFilter(scan3M, waveType, direction, level, rotS):
+    """rotationInvariantWaveletFilter
+    Returns wavelet response(s) pooled over right-angle rotations of scan3M using rotS['AggregationMethod']
+    ('avg', 'max' or 'std'): the 4 in-plane rotations for rotS['Dim'] '2d', or the 24 rotations for '3d'.
+
+    In 3D, filtering a rotated scan and rotating the result back is equivalent to filtering a flipped scan
+    with the sub-band whose letters are permuted accordingly, and flipping back. Over the 24 rotations, each
+    pair of the 8 flips (flipSequenceForWavelets) and distinct letter permutations of a sub-band occurs
+    equally often, so those responses are pooled individually instead of rotating the scan. Pooling
+    permutation-averaged sub-bands would only be equivalent for 'avg'.
+    """
+
+    if rotS['Dim'].lower() == '2d':
+        filter = {"wavelets": waveletFilter}
+        return rotationInvariantFilt(scan3M, [], filter, waveType, direction, level, rotS)
+
+    aggregationMethod = rotS['AggregationMethod']
+    if aggregationMethod not in ['avg', 'max', 'std']:
+        raise ValueError(f"Invalid AggregationMethod {aggregationMethod}. Supported methods are 'avg', 'max', 'std'.")
+    if direction.lower() == 'all':
+        dirList = ['HHH', 'LHH', 'HLH', 'HHL', 'LLH', 'LHL', 'HLL', 'LLL']
+    else:
+        dirList = [direction.upper()]
+    permListS = {dirName: sorted(set(''.join(perm) for perm in permutations(dirName))) for dirName in dirList}
+    subbandList = sorted(set(subband for permList in permListS.values() for subband in permList))
+
+    # Handle S-I orientation flip (for IBSI2 compatibility)
+    scan3M = np.flip(scan3M, axis=2).astype(float)
+
+    # Aggregate responses to each flip and permutation as they are computed
+    aggS = {dirName: None for dirName in dirList}
+    aggM2S = {dirName: None for dirName in dirList}
+    numAggS = {dirName: 0 for dirName in dirList}
+    for index in range(8):
+        subbandS = getWaveletSubbands(flipSequenceForWavelets(scan3M, index, 1), waveType, level, '3d', subbandList)
+        for dirName in dirList:
+            for perm in permListS[dirName]:
+                numAggS[dirName] += 1
+                out3M = flipSequenceForWavelets(subbandS[perm], index, -1)
+                aggS[dirName], aggM2S[dirName] = updateRotatedAggregate(out3M, numAggS[dirName], aggregationMethod,
+                                                                        aggS[dirName], aggM2S[dirName])
+        del subbandS
+
+    outS = dict()
+    for dirName in dirList:
+        out_name = f"{waveType}_{dirName}".replace('.', '_').replace(' ', '_')
+        agg3M = finalizeRotatedAggregate(aggS[dirName], aggM2S[dirName], numAggS[dirName], aggregationMethod)
+        outS[out_name] = np.flip(agg3M, axis=2)
+
+    return outS
+
+
 def rotationInvariantLawsEnergyFilter(scan3M, mask3M, direction, filterDim, normFlag, lawsPadFlag, lawsPadSizeV,\
                                       lawsPadMethod, energyKernelSizeV, energyPadSizeV, energyPadMethod, rotS):
 
@@ -749,133 +1065,104 @@ def rotationInvariantLawsEnergyFilter(scan3M, mask3M, direction, filterDim, norm
     return lawsEnergyAggPad3M
 
 
-# def getWaveletSubbands(scan3M, waveletName, level=1, dim='3d'):
-#     """ getWaveletSubbands
-#     Copyright (C) 2017-2019 Martin Vallières
-#     All rights reserved.
-#     https://github.com/mvallieres/radiomics-develop
-#     ------------------------------------------------------------------------
-#     IMPORTANT:
-#     - THIS FUNCTION IS TEMPORARY AND NEEDS BENCHMARKING. ALSO, IT
-#     ONLY WORKS WITH AXIAL SCANS FOR NOW. USING DICOM CONVENTIONS(NOT MATLAB).
-#     - Strategy: 2D transform for each axial slice. Then 1D transform for each
-#     axial line. I need to find a faster way to do that with 3D convolutions
-#     of wavelet filters, this is too slow now. Using GPUs would be ideal.
-#     ------------------------------------------------------------------------
-#     """
-#
-#     # Initialization
-#     if dim not in ['2d', '3d']:
-#         raise ValueError("Invalid 'dim' value. Supported values are '2d' and '3d'.")
-#
-#     sizeV = scan3M.shape
-#     subbands = {}
-#
-#     # Step 1: Making sure the volume has even size
-#     if sizeV[0] % 2 == 1:
-#         scan3M = np.concatenate((scan3M, scan3M[-1][np.newaxis, :, :]), axis=0)
-#     if sizeV[1] % 2 == 1:
-#         scan3M = np.concatenate((scan3M, scan3M[:, -1][:, np.newaxis, :]), axis=1)
-#     if dim == '3d' and sizeV[2] % 2 == 1:
-#         scan3M = np.concatenate((scan3M, scan3M[:, :, -1][:, :, np.newaxis]), axis=2)
-#
-#     # Step 2: Compute all sub-bands
-#     names = []
-#     if dim == '2d':
-#         names = ['LL', 'LH', 'HL', 'HH']
-#     elif dim == '3d':
-#         names = ['LLL', 'LLH', 'LHL', 'LHH', 'HLL', 'HLH', 'HHL', 'HHH']
-#
-#     # Ensure odd filter dimensions
-#     loFilt, hiFilt = pywt.Wavelet(waveletName).filter_bank[0]
-#
-#     # First pass using 2D stationary wavelet transform in axial direction
-#     for k in range(sizeV[2]):
-#         coeffs = pywt.swt2(scan3M[:, :, k], wavelet=waveletName, level=level)
-#         for s, name in enumerate(names):
-#             subbands[name][:, :, k] = coeffs[s][0][:, :, level]
-#
-#     # Second pass using 1D stationary wavelet transform for all axial lines
-#     if dim == '3d':
-#         for j in range(sizeV[1]):
-#             for i in range(sizeV[0]):
-#                 for s, name in enumerate(names[:4]):
-#                     vector = subbands[name][i, j, :]
-#                     L, H = pywt.swt(vector, wavelet=waveletName, level=level)
-#                     subbands[name][i, j, :] = L[level]
-#                 for s, name in enumerate(names[4:]):
-#                     vector = subbands[name][i, j, :]
-#                     L, H = pywt.swt(vector, wavelet=waveletName, level=level)
-#                     subbands[name][i, j, :] = L[level]
-#
-#     # Removing unnecessary data added in step 1
-#     if sizeV[0] % 2 == 1:
-#         for name in names:
-#             subbands[name] = subbands[name][:-1, :, :]
-#     if sizeV[1] % 2 == 1:
-#         for name in names:
-#             subbands[name] = subbands[name][:, :-1, :]
-#     if dim == '3d' and sizeV[2] % 2 == 1:
-#         for name in names:
-#             subbands[name] = subbands[name][:, :, :-1]
-#
-#     return subbands
-#
-#
-# def waveletFilter(vol3M, waveType, direction, level):
-#     if len(direction) == 3:
-#         dim = '3d'
-#     elif len(direction) == 2:
-#         dim = '2d'
-#
-#     if dim == '3d':
-#         dir_list = ['All', 'HHH', 'LHH', 'HLH', 'HHL', 'LLH', 'LHL', 'HLL', 'LLL']
-#     elif dim == '2d':
-#         dir_list = ['All', 'HH', 'HL', 'LH', 'LL']
-#
-#     outS = dict()
-#     if direction == 'All':
-#         for n in range(1, len(dir_list)):
-#
-#             out_name = f"{waveType}_{dir_list[n]}".replace('.', '_').replace(' ', '_')
-#             subbandsS = getWaveletSubbands(vol3M, waveType, level, dim)
-#
-#             if 'RotationInvariance' in paramS and paramS['RotationInvariance']:
-#                 perm_dir_list = [''.join(p) for p in permutations(dir_list[n])]
-#                 match_dir = f"{perm_dir_list[0]}_{waveType}"
-#                 out3M = subbandsS[match_dir]
-#
-#                 for perm_dir in perm_dir_list[1:]:
-#                     match_dir = f"{perm_dir}_{waveType}"
-#                     out3M += subbandsS[match_dir]
-#
-#                 out3M /= len(perm_dir_list)
-#             else:
-#                 match_dir = f"{dir_list[n]}_{waveType}"
-#                 out3M = subbandsS[match_dir]
-#
-#             outS[out_name] = out3M
-#
-#     else:
-#         out_name = f"{waveType}_{direction}".replace('.', '_').replace(' ', '_')
-#         subbandsS = getWaveletSubbands(vol3M, waveType, level, dim)
-#
-#         if 'RotationInvariance' in paramS and paramS['RotationInvariance']:
-#             perm_dir_list = [''.join(p) for p in permutations(direction)]
-#             match_dir = f"{perm_dir_list[0]}_{waveType}"
-#             out3M = subbandsS[match_dir]
-#
-#             for perm_dir in perm_dir_list[1:]:
-#                 match_dir = f"{perm_dir}_{waveType}"
-#                 out3M += subbandsS[match_dir]
-#
-#             out3M /= len(perm_dir_list)
-#         else:
-#             match_dir = f"{direction}_{waveType}"
-#             out3M = subbandsS[match_dir]
-#         outS[out_name] = out3M
-#
-#     return outS
+def getWaveletFilters(waveletName, level=1):
+    """getWaveletFilters
+    Returns 1-D low- and high-pass decomposition filters of waveletName for the stationary wavelet
+    transform at the input level. Filters are zero-padded to odd length and upsampled by inserting
+    2^(level-1) - 1 zeros between coefficients.
+    """
+
+    wavelet = pywt.Wavelet(waveletName)
+    loFiltV = np.array(wavelet.dec_lo, dtype=float)
+    hiFiltV = np.array(wavelet.dec_hi, dtype=float)
+
+    # Ensure odd filter dimensions
+    if len(loFiltV) % 2 == 0:
+        loFiltV = np.append(loFiltV, 0)
+        hiFiltV = np.append(hiFiltV, 0)
+
+    # Upsample for higher levels
+    step = 2 ** (level - 1)
+    if step > 1:
+        upLoFiltV = np.zeros((len(loFiltV) - 1) * step + 1)
+        upHiFiltV = np.zeros((len(hiFiltV) - 1) * step + 1)
+        upLoFiltV[::step] = loFiltV
+        upHiFiltV[::step] = hiFiltV
+        loFiltV, hiFiltV = upLoFiltV, upHiFiltV
+
+    return loFiltV, hiFiltV
+
+
+def getWaveletSubbands(scan3M, waveletName, level=1, dim='3d', subbandList=None):
+    """getWaveletSubbands
+    Returns dictionary of sub-bands of the undecimated (stationary) wavelet transform of scan3M.
+
+    scan3M      : 3D scan (numpy) array
+    waveletName : Wavelet name, e.g. 'db3', 'coif1' (see pywt.wavelist())
+    level       : Decomposition level
+    dim         : '2d' (slice-wise) or '3d'
+    subbandList : List of sub-bands to compute, e.g. ['LLH'] (3d) or ['LH'] (2d). Default: all sub-bands.
+                  Letters refer to the filters applied along x (cols), y (rows) and z (slices) in that order.
+
+    Sub-bands at level > 1 are computed from the low-pass (LL/LLL) sub-band of the previous level.
+    """
+
+    # Initialization
+    dim = dim.lower()
+    if dim not in ['2d', '3d']:
+        raise ValueError("Invalid 'dim' value. Supported values are '2d' and '3d'.")
+    numAxes = 2 if dim == '2d' else 3
+    if subbandList is None:
+        subbandList = [''.join(letters) for letters in product('LH', repeat=numAxes)]
+    for subband in subbandList:
+        if len(subband) != numAxes or any(letter not in 'LH' for letter in subband):
+            raise ValueError(f"Invalid sub-band {subband} for dim {dim}.")
+
+    # Axes filtered by each letter (x, y, z) and order of 1-D passes (slices, rows, cols)
+    letterAxisV = [1, 0, 2]
+    axisOrder = [2, 0, 1] if dim == '3d' else [0, 1]
+
+    # Low-pass sub-band of previous levels
+    scan3M = np.asarray(scan3M, dtype=float)
+    for prevLevel in range(1, level):
+        loFiltV, __ = getWaveletFilters(waveletName, prevLevel)
+        for axis in axisOrder:
+            scan3M = convolve1dSame(scan3M, loFiltV, axis)
+
+    # Compute requested sub-bands, re-using low-pass intermediates
+    loFiltV, hiFiltV = getWaveletFilters(waveletName, level)
+    kernelS = {'L': loFiltV, 'H': hiFiltV}
+    passS = {subband: [(axis, subband[letterAxisV.index(axis)]) for axis in axisOrder]
+             for subband in subbandList}
+    subbandS = applySeparablePasses(scan3M, passS, kernelS)
+
+    return {subband: subbandS[subband] for subband in subbandList}
+
+
+def waveletFilter(vol3M, waveType, direction, level=1):
+    """waveletFilter
+    Returns wavelet filter response(s) (IBSI-compatible)
+
+    vol3M     : 3D scan (numpy) array
+    waveType  : Wavelet name, e.g. 'db3', 'coif1'
+    direction : Sub-band, e.g. 'LLH' (3d) or 'LH' (2d), or 'All' for all 3d sub-bands
+    level     : Decomposition level
+    """
+
+    if direction.lower() == 'all':
+        dirList = ['HHH', 'LHH', 'HLH', 'HHL', 'LLH', 'LHL', 'HLL', 'LLL']
+    else:
+        dirList = [direction.upper()]
+    dim = '3d' if len(dirList[0]) == 3 else '2d'
+
+    subbandS = getWaveletSubbands(vol3M, waveType, level, dim, dirList)
+
+    outS = dict()
+    for dirName in dirList:
+        out_name = f"{waveType}_{dirName}".replace('.', '_').replace(' ', '_')
+        outS[out_name] = subbandS[dirName]
+
+    return outS
 
 
 ### Functions for rotation-invariant filtering and pooling
@@ -886,24 +1173,40 @@ def getMatchFields(dictIn, *args):
     return np.array([dictIn[field] for field in args])
 
 
-def aggregateRotatedResponses(rotTexture, aggregationMethod):
-    """Aggregate textures from all orientations"""
+def updateRotatedAggregate(out3M, numAgg, aggregationMethod, agg3M=None, aggM2_3M=None):
+    """Fold the numAgg-th response out3M into the running mean ('avg'), max ('max') or
+    variance ('std', Welford) of responses. Returns updated agg3M, aggM2_3M."""
 
-    out_4m = np.stack(rotTexture, axis=0)
-    if aggregationMethod == 'avg':
-        agg3M = np.mean(out_4m, axis=0)
+    if agg3M is None:
+        agg3M = np.array(out3M, dtype=float)
+        if aggregationMethod == 'std':
+            aggM2_3M = np.zeros_like(agg3M)
     elif aggregationMethod == 'max':
-        agg3M = np.max(out_4m, axis=0)
-    elif aggregationMethod == 'std':
-        agg3M = np.std(out_4m, axis=0)
+        np.maximum(agg3M, out3M, out=agg3M)
+    else:
+        delta3M = out3M - agg3M
+        agg3M += delta3M / numAgg
+        if aggregationMethod == 'std':
+            aggM2_3M += delta3M * (out3M - agg3M)
+
+    return agg3M, aggM2_3M
+
 
+def finalizeRotatedAggregate(agg3M, aggM2_3M, numAgg, aggregationMethod):
+    """Return aggregated response from running accumulators (see updateRotatedAggregate)"""
+
+    if aggregationMethod == 'std':
+        return np.sqrt(aggM2_3M / numAgg)
     return agg3M
 
 
 def rot3d90(arr3M, axis, angle):
-    """Rotate 3D array 90 degrees around a specific axis"""
+    """Rotate 3D array by a multiple of 90 degrees around a specific axis.
+    Returns an exact (non-interpolated) view of arr3M."""
 
-    rotArr3M = rotate(arr3M, angle, axes=(axis % 3, (axis + 1) % 3), reshape=False)
+    # Same sense of rotation as scipy.ndimage.rotate, which orders the axes of the plane
+    planeAxes = tuple(sorted((axis % 3, (axis + 1) % 3)))
+    rotArr3M = np.rot90(arr3M, k=int(angle // 90), axes=planeAxes)
     return rotArr3M
 
 
@@ -956,8 +1259,14 @@ def rotate3dSequence(vol3M, index, sign):
     return switch[index](vol3M)
 
 
-def flipSequenceForWavelets():
-    pass
+def flipSequenceForWavelets(vol3M, index, sign):
+    """Apply pre-defined sequence of flips to 2D/3D arrays. Bits 0, 1 and 2 of index (0-7) select flips
+    along rows, cols and slices. Flips are their own inverse, so sign is not used."""
+
+    flipAxes = tuple(axis for axis in range(3) if (index >> axis) & 1)
+    if len(flipAxes) == 0:
+        return vol3M
+    return np.flip(vol3M, axis=flipAxes)
 
 
 def rotationInvariantFilt(scan3M, mask3M, filter, *params):
@@ -972,11 +1281,10 @@ def rotationInvariantFilt(scan3M, mask3M, filter, *params):
     # Parameters for rotation invariance
     rot = params[-1]
     aggregationMethod = rot['AggregationMethod']
+    if aggregationMethod not in ['avg', 'max', 'std']:
+        raise ValueError(f"Invalid AggregationMethod {aggregationMethod}. Supported methods are 'avg', 'max', 'std'.")
     dim = rot['Dim']
-    if waveletFlag:
-        numRotations = 4 if dim.lower() == '2d' else 8
-    else:
-        numRotations = 4 if dim.lower() == '2d' else 24
+    numRotations = 4 if dim.lower() == '2d' else 24
 
     # Handle S-I orientation flip for Wavelet filters
     if waveletFlag:
@@ -984,25 +1292,20 @@ def rotationInvariantFilt(scan3M, mask3M, filter, *params):
         if len(mask3M) > 0:
             mask3M = np.flip(mask3M, axis=2)
 
-    # Apply filter at specified orientations
-    rotTextureTypes = [{} for _ in range(numRotations)]
+    # Apply filter at specified orientations, aggregating responses as they are computed
+    aggS = None
+    aggM2S = None
     for index in range(1, numRotations + 1):
-        if waveletFlag:
-            rotScan3M = flipSequenceForWavelets(scan3M, index - 1, 1)
+        if dim.lower() == '2d':
+            rotScan3M = np.rot90(scan3M, k=index - 1)
             rotMask3M = mask3M
             if len(mask3M) > 0:
-                rotMask3M = flipSequenceForWavelets(mask3M, index - 1, 1)
-        else:
-            if dim.lower() == '2d':
-                rotScan3M = np.rot90(scan3M, k=index - 1)
-                rotMask3M = mask3M
-                if len(mask3M) > 0:
-                    rotMask3M = np.rot90(mask3M, k=index - 1)
-            elif dim.lower() == '3d':
-                rotScan3M = rotate3dSequence(scan3M, index - 1, 1)
-                rotMask3M = mask3M
-                if len(mask3M) > 0:
-                    rotMask3M = rotate3dSequence(mask3M, index - 1, 1)
+                rotMask3M = np.rot90(mask3M, k=index - 1)
+        elif dim.lower() == '3d':
+            rotScan3M = rotate3dSequence(scan3M, index - 1, 1)
+            rotMask3M = mask3M
+            if len(mask3M) > 0:
+                rotMask3M = rotate3dSequence(mask3M, index - 1, 1)
 
         # Apply filter
         filterHandle = filter[filterType]
@@ -1015,36 +1318,43 @@ def rotationInvariantFilt(scan3M, mask3M, filter, *params):
             for key in filterResult.keys():
                 texture3M = filterResult[key]
 
-                if waveletFlag:
-                    out3M = flipSequenceForWavelets(texture3M, index - 1, -1)
-                    out3M = np.flip(out3M, axis=2)
-                else:
-                    if dim.lower() == '2d':
-                        out3M = np.rot90(texture3M, k=-(index - 1))
-                    elif dim.lower() == '3d':
-                        out3M = rotate3dSequence(texture3M, index - 1, -1)
+                if dim.lower() == '2d':
+                    out3M = np.rot90(texture3M, k=-(index - 1))
+                elif dim.lower() == '3d':
+                    out3M = rotate3dSequence(texture3M, index - 1, -1)
 
                 filterResult[key] = out3M
-            rotTextureTypes[index - 1] = filterResult
         else:
-            if waveletFlag:
-                out3M = flipSequenceForWavelets(filterResult, index - 1, -1)
-                #out3M = np.flip(rotOut3M, axis=2)
-            else:
-                if dim.lower() == '2d':
-                    filterResult = np.rot90(filterResult, k=-(index - 1))
-                elif dim.lower() == '3d':
-                    filterResult = rotate3dSequence(filterResult, index - 1, -1)
-            rotTextureTypes[index - 1] = filterResult
+            if dim.lower() == '2d':
+                filterResult = np.rot90(filterResult, k=-(index - 1))
+            elif dim.lower() == '3d':
+                filterResult = rotate3dSequence(filterResult, index - 1, -1)
+
+        # Update running aggregate(s)
+        if isinstance(filterResult, dict):
+            if aggS is None:
+                aggS = {key: None for key in filterResult}
+                aggM2S = {key: None for key in filterResult}
+            for key in filterResult.keys():
+                aggS[key], aggM2S[key] = updateRotatedAggregate(filterResult[key], index, aggregationMethod,
+                                                                aggS[key], aggM2S[key])
+        else:
+            aggS, aggM2S = updateRotatedAggregate(filterResult, index, aggregationMethod, aggS, aggM2S)
+        del filterResult
 
     # Aggregate responses across orientations
-    if isinstance(rotTextureTypes[0], dict):
-        aggS = dict()
-        for type in rotTextureTypes[0].keys():
-            rotTextureType = [rotTextures[type] for rotTextures in rotTextureTypes]
-            agg3M = aggregateRotatedResponses(rotTextureType, aggregationMethod)
-        aggS[key] = agg3M
+    if isinstance(aggS, dict):
+        for key in aggS.keys():
+            aggS[key] = finalizeRotatedAggregate(aggS[key], aggM2S[key], numRotations, aggregationMethod)
     else:
-        aggS = aggregateRotatedResponses(rotTextureTypes, aggregationMethod)
+        aggS = finalizeRotatedAggregate(aggS, aggM2S, numRotations, aggregationMethod)
+
+    # Undo S-I orientation flip for Wavelet filters
+    if waveletFlag:
+        if isinstance(aggS, dict):
+            for key in aggS.keys():
+                aggS[key] = np.flip(aggS[key], axis=2)
+        else:
+            aggS = np.flip(aggS, axis=2)
 
     return aggS
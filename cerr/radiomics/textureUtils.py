@@ -27,16 +27,104 @@ def loadSettingsFromFile(settingsFile, scanNum=None, planC=None):
     return paramS, filterTypes
 
 
-def processImage(filterType, scan3M, mask3M, paramS):
+def getFilterMargin(filterType, paramS):
     """
-    Process scan using selected filter and parameters
+    Returns no. of voxels [rows, cols, slices] on either side of a voxel that contribute to its
+    filter response, or None if the response depends on the extent of the scan (e.g. Gabor filters
+    with default radius) or on its padding (Laws energy).
 
     filterType : Name of supported filter
-    scan3M     : 3D scan array
-    mask3M     : 3D mask
     paramS     : Dictionary of parameters (read from JSON)
     """
 
+    filterType = filterType.strip().lower()
+
+    if filterType == 'original':
+        marginV = np.array([0, 0, 0])
+
+    elif filterType == 'mean':
+        marginV = np.array(paramS['KernelSize']) // 2
+        if len(marginV) == 2:
+            marginV = np.append(marginV, 0)
+
+    elif filterType == 'sobel':
+        marginV = np.array([1, 1, 0])
+
+    elif filterType == 'log':
+        cutOffV = np.array(paramS['CutOff_mm'])
+        voxelSizeV = np.array(paramS['VoxelSize_mm'])
+        marginV = np.round(cutOffV / voxelSizeV[:len(cutOffV)]).astype(int)
+        if len(marginV) == 2:
+            marginV = np.append(marginV, 0)
+
+    elif filterType in ['laws', 'rotationinvariantlaws']:
+        lawsType = str(paramS['Type']).upper()
+        if lawsType in ['3', '5']:
+            kernelLen = int(lawsType)
+        elif lawsType == 'ALL':
+            kernelLen = 5
+        else:
+            kernelLen = max(int(char) for char in lawsType if char.isdigit())
+        halfLen = kernelLen // 2
+        marginV = np.array([halfLen, halfLen, 0 if paramS['Direction'].lower() == '2d' else halfLen])
+
+    elif filterType in ['wavelets', 'rotationinvariantwavelets']:
+        waveType = paramS['Wavelets']
+        if 'Index' in paramS and paramS['Index'] is not None:
+            waveType += str(paramS['Index'])
+        level = paramS['Level'] if 'Level' in paramS.keys() else 1
+        halfLen = sum((len(textureFilters.getWaveletFilters(waveType, lev)[0]) - 1) // 2
+                      for lev in range(1, level + 1))
+        marginV = np.array([halfLen, halfLen, 0 if len(paramS['Direction']) == 2 else halfLen])
+
+    else:
+        return None
+
+    # Rotated kernels
+    if 'RotationInvariance' in paramS and paramS['RotationInvariance']:
+        if paramS['RotationInvariance']['Dim'].lower() == '3d':
+            marginV[:] = np.max(marginV)
+        else:
+            marginV[:2] = np.max(marginV[:2])
+
+    return marginV.astype(int)
+
+
+def processImage(filterType, scan3M, mask3M, paramS, fullMapFlag=True):
+    """
+    Process scan using selected filter and parameters
+
+    filterType  : Name of supported filter
+    scan3M      : 3D scan array
+    mask3M      : 3D mask
+    paramS      : Dictionary of parameters (read from JSON)
+    fullMapFlag : True (default) - return response maps over the entire scan.
+                  False - return response maps over the bounding box of mask3M only. The filter is then
+                  applied to the bounding box extended by the kernel support (see getFilterMargin).
+    """
+
+    # Filter ROI bounding box plus kernel support
+    if not fullMapFlag and mask3M is not None and np.any(mask3M):
+        minr, maxr, minc, maxc, mins, maxs, __ = compute_boundingbox(mask3M)
+        sizeV = scan3M.shape
+        marginV = getFilterMargin(filterType, paramS)
+        if marginV is None:
+            cropV = [0, sizeV[0] - 1, 0, sizeV[1] - 1, 0, sizeV[2] - 1]
+        else:
+            cropV = [max(minr - marginV[0], 0), min(maxr + marginV[0], sizeV[0] - 1),
+                     max(minc - marginV[1], 0), min(maxc + marginV[1], sizeV[1] - 1),
+                     max(mins - marginV[2], 0), min(maxs + marginV[2], sizeV[2] - 1)]
+        cropScan3M = scan3M[cropV[0]:cropV[1]+1, cropV[2]:cropV[3]+1, cropV[4]:cropV[5]+1]
+        cropMask3M = mask3M[cropV[0]:cropV[1]+1, cropV[2]:cropV[3]+1, cropV[4]:cropV[5]+1]
+        cropOutS = processImage(filterType, cropScan3M, cropMask3M, paramS)
+
+        # Extract response over ROI bounding box
+        outS = dict()
+        for key in cropOutS.keys():
+            outS[key] = cropOutS[key][minr-cropV[0]:maxr-cropV[0]+1, minc-cropV[2]:maxc-cropV[2]+1,
+                                      mins-cropV[4]:maxs-cropV[4]+1]
+        return outS
+
     filterType = filterType.strip().lower()
     scan3M = scan3M.astype(float)
     outS = dict()
@@ -135,18 +223,24 @@ def processImage(filterType, scan3M, mask3M, paramS):
                                                                      energyPadMethod, rotS)
             outS[type + '_Energy'] = out3M
 
-    # elif filterType in ['wavelets', 'rotationinvariantwavelets']:
-    #
-    #     waveType = paramS['Wavelets']
-    #     direction = paramS['Direction']
-    #     level = 1  # Default
-    #     if 'level' in paramS.keys():
-    #         level = paramS['Level']
-    #     if 'Index' in paramS and paramS['Index'] is not None:
-    #         waveType += str(paramS['Index'])
-    #     if filterType == 'rotationInvariantWaveletFilter':
-    #         outS = waveletFilter(scan3M, waveType, direction, level)
-    #     # elif filterType == 'rotationInvariantWavelets':
+    elif filterType in ['wavelets', 'rotationinvariantwavelets']:
+
+        waveType = paramS['Wavelets']
+        direction = paramS['Direction']
+        level = 1  # Default
+        if 'Level' in paramS.keys():
+            level = paramS['Level']
+        if 'Index' in paramS and paramS['Index'] is not None:
+            waveType += str(paramS['Index'])
+        if filterType == 'rotationinvariantwavelets' or \
+                ('RotationInvariance' in paramS and paramS['RotationInvariance']):
+            rotS = paramS['RotationInvariance']
+            outS = textureFilters.rotationInvariantWaveletFilter(scan3M, waveType, direction, level, rotS)
+        else:
+            # Handle S-I orientation flip (for IBSI2 compatibility)
+            outS = textureFilters.waveletFilter(np.flip(scan3M, axis=2), waveType, direction, level)
+            for key in outS.keys():
+                outS[key] = np.flip(outS[key], axis=2)
 
     else:
         raise Exception('Unknown filter name ' + filterType)
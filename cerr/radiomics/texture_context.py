@@ -0,0 +1,131 @@
+"""
+This module defines TextureContext, which holds data derived from a quantized volume
+that is shared by the texture feature families (GLCM, GLRLM, GLSZM, NGTDM and NGLDM).
+Quantities are computed once, on first use, and reused by every family.
+"""
+
+import numpy as np
+from scipy.ndimage import uniform_filter
+from cerr.utils.bbox import compute_boundingbox
+
+
+def getLineOrderIndices(siz, offset):
+    """
+    Returns flat (C-order) indices of an array of size siz ordered along the lines
+    x, x + offset, x + 2*offset, ... that cover the array, along with a boolean
+    vector marking the first voxel of each line.
+    """
+    siz = np.asarray(siz, dtype=np.int64)
+    offset = np.asarray(offset, dtype=np.int64)
+    gridC = np.ogrid[tuple(slice(0, n) for n in siz)]
+
+    # A line starts at voxels whose predecessor (x - offset) lies outside the array
+    startM = np.zeros(tuple(siz), dtype=bool)
+    for dim in range(len(siz)):
+        if offset[dim] > 0:
+            startM |= gridC[dim] < offset[dim]
+        elif offset[dim] < 0:
+            startM |= gridC[dim] >= siz[dim] + offset[dim]
+    startIndV = np.flatnonzero(startM)
+
+    # Number of voxels on each line
+    subC = np.unravel_index(startIndV, tuple(siz))
+    lineLenV = np.full(len(startIndV), np.max(siz) - 1, dtype=np.int64)
+    for dim in range(len(siz)):
+        if offset[dim] > 0:
+            lineLenV = np.minimum(lineLenV, (siz[dim] - 1 - subC[dim]) // offset[dim])
+        elif offset[dim] < 0:
+            lineLenV = np.minimum(lineLenV, subC[dim] // -offset[dim])
+    lineLenV += 1
+
+    # Flat indices of voxels along each line
+    stridesV = np.append(np.cumprod(siz[::-1])[::-1][1:], 1)
+    flatStep = int(np.sum(offset * stridesV))
+    firstPosV = np.cumsum(lineLenV) - lineLenV
+    stepV = np.arange(np.sum(lineLenV)) - np.repeat(firstPosV, lineLenV)
+    orderedIndV = np.repeat(startIndV, lineLenV) + stepV * flatStep
+    lineStartV = stepV == 0
+
+    return orderedIndV, lineStartV
+
+
+def getNeighborhoodSum(img3M, patch_size):
+    """
+    Returns the sum of img3M over a (2*patch_size+1) box around each voxel, treating
+    voxels outside the array as 0. Use only with integer-valued images, since the
+    sums are rounded.
+    """
+    winSizV = 2 * np.asarray(patch_size, dtype=int) + 1
+    mean3M = uniform_filter(img3M.astype(float), size=winSizV, mode='constant', cval=0)
+    return np.rint(mean3M * np.prod(winSizV))
+
+
+class TextureContext:
+    """
+    Quantized volume cropped to the bounding box of the ROI (level > 0), along with its
+    ROI mask, ROI voxels grouped by level, line orderings per offset and neighbour counts.
+
+    Example:
+        texContext = TextureContext(quantized3M, nL)
+        glcmM = gray_level_cooccurence.calcCooccur(quantized3M, offsetsM, nL, textureContext=texContext)
+        rlmM = run_length.calcRLM(quantized3M, offsetsM, nL, textureContext=texContext)
+    """
+
+    def __init__(self, quantized3M, nL):
+        q3M = np.array(quantized3M, dtype=float)
+        q3M[np.isnan(q3M)] = 0
+        self.origShape = q3M.shape
+        self.nL = int(nL)
+
+        mask3M = q3M > 0
+        if np.any(mask3M):
+            minr, maxr, minc, maxc, mins, maxs, __ = compute_boundingbox(mask3M)
+            q3M = q3M[minr:maxr+1, minc:maxc+1, mins:maxs+1]
+        else:
+            q3M = np.zeros((0, 0, 0))
+        maxLevel = np.max(q3M, initial=0)
+        self.quantized3M = q3M.astype(np.uint8 if maxLevel < 2**8 else np.uint16 if maxLevel < 2**16 else np.int64)
+        self.mask3M = self.quantized3M > 0
+
+        # ROI voxels (flat indices into quantized3M) and their levels
+        self.roiIndV = np.flatnonzero(self.mask3M)
+        self.roiLevV = self.quantized3M.ravel()[self.roiIndV].astype(np.int64)
+
+        self._levelGroups = None
+        self._lineOrderS = {}
+        self._numNeighborsS = {}
+
+    def getLineOrder(self, offset):
+        """
+        Returns getLineOrderIndices of quantized3M along offset, computed once per offset.
+        """
+        key = tuple(int(off) for off in offset)
+        if key not in self._lineOrderS:
+            self._lineOrderS[key] = getLineOrderIndices(self.quantized3M.shape, offset)
+        return self._lineOrderS[key]
+
+    def getLevelGroups(self):
+        """
+        Returns ROI voxel indices sorted by level, their levels, the levels present (up to nL)
+        and the start/stop positions of each level in the sorted vectors.
+        """
+        if self._levelGroups is None:
+            useV = self.roiLevV <= self.nL
+            sortIndV = np.argsort(self.roiLevV[useV], kind='stable')
+            roiIndV = self.roiIndV[useV][sortIndV]
+            levV = self.roiLevV[useV][sortIndV]
+            levelsV = np.unique(levV)
+            levStartV = np.searchsorted(levV, levelsV, side='left')
+            levStopV = np.searchsorted(levV, levelsV, side='right')
+            self._levelGroups = (roiIndV, levV, levelsV, levStartV, levStopV)
+        return self._levelGroups
+
+    def getNumNeighbors(self, patch_size):
+        """
+        Returns the number of ROI neighbours within a (2*patch_size+1) box of each ROI voxel,
+        excluding the voxel itself.
+        """
+        key = tuple(int(siz) for siz in patch_size)
+        if key not in self._numNeighborsS:
+            self._numNeighborsS[key] = getNeighborhoodSum(self.mask3M, patch_size).ravel()[self.roiIndV] - 1
+        return self._numNeighborsS[key]
@@ -0,0 +1,62 @@
+"""
+ This script checks that the separable, FFT-based and direct convolution backends of
+ texture filters agree with scipy.signal.convolve (3-D kernels) and slice-wise
+ convolve2d (2-D kernels).
+"""
+
+import numpy as np
+import pytest
+from scipy.signal import convolve, convolve2d
+from cerr.radiomics import textureFilters
+
+
+def getRandomScan(siz=(24, 21, 13), seed=0):
+    return np.random.default_rng(seed).normal(size=siz)
+
+
+def getReference(scan3M, filtM):
+    if filtM.ndim == 3:
+        return convolve(scan3M, filtM, mode='same', method='direct')
+    ref3M = np.zeros(scan3M.shape)
+    for slc in range(scan3M.shape[2]):
+        ref3M[:, :, slc] = convolve2d(scan3M[:, :, slc], filtM, mode='same')
+    return ref3M
+
+
+def getKernels():
+    rng = np.random.default_rng(1)
+    return {'separable3d': np.multiply.outer(np.outer(rng.normal(size=5), rng.normal(size=3)), rng.normal(size=7)),
+            'separable3dEven': np.multiply.outer(np.outer(rng.normal(size=4), rng.normal(size=3)), rng.normal(size=2)),
+            'separable2d': np.outer(rng.normal(size=5), rng.normal(size=9)),
+            'nonSeparable3d': rng.normal(size=(3, 5, 3)),
+            'nonSeparable2d': rng.normal(size=(9, 7))}
+
+
+@pytest.mark.parametrize("kernelName", list(getKernels().keys()))
+def test_convolution_methods(kernelName):
+    scan3M = getRandomScan()
+    filtM = getKernels()[kernelName]
+    ref3M = getReference(scan3M, filtM)
+    methodList = ['auto', 'fft', 'direct']
+    if kernelName.startswith('separable'):
+        methodList.append('separable')
+    else:
+        with pytest.raises(ValueError):
+            textureFilters.convolveFilter(scan3M, filtM, method='separable')
+    for method in methodList:
+        out3M = textureFilters.convolveFilter(scan3M, filtM, method=method)
+        np.testing.assert_allclose(out3M, ref3M, atol=1e-10 * np.max(np.abs(ref3M)))
+
+
+def test_separable_terms():
+    # Kernel given as a sum of separable terms
+    rng = np.random.default_rng(2)
+    termList = [[rng.normal(size=5), rng.normal(size=5), rng.normal(size=3)] for __ in range(3)]
+    filt3M = sum(np.multiply.outer(np.outer(f0, f1), f2) for f0, f1, f2 in termList)
+    scan3M = getRandomScan()
+    ref3M = getReference(scan3M, filt3M)
+    for method in ['auto', 'separable']:
+        out3M = textureFilters.convolveFilter(scan3M, filt3M, method=method, termList=termList)
+        np.testing.assert_allclose(out3M, ref3M, atol=1e-10 * np.max(np.abs(ref3M)))
+    with pytest.raises(ValueError):
+        textureFilters.convolveFilter(scan3M, filt3M, method='spatial')
@@ -0,0 +1,62 @@
+"""
+ This script checks dose summation and conversion of physical dose to BED and EQD2
+ against hand-computed values of the linear-quadratic model.
+"""
+
+import os
+import numpy as np
+import pytest
+from cerr import datasets
+from cerr import plan_container as pc
+from cerr import dose_accumulation
+from cerr.utils import uid
+
+phantom_dir = os.path.join(os.path.dirname(datasets.__file__),'radiomics_phantom_dicom')
+dcm_dir = os.path.join(phantom_dir, 'PAT1')
+
+
+def addConstantDose(doseVal, numFractions, planC, scanNum=0):
+    """ Add dose with constant value on the grid of scanNum to planC """
+    xV, yV, zV, doseObj = dose_accumulation.getTargetGrid(planC, targetScanNum=scanNum)
+    doseObj.doseArray = doseVal * np.ones((len(yV), len(xV), len(zV)))
+    doseObj.doseUID = uid.createUID("dose")
+    doseObj.numberOfTx = numFractions
+    planC.dose.append(doseObj)
+    return planC
+
+
+def getInteriorDose(doseObj):
+    """ Exclude boundary rows/cols of the grid, which getDoseAt may treat as out of bounds """
+    return doseObj.doseArray[1:-1, 1:-1, :]
+
+
+def test_convert_physical_dose():
+    # 20 Gy in 5 fractions, alpha/beta = 3 Gy
+    # BED = 20 * (1 + 4/3) = 46.667 Gy, EQD2 = BED / (1 + 2/3) = 28 Gy
+    dose3M = np.array([0, 20, 50], dtype=float)
+    bed3M = dose_accumulation.convertPhysicalDose(dose3M, 5, 3, 'BED')
+    eqd3M = dose_accumulation.convertPhysicalDose(dose3M, 5, 3, 'eqd2')
+    np.testing.assert_allclose(bed3M, [0, 140/3, 50 * (1 + 10/3)])
+    np.testing.assert_allclose(eqd3M, [0, 28, 50 * (1 + 10/3) * 0.6])
+    np.testing.assert_array_equal(dose_accumulation.convertPhysicalDose(dose3M, 5, 3, None), dose3M)
+    with pytest.raises(ValueError):
+        dose_accumulation.convertPhysicalDose(dose3M, 5, 3, 'LQ')
+
+
+def test_sum_dose_eqd2():
+    planC = pc.load_dcm_dir(dcm_dir)
+    planC = addConstantDose(20, 5, planC)   # 4 Gy x 5
+    planC = addConstantDose(50, 25, planC)  # 2 Gy x 25
+    sumDoseObj = dose_accumulation.sumDose([0, 1], planC, conversion='eqd2', abRatio=3)
+    np.testing.assert_allclose(getInteriorDose(sumDoseObj), 28 + 50)
+    assert sumDoseObj.doseSummationType == 'EQD2'
+    sumDoseObj = dose_accumulation.sumDose([0, 1], planC, conversion='BED', abRatio=3,
+                                           numFractionsV=[5, 25])
+    np.testing.assert_allclose(getInteriorDose(sumDoseObj), 140/3 + 50 * (1 + 2/3))
+    sumDoseObj = dose_accumulation.sumDose([0, 1], planC, scaleFactorV=[2, 1])
+    np.testing.assert_allclose(getInteriorDose(sumDoseObj), 2 * 20 + 50)
+    assert sumDoseObj.doseSummationType == 'PLAN'
+    with pytest.raises(ValueError):
+        dose_accumulation.sumDose([0, 1], planC, conversion='EQD2')
+    with pytest.raises(ValueError):
+        dose_accumulation.sumDose([0, 1], planC, conversion='LQ', abRatio=3)
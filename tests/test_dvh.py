@@ -0,0 +1,186 @@
+"""
+ This script checks DVH metrics of CumulativeDVH against the scalar DVH routines,
+ DVHs computed on the dose grid and via cached dose on the scan grid against getDVH,
+ invalidation of memoised DVHs and their persistence to HDF5.
+"""
+
+import os
+import numpy as np
+from cerr import datasets
+from cerr import plan_container as pc
+from cerr import dose_accumulation
+from cerr import dvh
+from cerr.dataclasses import dose as rtds
+from cerr.utils import uid
+
+phantom_dir = os.path.join(os.path.dirname(datasets.__file__),'radiomics_phantom_dicom')
+dcm_dir = os.path.join(phantom_dir, 'PAT1')
+
+
+def getRandomHist(binWidth=0.5):
+    rng = np.random.default_rng(0)
+    dosesV = rng.gamma(4, 10, 5000)
+    volsV = rng.uniform(0.5, 1.5, 5000)
+    return dvh.doseHist(dosesV, volsV, binWidth)
+
+
+def addDose(dose3M, planC, scanNum=0, subsample=1):
+    """ Add dose3M on (a subsample of) the grid of scanNum to planC """
+    xV, yV, zV, doseObj = dose_accumulation.getTargetGrid(planC, targetScanNum=scanNum)
+    doseObj.horizontalGridInterval *= subsample
+    doseObj.verticalGridInterval *= subsample
+    doseObj.sizeOfDimension1 = len(xV[::subsample])
+    doseObj.sizeOfDimension2 = len(yV[::subsample])
+    doseObj.sizeOfDimension3 = len(zV[::subsample])
+    doseObj.zValues = zV[::subsample]
+    doseObj.doseArray = dose3M
+    doseObj.doseUID = uid.createUID("dose")
+    planC.dose.append(doseObj)
+    return planC
+
+
+def getPhantomWithDose():
+    planC = pc.load_dcm_dir(dcm_dir)
+    siz = planC.scan[0].getScanSize()
+    dose3M = np.random.default_rng(0).uniform(0, 60, siz)
+    return addDose(dose3M, planC)
+
+
+def failDVH(*args, **kwargs):
+    raise AssertionError('DVH recomputed instead of read from the cache')
+
+
+def test_cumulative_dvh_metrics():
+    doseBinsV, volsHistV = getRandomHist()
+    cumDVH = dvh.CumulativeDVH(doseBinsV, volsHistV)
+
+    doseCutoffV = [0, 5, 20.25, 40, 100, 1000]
+    for volumeType in [0, 1]:
+        refV = [dvh.Vx(doseBinsV, volsHistV, cutoff, volumeType) for cutoff in doseCutoffV]
+        np.testing.assert_allclose(cumDVH.Vx(doseCutoffV, volumeType), refV)
+    percentV = [0.5, 5, 50, 95, 100]
+    refV = [dvh.Dx(doseBinsV, volsHistV, x, 1) for x in percentV]
+    np.testing.assert_allclose(cumDVH.Dx(percentV), refV)
+    refV = [dvh.MOHx(doseBinsV, volsHistV, x) for x in percentV]
+    np.testing.assert_allclose(cumDVH.MOHx(percentV), refV)
+    refV = [dvh.MOCx(doseBinsV, volsHistV, x) for x in percentV]
+    np.testing.assert_allclose(cumDVH.MOCx(percentV), refV)
+
+    # Scalar inputs return scalars
+    np.testing.assert_allclose(cumDVH.Dx(95), dvh.Dx(doseBinsV, volsHistV, 95, 1))
+    np.testing.assert_allclose(cumDVH.meanDose(), dvh.meanDose(doseBinsV, volsHistV))
+    np.testing.assert_allclose(cumDVH.minDose(), dvh.minDose(doseBinsV, volsHistV))
+    np.testing.assert_allclose(cumDVH.maxDose(), dvh.maxDose(doseBinsV, volsHistV, 100))
+    np.testing.assert_allclose(cumDVH.medianDose(), dvh.medianDose(doseBinsV, volsHistV))
+
+
+def test_dose_at_beyond_z_extent():
+    # 5 x 6 x 4 dose grid with unit spacing and slices at z = 0, 1, 2, 3
+    doseObj = rtds.Dose()
+    doseObj.doseArray = np.arange(120, dtype=float).reshape(5, 6, 4)
+    doseObj.sizeOfDimension1, doseObj.sizeOfDimension2, doseObj.sizeOfDimension3 = 6, 5, 4
+    doseObj.horizontalGridInterval, doseObj.verticalGridInterval = 1, -1
+    doseObj.coord1OFFirstPoint, doseObj.coord2OFFirstPoint = 0, 0
+    doseObj.zValues = np.array([0., 1, 2, 3])
+    xV, yV = np.array([2., 2]), np.array([-2., -2])
+
+    # Points beyond the first/last slice take its value. Without clamping z, finterp3
+    # indexes past the last slice for points within the padded z-extent.
+    firstV = doseObj.getDoseAt(xV, yV, np.array([0., -0.5]))
+    lastV = doseObj.getDoseAt(xV, yV, np.array([3., 3.5]))
+    np.testing.assert_allclose(firstV, firstV[0])
+    np.testing.assert_allclose(lastV, lastV[0])
+    np.testing.assert_allclose([firstV[0], lastV[0]], [56, 59], atol=1e-2)
+
+
+def test_dvh_from_dose_on_scan_cache():
+    planC = getPhantomWithDose()
+    structNum, doseNum = 0, 0
+    dose3M = planC.dose[doseNum].doseArray
+
+    dosesV, volsV, __ = dvh.getDVH(structNum, doseNum, planC)
+    cachedDosesV, cachedVolsV, __ = dvh.getDVH(structNum, doseNum, planC, useDoseOnScanCache=True)
+    np.testing.assert_allclose(cachedDosesV, dosesV, atol=1e-3)
+    np.testing.assert_allclose(cachedVolsV, volsV)
+
+    # Cached dose is refreshed when doseArray is replaced
+    planC.dose[doseNum].doseArray = 2 * dose3M
+    cachedDosesV, __, __ = dvh.getDVH(structNum, doseNum, planC, useDoseOnScanCache=True)
+    np.testing.assert_allclose(cachedDosesV, 2 * dosesV, atol=2e-3)
+    rtds.clearDoseOnScanCache()
+
+
+def test_dose_grid_dvh():
+    planC = pc.load_dcm_dir(dcm_dir)
+    siz = planC.scan[0].getScanSize()
+    structNum = 0
+
+    # Dose on the scan grid matches getDVH
+    dose3M = np.random.default_rng(0).uniform(0, 60, siz)
+    planC = addDose(dose3M, planC)
+    dosesV, volsV, __ = dvh.getDVH(structNum, 0, planC)
+    gridDosesV, gridVolsV, __ = dvh.getDoseGridDVH(structNum, 0, planC)
+    np.testing.assert_allclose(np.sum(gridVolsV), np.sum(volsV))
+    np.testing.assert_allclose(np.sum(gridDosesV * gridVolsV), np.sum(dosesV * volsV), rtol=1e-5)
+
+    # Partial volumes on a coarser dose grid add up to the structure volume
+    coarseSiz = [len(range(0, dimSiz, 2)) for dimSiz in siz]
+    planC = addDose(30 * np.ones(coarseSiz), planC, subsample=2)
+    gridDosesV, gridVolsV, __ = dvh.getDoseGridDVH(structNum, 1, planC)
+    np.testing.assert_allclose(np.sum(gridVolsV), np.sum(volsV))
+    np.testing.assert_allclose(gridDosesV, 30)
+
+
+def test_cached_dose_hist_invalidation(monkeypatch):
+    dvh.clearDVHCache()
+    planC = getPhantomWithDose()
+    structNum, doseNum, binWidth = 0, 0, 0.5
+    doseBinsV, volsHistV = dvh.getCachedDoseHist(structNum, doseNum, binWidth, planC)
+    dosesV, volsV, __ = dvh.getDVH(structNum, doseNum, planC)
+    refBinsV, refHistV = dvh.doseHist(dosesV, volsV, binWidth)
+    np.testing.assert_array_equal(doseBinsV, refBinsV)
+    np.testing.assert_array_equal(volsHistV, refHistV)
+
+    # Repeated calls are served from the cache
+    with monkeypatch.context() as m:
+        m.setattr(dvh, 'getDVH', failDVH)
+        cachedBinsV, __ = dvh.getCachedDoseHist(structNum, doseNum, binWidth, planC)
+    assert cachedBinsV is doseBinsV
+    assert len(dvh.dvhCache) == 1
+
+    # Replacing the dose recomputes the DVH and drops the stale entry
+    planC.dose[doseNum].doseArray = 2 * planC.dose[doseNum].doseArray
+    doubleBinsV, doubleHistV = dvh.getCachedDoseHist(structNum, doseNum, binWidth, planC)
+    np.testing.assert_allclose(np.sum(doubleBinsV * doubleHistV),
+                               2 * np.sum(doseBinsV * volsHistV), rtol=1e-4)
+    assert len(dvh.dvhCache) == 1
+
+    # Editing the structure recomputes the DVH
+    planC.structure[structNum].rasterSegments = planC.structure[structNum].rasterSegments[:-1, :]
+    __, editedHistV = dvh.getCachedDoseHist(structNum, doseNum, binWidth, planC)
+    assert np.sum(editedHistV) < np.sum(doubleHistV)
+    assert len(dvh.dvhCache) == 1
+
+    dvh.clearDVHCache(doseUID=planC.dose[doseNum].doseUID)
+    assert len(dvh.dvhCache) == 0
+
+
+def test_dvh_cache_h5_reload(tmp_path, monkeypatch):
+    dvh.clearDVHCache()
+    planC = getPhantomWithDose()
+    doseBinsV, volsHistV = dvh.getCachedDoseHist(0, 0, 0.5, planC)
+    h5File = os.path.join(tmp_path, 'planC.h5')
+    pc.saveToH5(planC, h5File, saveDVHCacheFlag=True)
+    dvh.clearDVHCache()
+
+    # Re-import assigns new UIDs, the cache is matched by contents
+    newPlanC = getPhantomWithDose()
+    assert newPlanC.structure[0].strUID != planC.structure[0].strUID
+    assert newPlanC.dose[0].doseUID != planC.dose[0].doseUID
+    pc.loadFromH5(h5File)
+    assert len(dvh.dvhCache) == 1
+    monkeypatch.setattr(dvh, 'getDVH', failDVH)
+    cachedBinsV, cachedHistV = dvh.getCachedDoseHist(0, 0, 0.5, newPlanC)
+    np.testing.assert_array_equal(cachedBinsV, doseBinsV)
+    np.testing.assert_array_equal(cachedHistV, volsHistV)
+    dvh.clearDVHCache()
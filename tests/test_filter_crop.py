@@ -0,0 +1,45 @@
+"""
+ This script checks that filter responses computed over the ROI bounding box plus kernel
+ support (fullMapFlag=False) match the full response map within the bounding box.
+"""
+
+import numpy as np
+import pytest
+from cerr.radiomics import textureUtils
+from cerr.utils.bbox import compute_boundingbox
+
+filterParamList = [
+    ('mean', {'KernelSize': [5, 5, 3]}),
+    ('mean', {'KernelSize': [3, 3]}),
+    ('LoG', {'Sigma_mm': [3, 3, 2], 'CutOff_mm': [12, 12, 8], 'VoxelSize_mm': [1.5, 1.5, 2]}),
+    ('laws', {'Direction': '3d', 'Type': 'E5L3S5', 'Normalize': 'no'}),
+    ('laws', {'Direction': '2d', 'Type': 'L5S5', 'Normalize': 'yes'}),
+    ('rotationInvariantLaws', {'Direction': '3d', 'Type': 'E3L3S3', 'Normalize': 'no',
+                               'RotationInvariance': {'Dim': '3d', 'AggregationMethod': 'max'}}),
+    ('wavelets', {'Wavelets': 'db', 'Index': 2, 'Direction': 'HLH', 'Level': 1}),
+    ('wavelets', {'Wavelets': 'haar', 'Direction': 'LLH', 'Level': 2}),
+    ('wavelets', {'Wavelets': 'coif', 'Index': 1, 'Direction': 'HH', 'Level': 1}),
+    ('rotationInvariantWavelets', {'Wavelets': 'db', 'Index': 2, 'Direction': 'HHH', 'Level': 1,
+                                   'RotationInvariance': {'Dim': '3d', 'AggregationMethod': 'avg'}}),
+]
+
+
+def getScanAndMask(roiSlc):
+    rng = np.random.default_rng(0)
+    scan3M = rng.normal(100, 30, (40, 36, 28))
+    mask3M = np.zeros(scan3M.shape, dtype=bool)
+    mask3M[roiSlc] = rng.uniform(size=mask3M[roiSlc].shape) < 0.7
+    return scan3M, mask3M
+
+
+@pytest.mark.parametrize("filterType, paramS", filterParamList)
+@pytest.mark.parametrize("roiSlc", [np.s_[12:25, 14:23, 10:17], np.s_[0:9, 30:36, 20:28]])
+def test_filter_roi_crop(filterType, paramS, roiSlc):
+    scan3M, mask3M = getScanAndMask(roiSlc)
+    minr, maxr, minc, maxc, mins, maxs, __ = compute_boundingbox(mask3M)
+    fullS = textureUtils.processImage(filterType, scan3M, mask3M, paramS)
+    cropS = textureUtils.processImage(filterType, scan3M, mask3M, paramS, fullMapFlag=False)
+    assert list(cropS.keys()) == list(fullS.keys())
+    for key in fullS:
+        ref3M = fullS[key][minr:maxr+1, minc:maxc+1, mins:maxs+1]
+        np.testing.assert_allclose(cropS[key], ref3M, atol=1e-9 * np.max(np.abs(ref3M)))
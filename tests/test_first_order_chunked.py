@@ -0,0 +1,41 @@
+"""
+ This script checks that first-order features computed by streaming slabs of the scan
+ match those computed from all ROI voxels at once.
+"""
+
+import numpy as np
+from cerr.radiomics import first_order
+
+
+def getScanAndMask(floatFlag, siz=(40, 40, 37)):
+    rng = np.random.default_rng(0)
+    if floatFlag:
+        scan3M = rng.normal(40, 120, siz)
+    else:
+        scan3M = rng.integers(-1000, 1000, siz).astype(float)
+    rV, cV, sV = np.meshgrid(*[np.linspace(-1, 1, dimSiz) for dimSiz in siz], indexing='ij')
+    mask3M = rV**2 + cV**2 + sV**2 <= 0.8
+    return scan3M, mask3M
+
+
+def compareFeatures(floatFlag, rtol, **chunkedParams):
+    scan3M, mask3M = getScanAndMask(floatFlag)
+    voxelVol = 0.5
+    refS = first_order.radiomics_first_order_stats(scan3M[mask3M], voxelVol, 1000, 25)
+    featS = first_order.radiomics_first_order_stats_chunked(scan3M, mask3M, voxelVol, 1000, 25,
+                                                            slicesPerChunk=8, **chunkedParams)
+    assert set(featS.keys()) == set(refS.keys())
+    for feat in refS:
+        np.testing.assert_allclose(featS[feat], refS[feat], rtol=rtol, atol=1e-8, err_msg=feat)
+
+
+def test_chunked_first_order_integer():
+    compareFeatures(False, 1e-10)
+
+
+def test_chunked_first_order_float_exact():
+    compareFeatures(True, 1e-10, histNumBins=None)
+
+
+def test_chunked_first_order_float_binned():
+    compareFeatures(True, 1e-3)
@@ -0,0 +1,44 @@
+"""
+ This script checks that Gabor filter responses computed in the frequency domain match
+ slice-wise spatial convolution with the Gabor kernel.
+"""
+
+import numpy as np
+import pytest
+from scipy.signal import convolve2d
+from cerr.radiomics import textureFilters
+
+
+def getSpatialResponse(scan3M, hGaborEven, hGaborOdd):
+    h = hGaborEven + 1j * hGaborOdd
+    out3M = np.zeros(scan3M.shape)
+    for slc in range(scan3M.shape[2]):
+        out3M[:, :, slc] = np.abs(convolve2d(scan3M[:, :, slc], h, mode='same', boundary='fill', fillvalue=0))
+    return out3M
+
+
+@pytest.mark.parametrize("radius", [np.array([6, 9]), np.array([6.5, 9]), None])
+def test_gabor_orientations(radius):
+    scan3M = np.random.default_rng(0).normal(size=(31, 26, 4))
+    thetaV = np.array([0, 45, 112.5])
+    outS, hGabor = textureFilters.gaborFilter(scan3M, 3, 4, 1.5, thetaV, radius=radius, paddingV=[2, 2, 0])
+    assert list(outS.keys()) == [f'gabor_{theta}' for theta in thetaV]
+    for fieldName in outS:
+        ref3M = getSpatialResponse(scan3M, hGabor['even'][fieldName], hGabor['odd'][fieldName])
+        np.testing.assert_allclose(outS[fieldName], ref3M, atol=1e-10 * np.max(ref3M))
+
+
+@pytest.mark.parametrize("aggMethod, aggFun", [('max', np.max), ('average', np.mean), ('std', np.std)])
+def test_gabor_orientation_aggregation(aggMethod, aggFun):
+    scan3M = np.random.default_rng(0).normal(size=(31, 26, 4))
+    thetaV = np.array([0, 60, 120])
+    radius = np.array([7, 7])
+    outS, hGabor = textureFilters.gaborFilter(scan3M, 2.5, 5, 1, thetaV, {'OrientationAggregation': aggMethod},
+                                              radius)
+    refList = [getSpatialResponse(scan3M, hGabor['even'][fieldName], hGabor['odd'][fieldName])
+               for fieldName in hGabor['even']]
+    np.testing.assert_allclose(outS['gabor_0_60_120_' + aggMethod], aggFun(refList, axis=0),
+                               atol=1e-10 * np.max(refList))
+
+    with pytest.raises(ValueError):
+        textureFilters.gaborFilter(scan3M, 2.5, 5, 1, thetaV, {'OrientationAggregation': 'median'}, radius)
@@ -0,0 +1,75 @@
+"""
+ This script checks that GLCM features computed from sparse co-occurrence matrices
+ match those computed from dense matrices, and that ibsi1 uses sparse matrices only
+ when requested in the settings.
+"""
+
+import os
+import json
+import numpy as np
+from cerr import plan_container
+from cerr.radiomics import ibsi1
+from cerr.radiomics import gray_level_cooccurence
+from cerr.radiomics.ibsi1 import getDirectionOffsets
+
+currPath = os.path.abspath(__file__)
+cerrPath = os.path.join(os.path.dirname(os.path.dirname(currPath)),'cerr')
+dataPath = os.path.join(cerrPath, 'datasets', 'radiomics_phantom_dicom', 'PAT1')
+settingsPath = os.path.join(cerrPath, 'datasets','radiomics_settings', 'IBSIsettings','IBSI1')
+
+
+def getQuantizedROI(nL, siz=(24, 24, 12)):
+    """ Random quantized image with levels 1..nL within a spherical ROI and 0 outside """
+    rng = np.random.default_rng(0)
+    quantized3M = rng.integers(1, nL + 1, siz)
+    rV, cV, sV = np.meshgrid(*[np.linspace(-1, 1, dimSiz) for dimSiz in siz], indexing='ij')
+    quantized3M[rV**2 + cV**2 + sV**2 > 1] = 0
+    return quantized3M
+
+
+def compareFeatures(nL, cooccurType, direction):
+    quantized3M = getQuantizedROI(nL)
+    offsetsM = getDirectionOffsets(direction)
+    denseM = gray_level_cooccurence.calcCooccur(quantized3M, offsetsM, nL, cooccurType)
+    sparseM = gray_level_cooccurence.calcCooccur(quantized3M, offsetsM, nL, cooccurType, sparseFlag=True)
+    assert isinstance(denseM, np.ndarray)
+    np.testing.assert_allclose(sparseM.toarray(), denseM, atol=1e-7)
+
+    # Dense matrix is accumulated in single precision, so features are compared on the same matrix
+    denseFeatS = gray_level_cooccurence.cooccurToScalarFeatures(sparseM.toarray())
+    sparseFeatS = gray_level_cooccurence.cooccurToScalarFeatures(sparseM)
+    for feat in gray_level_cooccurence.glcmFeatureNames:
+        np.testing.assert_allclose(sparseFeatS[feat], denseFeatS[feat], rtol=1e-6, atol=1e-9, err_msg=feat)
+
+
+def test_sparse_glcm_merged():
+    compareFeatures(32, 1, 1)
+
+
+def test_sparse_glcm_per_offset():
+    compareFeatures(32, 2, 2)
+
+
+def test_sparse_glcm_many_levels():
+    compareFeatures(300, 1, 1)
+
+
+def test_sparse_glcm_settings(tmp_path):
+    planC = plan_container.load_dcm_dir(dataPath)
+    with open(os.path.join(settingsPath, 'IBSI1IDB1.json')) as settingsFid:
+        settingS = json.load(settingsFid)
+    settingS['featureClass'] = {'glcm': {'featureList': ['all']}}
+    settingsFile = str(tmp_path / 'dense.json')
+    with open(settingsFile, 'w') as settingsFid:
+        json.dump(settingS, settingsFid)
+    denseFeatS, __ = ibsi1.computeScalarFeatures(0, 0, settingsFile, planC)
+
+    settingS['settings']['texture']['sparseCooccur'] = 'yes'
+    settingsFile = str(tmp_path / 'sparse.json')
+    with open(settingsFile, 'w') as settingsFid:
+        json.dump(settingS, settingsFid)
+    sparseFeatS, __ = ibsi1.computeScalarFeatures(0, 0, settingsFile, planC)
+
+    assert denseFeatS.keys() == sparseFeatS.keys()
+    for feat in denseFeatS:
+        np.testing.assert_allclose(sparseFeatS[feat], denseFeatS[feat], rtol=1e-4, atol=1e-6, err_msg=feat)
@@ -0,0 +1,51 @@
+"""
+ This script checks GLCM sum entropy with and without the i+j=2 term against
+ hand-computed values and the IBSI1 reference value (configuration B).
+
+ Dataset: https://github.com/theibsi/data_sets/tree/master/ibsi_1_ct_radiomics_phantom
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from cerr import plan_container
+from cerr.radiomics import ibsi1
+from cerr.radiomics import gray_level_cooccurence
+
+currPath = os.path.abspath(__file__)
+cerrPath = os.path.join(os.path.dirname(os.path.dirname(currPath)),'cerr')
+dataPath = os.path.join(cerrPath, 'datasets', 'radiomics_phantom_dicom', 'PAT1')
+settingsPath = os.path.join(cerrPath, 'datasets','radiomics_settings', 'IBSIsettings','IBSI1')
+refPath = os.path.join(cerrPath, 'datasets', 'referenceValuesForTests', 'IBSI1')
+
+
+def getRefVal(config, tag):
+    refData = pd.read_csv(os.path.join(refPath, 'IBSI1_CERR_features_config' + config + '.csv'))
+    matchIdx = list(refData['tag']).index(tag)
+    return refData['benchmark_value'][matchIdx], refData['tolerance'][matchIdx]
+
+
+def test_sum_entropy_hand_computed(monkeypatch):
+    # p(1,1) = 0.5, p(1,2) = p(2,1) = 0.25, so that p(x+y=2) = p(x+y=3) = 0.5
+    cooccurM = np.array([[0.5], [0.25], [0.25], [0]])
+    featS = gray_level_cooccurence.cooccurToScalarFeatures(cooccurM)
+    np.testing.assert_allclose(featS['sumEntropy'], 0.5, atol=1e-12)
+    monkeypatch.setattr(gray_level_cooccurence, 'sumEntropyExcludeLowestSum', False)
+    featS = gray_level_cooccurence.cooccurToScalarFeatures(cooccurM)
+    np.testing.assert_allclose(featS['sumEntropy'], 1, atol=1e-12)
+
+
+def test_sum_entropy_ibsi_reference(monkeypatch):
+    planC = plan_container.load_dcm_dir(dataPath)
+    settingsFile = os.path.join(settingsPath, 'IBSI1IDB1.json')
+    refVal, tol = getRefVal('B', 'cm_sum_entr_2_5D_comb')
+    featName = 'original_cm_sum_entr_2_5D_comb'
+
+    calcFeatS, __ = ibsi1.computeScalarFeatures(0, 0, settingsFile, planC)
+    np.testing.assert_allclose(calcFeatS[featName], 3.909, atol=5e-4)
+    np.testing.assert_allclose(calcFeatS[featName], refVal, atol=tol)
+
+    monkeypatch.setattr(gray_level_cooccurence, 'sumEntropyExcludeLowestSum', False)
+    calcFeatS, __ = ibsi1.computeScalarFeatures(0, 0, settingsFile, planC)
+    np.testing.assert_allclose(calcFeatS[featName], 3.914, atol=5e-4)
+    np.testing.assert_allclose(calcFeatS[featName], refVal, atol=tol)
@@ -0,0 +1,53 @@
+"""
+ This script checks the selection of Laws masks by getLawsMasks, and that Laws filter
+ responses computed from shared 1-D passes match convolution with each mask.
+"""
+
+import numpy as np
+import pytest
+from scipy.signal import convolve, convolve2d
+from cerr.radiomics import textureFilters
+
+
+@pytest.mark.parametrize("direction, filterType, numMasks", [('2d', '3', 8), ('2d', '5', 25),
+                                                            ('3d', '3', 27), ('3d', '5', 125),
+                                                            ('all', '3', 35), ('all', '5', 150)])
+def test_laws_mask_selection(direction, filterType, numMasks):
+    lawsMasks = textureFilters.getLawsMasks(direction, filterType)
+    assert len(lawsMasks) == numMasks
+    assert all(len(name) == 4 for name in lawsMasks) == (direction == '2d')
+
+
+def test_laws_all_masks():
+    # 'all' selects both the length 3 and length 5 masks, in any case
+    for direction in ['2d', '3d', 'all', 'All']:
+        maskNames = set(textureFilters.getLawsMasks(direction, '3')) | \
+                    set(textureFilters.getLawsMasks(direction, '5'))
+        for filterType in ['all', 'ALL', 'All']:
+            assert set(textureFilters.getLawsMasks(direction, filterType)) == maskNames
+
+    lawsMasks = textureFilters.getLawsMasks('3d', 'l3e5s3')
+    assert list(lawsMasks.keys()) == ['L3E5S3']
+    assert lawsMasks['L3E5S3'].shape == (5, 3, 3)
+
+
+def getMaskResponse(scan3M, lawsMask):
+    if lawsMask.ndim == 3:
+        return convolve(scan3M, lawsMask.astype(float), mode='same')
+    response3M = np.empty_like(scan3M)
+    for slc in range(scan3M.shape[2]):
+        response3M[:, :, slc] = convolve2d(scan3M[:, :, slc], lawsMask, mode='same')
+    return response3M
+
+
+@pytest.mark.parametrize("direction, filterDim, normFlag", [('all', 'all', False), ('3d', '5', True),
+                                                            ('2d', '3', True), ('3d', 'E5L3S5', False),
+                                                            ('2d', 'L5W5', False)])
+def test_laws_shared_passes(direction, filterDim, normFlag):
+    scan3M = np.random.default_rng(0).normal(size=(12, 11, 9))
+    lawsMasks = textureFilters.getLawsMasks(direction, filterDim, normFlag)
+    outS = textureFilters.lawsFilter(scan3M, direction, filterDim, normFlag)
+    assert list(outS.keys()) == list(lawsMasks.keys())
+    for fieldName, lawsMask in lawsMasks.items():
+        ref3M = getMaskResponse(scan3M, lawsMask)
+        np.testing.assert_allclose(outS[fieldName], ref3M, atol=1e-6 * np.max(np.abs(ref3M)))
@@ -0,0 +1,35 @@
+"""
+ This script checks that radiomic features computed for several image types in parallel
+ match those computed serially.
+
+ Dataset: https://github.com/theibsi/data_sets/tree/master/ibsi_1_ct_radiomics_phantom
+"""
+
+import os
+import json
+import numpy as np
+from cerr import plan_container
+from cerr.radiomics import ibsi1
+
+currPath = os.path.abspath(__file__)
+cerrPath = os.path.join(os.path.dirname(os.path.dirname(currPath)),'cerr')
+dataPath = os.path.join(cerrPath, 'datasets', 'radiomics_phantom_dicom', 'PAT1')
+settingsPath = os.path.join(cerrPath, 'datasets','radiomics_settings', 'IBSIsettings','IBSI1')
+
+
+def test_parallel_image_types(tmp_path):
+    planC = plan_container.load_dcm_dir(dataPath)
+    with open(os.path.join(settingsPath, 'IBSI1IDB1.json')) as settingsFid:
+        settingS = json.load(settingsFid)
+    settingS['imageType'] = {'Original': {},
+                             'Mean': [{'KernelSize': [3, 3, 1]}, {'KernelSize': [5, 5, 1]}]}
+    settingsFile = os.path.join(tmp_path, 'parallel.json')
+    with open(settingsFile, 'w') as settingsFid:
+        json.dump(settingS, settingsFid)
+
+    serialFeatS, __ = ibsi1.computeScalarFeatures(0, 0, settingsFile, planC)
+    parallelFeatS, __ = ibsi1.computeScalarFeatures(0, 0, settingsFile, planC, numWorkers=2)
+    assert list(parallelFeatS.keys()) == list(serialFeatS.keys())
+    assert any(featName.startswith('mean_') for featName in serialFeatS)
+    for featName in serialFeatS:
+        np.testing.assert_allclose(parallelFeatS[featName], serialFeatS[featName], rtol=1e-12)
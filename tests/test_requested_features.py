@@ -0,0 +1,59 @@
+"""
+ This script checks that features requested by name in the settings file match those
+ computed with featureList ["all"].
+
+ Dataset: https://github.com/theibsi/data_sets/tree/master/ibsi_1_ct_radiomics_phantom
+"""
+
+import os
+import re
+import json
+import numpy as np
+import pytest
+from cerr import plan_container
+from cerr.radiomics import ibsi1
+
+currPath = os.path.abspath(__file__)
+cerrPath = os.path.join(os.path.dirname(os.path.dirname(currPath)),'cerr')
+dataPath = os.path.join(cerrPath, 'datasets', 'radiomics_phantom_dicom', 'PAT1')
+settingsPath = os.path.join(cerrPath, 'datasets','radiomics_settings', 'IBSIsettings','IBSI1')
+
+
+def writeSettings(featureClassS, settingsFile):
+    with open(os.path.join(settingsPath, 'IBSI1IDB1.json')) as settingsFid:
+        settingS = json.load(settingsFid)
+    settingS['featureClass'] = featureClassS
+    with open(settingsFile, 'w') as settingsFid:
+        json.dump(settingS, settingsFid)
+    return settingsFile
+
+
+def test_requested_features(tmp_path):
+    planC = plan_container.load_dcm_dir(dataPath)
+    allFeatS, __ = ibsi1.computeScalarFeatures(0, 0, os.path.join(settingsPath, 'IBSI1IDB1.json'), planC)
+
+    # Features by CERR or IBSI name; glszm and gldm are skipped
+    featureClassS = {'shape': {'featureList': ['volume', 'diam', 'sphericity']},
+                     'firstOrder': {'featureList': ['std']},
+                     'glcm': {'featureList': ['jointEntropy', 'contrast']},
+                     'glrlm': {'featureList': ['sre']},
+                     'glszm': {'featureList': []},
+                     'gtdm': {'featureList': ['coarseness']}}
+    settingsFile = writeSettings(featureClassS, os.path.join(tmp_path, 'requested.json'))
+    featS, __ = ibsi1.computeScalarFeatures(0, 0, settingsFile, planC)
+
+    ibsiNameS = {'morph': ['vol_approx', 'diam', 'sphericity'], 'stat': ['std'],
+                 'cm': ['joint_entr', 'contrast'], 'rlm': ['sre'], 'szm': [], 'ngl': [], 'ngt': ['coarseness']}
+    for featClass, nameList in ibsiNameS.items():
+        expectedList = [feat for feat in allFeatS if any(
+            re.match('original_' + featClass + '_' + name + r'($|_\d)', feat) for name in nameList)]
+        classFeatList = [feat for feat in featS if feat.startswith('original_' + featClass + '_')]
+        assert classFeatList == expectedList
+        assert len(expectedList) >= len(nameList)
+        for feat in classFeatList:
+            np.testing.assert_allclose(featS[feat], allFeatS[feat], rtol=1e-12)
+
+    featureClassS['glrlm'] = {'featureList': ['shortRunEmph']}
+    settingsFile = writeSettings(featureClassS, os.path.join(tmp_path, 'invalid.json'))
+    with pytest.raises(ValueError):
+        ibsi1.computeScalarFeatures(0, 0, settingsFile, planC)
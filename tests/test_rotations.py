@@ -0,0 +1,26 @@
+"""
+ This script checks exact right-angle rotations used for rotation-invariant filtering
+ against interpolated rotations, and that rotate3dSequence is inverted by the
+ opposite sign.
+"""
+
+import numpy as np
+import pytest
+from scipy.ndimage import rotate
+from cerr.radiomics import textureFilters
+
+
+@pytest.mark.parametrize("axis", [1, 2, 3])
+def test_rot3d90(axis):
+    vol3M = np.random.default_rng(0).normal(size=(7, 7, 7))
+    for angle in [-270, -180, -90, 0, 90, 180, 270]:
+        refVol3M = rotate(vol3M, angle, axes=(axis % 3, (axis + 1) % 3), reshape=False)
+        np.testing.assert_allclose(textureFilters.rot3d90(vol3M, axis, angle), refVol3M, atol=1e-12)
+
+
+def test_rotate3d_sequence_inverse():
+    vol3M = np.random.default_rng(0).normal(size=(6, 5, 4))
+    for index in range(24):
+        rotVol3M = textureFilters.rotate3dSequence(vol3M, index, 1)
+        assert sorted(rotVol3M.shape) == sorted(vol3M.shape)
+        np.testing.assert_array_equal(textureFilters.rotate3dSequence(rotVol3M, index, -1), vol3M)
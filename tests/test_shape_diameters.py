@@ -0,0 +1,60 @@
+"""
+ This script checks maximum diameters computed from convex hull vertices against
+ the maximum over all pairwise distances.
+"""
+
+import numpy as np
+from scipy.spatial.distance import pdist
+from cerr.radiomics import shape
+
+
+def getBlobMask(siz=(30, 28, 20), seed=0):
+    rng = np.random.default_rng(seed)
+    rV, cV, sV = np.meshgrid(*[np.linspace(-1, 1, dimSiz) for dimSiz in siz], indexing='ij')
+    radius3M = np.sqrt(rV**2 + (cV / 0.8)**2 + (sV / 0.6)**2)
+    return radius3M < 0.7 + 0.2 * rng.uniform(size=siz)
+
+
+def test_max_pairwise_distance():
+    rng = np.random.default_rng(0)
+    ptsList = [rng.normal(size=(500, 3)),
+               rng.normal(size=(500, 2)),
+               rng.uniform(size=(20, 3)),
+               np.column_stack((rng.uniform(size=(200, 2)), np.ones(200))),   # coplanar
+               np.outer(rng.uniform(size=200), [1, 2, 3]),                     # collinear
+               np.zeros((3, 3))]
+    for ptsM in ptsList:
+        refDist = np.max(pdist(ptsM))
+        np.testing.assert_allclose(shape.getMaxPairwiseDistance(ptsM), refDist, rtol=1e-12)
+        np.testing.assert_allclose(shape.getMaxPairwiseDistance(ptsM, maxChunkSize=7), refDist, rtol=1e-12)
+    assert shape.getMaxPairwiseDistance(np.ones((1, 3))) == 0
+
+
+def test_max3d_diameter(monkeypatch):
+    mask3M = getBlobMask()
+    xV, yV, zV = np.arange(28) * 0.1, -np.arange(30) * 0.08, np.arange(20) * 0.25
+    featureList = ['max3dDiameter']
+    shapeS = shape.compute_shape_features(mask3M, xV, yV, zV, featureList)
+    # Search all mesh vertices
+    monkeypatch.setattr(shape, 'minPointsForHull', np.inf)
+    refS = shape.compute_shape_features(mask3M, xV, yV, zV, featureList)
+    np.testing.assert_allclose(shapeS['max3dDiameter'], refS['max3dDiameter'], rtol=1e-12)
+
+
+def test_max2d_diameters(monkeypatch):
+    rng = np.random.default_rng(0)
+    ptsM = rng.normal(size=(1000, 2))
+    planeV = rng.integers(0, 5, 1000)
+    refDist = max(np.max(pdist(ptsM[planeV == plane])) for plane in range(5))
+    np.testing.assert_allclose(shape.getMaxPlanarDiameter(ptsM, planeV), refDist, rtol=1e-12)
+
+    mask3M = getBlobMask()
+    xV, yV, zV = np.arange(28) * 0.1, -np.arange(30) * 0.08, np.arange(20) * 0.25
+    featureList = shape.diameter2dFeatureNames
+    shapeS = shape.compute_shape_features(mask3M, xV, yV, zV, featureList)
+    # Search all surface points of each plane
+    monkeypatch.setattr(shape, 'minPointsForHull', np.inf)
+    refS = shape.compute_shape_features(mask3M, xV, yV, zV, featureList)
+    assert list(shapeS.keys()) == featureList
+    for feat in featureList:
+        np.testing.assert_allclose(shapeS[feat], refS[feat], rtol=1e-12)
@@ -0,0 +1,204 @@
+"""
+ This script checks texture matrices against brute-force implementations of their
+ definitions on small random volumes, and that sharing a TextureContext across
+ feature families leaves them unchanged.
+"""
+
+import numpy as np
+import pytest
+from cerr.radiomics import ibsi1, run_length, size_zone, neighbor_gray_tone, \
+    neighbor_gray_level_dependence, gray_level_cooccurence
+from cerr.radiomics.texture_context import TextureContext, getLineOrderIndices
+
+
+def getRandomLevels(nL, siz=(9, 10, 6), seed=0):
+    """ Random levels 1..nL within an irregular ROI, 0 outside """
+    rng = np.random.default_rng(seed)
+    q3M = rng.integers(1, nL + 1, siz)
+    # Spatially correlated levels so that runs and zones of several voxels occur
+    q3M[1::2, :, :] = q3M[:-1:2, :, :]
+    q3M[rng.uniform(size=siz) < 0.15] = 0
+    q3M[0, :, :] = 0
+    return q3M
+
+
+def isInside(posV, siz):
+    return all(0 <= posV[dim] < siz[dim] for dim in range(len(siz)))
+
+
+def bruteForceRLM(q3M, offset, nL, maxRunLen):
+    rlmM = np.zeros((nL, maxRunLen))
+    siz = q3M.shape
+    for posV in np.ndindex(siz):
+        level = q3M[posV]
+        prevV = tuple(np.subtract(posV, offset))
+        if level == 0 or (isInside(prevV, siz) and q3M[prevV] == level):
+            continue
+        runLen = 1
+        nextV = tuple(np.add(posV, offset))
+        while isInside(nextV, siz) and q3M[nextV] == level:
+            runLen += 1
+            nextV = tuple(np.add(nextV, offset))
+        rlmM[level - 1, runLen - 1] += 1
+    return rlmM
+
+
+def bruteForceSZM(q3M, nL, szmType):
+    siz = q3M.shape
+    sliceSteps = [-1, 0, 1] if szmType == 1 else [0]
+    stepList = [(i, j, k) for i in [-1, 0, 1] for j in [-1, 0, 1] for k in sliceSteps
+                if (i, j, k) != (0, 0, 0)]
+    visitedM = np.zeros(siz, dtype=bool)
+    zoneList = []
+    for posV in np.ndindex(siz):
+        level = q3M[posV]
+        if level == 0 or visitedM[posV]:
+            continue
+        # Flood fill the zone
+        visitedM[posV] = True
+        stack = [posV]
+        zoneSize = 0
+        while stack:
+            currV = stack.pop()
+            zoneSize += 1
+            for step in stepList:
+                nextV = tuple(np.add(currV, step))
+                if isInside(nextV, siz) and not visitedM[nextV] and q3M[nextV] == level:
+                    visitedM[nextV] = True
+                    stack.append(nextV)
+        zoneList.append((level, zoneSize))
+    szmM = np.zeros((nL, max(zoneSize for __, zoneSize in zoneList)))
+    for level, zoneSize in zoneList:
+        szmM[level - 1, zoneSize - 1] += 1
+    return szmM
+
+
+def getNeighborLevels(q3M, posV, patchSizeV):
+    """ Levels of ROI voxels within the patch around posV, excluding posV """
+    siz = q3M.shape
+    rangeList = [range(max(0, posV[dim] - patchSizeV[dim]), min(siz[dim], posV[dim] + patchSizeV[dim] + 1))
+                 for dim in range(3)]
+    levelList = [q3M[i, j, k] for i in rangeList[0] for j in rangeList[1] for k in rangeList[2]
+                 if (i, j, k) != tuple(posV) and q3M[i, j, k] > 0]
+    return np.array(levelList)
+
+
+def bruteForceNGTDM(q3M, patchSizeV, nL):
+    s = np.zeros((nL, 1))
+    Nvc = 0
+    for posV in zip(*np.nonzero(q3M)):
+        nbLevV = getNeighborLevels(q3M, posV, patchSizeV)
+        if len(nbLevV) == 0:
+            continue
+        Nvc += 1
+        s[q3M[posV] - 1, 0] += np.abs(q3M[posV] - np.mean(nbLevV))
+    p = np.bincount(q3M[q3M > 0] - 1, minlength=nL)[:, None] / Nvc
+    return s, p, Nvc
+
+
+def bruteForceNGLDM(q3M, patchSizeV, nL, a):
+    maxNbhoodSize = np.prod(2 * np.array(patchSizeV) + 1) - 1
+    s = np.zeros((nL, maxNbhoodSize + 1))
+    for posV in zip(*np.nonzero(q3M)):
+        nbLevV = getNeighborLevels(q3M, posV, patchSizeV)
+        s[q3M[posV] - 1, np.sum(np.abs(nbLevV - q3M[posV]) <= a)] += 1
+    return s
+
+
+@pytest.mark.parametrize("direction", [1, 2])
+def test_run_length_matrix(direction):
+    nL = 4
+    q3M = getRandomLevels(nL)
+    offsetsM = ibsi1.getDirectionOffsets(direction)
+    rlmList = run_length.calcRLM(q3M, offsetsM, nL, rlmType=2)
+    for offset, rlmM in zip(offsetsM, rlmList):
+        np.testing.assert_array_equal(rlmM, bruteForceRLM(q3M, offset, nL, rlmM.shape[1]))
+    np.testing.assert_array_equal(run_length.calcRLM(q3M, offsetsM, nL, rlmType=1),
+                                  np.sum(rlmList, axis=0))
+
+
+@pytest.mark.parametrize("szmType", [1, 2])
+def test_size_zone_matrix(szmType):
+    nL = 4
+    q3M = getRandomLevels(nL)
+    np.testing.assert_array_equal(size_zone.calcSZM(q3M, nL, szmType), bruteForceSZM(q3M, nL, szmType))
+    # Levels absent from the ROI have empty rows
+    q3M[q3M == 2] = 3
+    szmM = size_zone.calcSZM(q3M, nL, szmType)
+    np.testing.assert_array_equal(szmM, bruteForceSZM(q3M, nL, szmType))
+    assert not np.any(szmM[1, :])
+
+
+@pytest.mark.parametrize("patchSizeV", [[1, 1, 1], [1, 1, 0], [2, 1, 1]])
+def test_neighborhood_gray_tone_difference_matrix(patchSizeV):
+    nL = 5
+    q3M = getRandomLevels(nL)
+    # Voxel without neighbours within a [1, 1, 1] patch
+    q3M[3:6, 4:7, 2:5] = 0
+    q3M[4, 5, 3] = 5
+    s, p, Nvc = neighbor_gray_tone.calcNGTDM(q3M, patchSizeV, nL)
+    sRef, pRef, NvcRef = bruteForceNGTDM(q3M, patchSizeV, nL)
+    assert Nvc == NvcRef
+    if patchSizeV == [1, 1, 1]:
+        assert Nvc < np.sum(q3M > 0)
+    np.testing.assert_allclose(s, sRef, rtol=1e-12)
+    np.testing.assert_allclose(p, pRef, rtol=1e-12)
+
+
+@pytest.mark.parametrize("patchSizeV, a", [([1, 1, 1], 0), ([1, 1, 1], 1), ([1, 1, 0], 0), ([2, 1, 1], 2)])
+def test_neighborhood_gray_level_dependence_matrix(patchSizeV, a, monkeypatch):
+    nL = 5
+    q3M = getRandomLevels(nL)
+    sRef = bruteForceNGLDM(q3M, patchSizeV, nL, a)
+    np.testing.assert_array_equal(neighbor_gray_level_dependence.calcNGLDM(q3M, patchSizeV, nL, a), sRef)
+    # Indicator images of one level at a time
+    monkeypatch.setattr(neighbor_gray_level_dependence, 'maxChunkVoxels', 1)
+    np.testing.assert_array_equal(neighbor_gray_level_dependence.calcNGLDM(q3M, patchSizeV, nL, a), sRef)
+
+
+def test_line_order_indices():
+    siz = (4, 5, 3)
+    offsetsM = ibsi1.getDirectionOffsets(1)
+    for offset in np.concatenate((offsetsM, -offsetsM, [[2, 0, 1]])):
+        orderedIndV, lineStartV = getLineOrderIndices(siz, offset)
+        # Every voxel is visited once, along lines stepping by offset
+        np.testing.assert_array_equal(np.sort(orderedIndV), np.arange(np.prod(siz)))
+        subM = np.array(np.unravel_index(orderedIndV, siz)).T
+        stepM = np.diff(subM, axis=0)[~lineStartV[1:]]
+        assert np.all(stepM == offset)
+        # Lines start where the predecessor is outside the volume
+        prevM = subM[lineStartV] - offset
+        assert not np.any(np.all((prevM >= 0) & (prevM < siz), axis=1))
+
+
+def getTextureMatrices(q3M, nL, textureContext=None):
+    offsetsM = ibsi1.getDirectionOffsets(1)
+    return [gray_level_cooccurence.calcCooccur(q3M, offsetsM, nL, 1, textureContext=textureContext),
+            run_length.calcRLM(q3M, offsetsM, nL, 1, textureContext=textureContext),
+            size_zone.calcSZM(q3M, nL, 1, textureContext=textureContext),
+            neighbor_gray_level_dependence.calcNGLDM(q3M, [1, 1, 1], nL, 0, textureContext=textureContext),
+            *neighbor_gray_tone.calcNGTDM(q3M, [1, 1, 1], nL, textureContext=textureContext)]
+
+
+def test_shared_texture_context():
+    nL = 5
+    q3M = getRandomLevels(nL)
+    refList = getTextureMatrices(q3M, nL)
+    texContext = TextureContext(q3M, nL)
+    for matList in [getTextureMatrices(q3M, nL, texContext), getTextureMatrices(q3M, nL, texContext)]:
+        for mat, refMat in zip(matList, refList):
+            np.testing.assert_array_equal(mat, refMat)
+
+    # Voxels outside the ROI (level 0, or NaN in TextureContext) around the bounding box
+    # do not change the matrices
+    pad3M = np.pad(q3M.astype(float), 3, mode='constant', constant_values=0)
+    nanPad3M = pad3M.copy()
+    nanPad3M[:2, :, :] = np.nan
+    np.testing.assert_array_equal(TextureContext(nanPad3M, nL).quantized3M, q3M[1:, :, :])
+    for matList in [getTextureMatrices(pad3M, nL), getTextureMatrices(nanPad3M, nL, TextureContext(nanPad3M, nL))]:
+        for mat, refMat in zip(matList, refList):
+            if mat.ndim == 2 and mat.shape[1] > refMat.shape[1]:
+                # Run length matrices are sized by the volume
+                assert not np.any(mat[:, refMat.shape[1]:])
+                mat = mat[:, :refMat.shape[1]]
+            np.testing.assert_array_equal(mat, refMat)
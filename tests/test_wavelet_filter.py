@@ -0,0 +1,67 @@
+"""
+ This script checks sub-bands of the stationary wavelet filter against pywt.swtn
+ at voxels unaffected by boundary handling, and rotation-invariant responses against
+ pooling over all 24 right-angle rotations of the scan.
+"""
+
+from itertools import permutations, product
+import numpy as np
+import pywt
+import pytest
+from cerr.radiomics import textureFilters
+
+
+def getInterior(arr3M, margin):
+    return arr3M[margin:-margin, margin:-margin, margin:-margin]
+
+
+@pytest.mark.parametrize("level", [1, 2])
+@pytest.mark.parametrize("waveletName", ['haar', 'db2', 'coif1'])
+def test_wavelet_subbands(waveletName, level):
+    scan3M = np.random.default_rng(0).normal(0, 100, (48, 44, 40))
+    subbandS = textureFilters.getWaveletSubbands(scan3M, waveletName, level)
+
+    # pywt.swtn uses periodic extension. Sub-band letters refer to x (cols), y (rows), z (slices).
+    refS = pywt.swtn(scan3M, waveletName, level=level, axes=(1, 0, 2))[0]
+    filtLen = pywt.Wavelet(waveletName).dec_len
+    margin = (filtLen - 1) * (2 ** level - 1)
+    assert len(subbandS) == 8
+    for subband, out3M in subbandS.items():
+        ref3M = refS[subband.replace('L', 'a').replace('H', 'd')]
+        np.testing.assert_allclose(getInterior(out3M, margin), getInterior(ref3M, margin),
+                                   atol=1e-8, err_msg=subband)
+
+
+def test_wavelet_filter_response():
+    scan3M = np.random.default_rng(0).normal(0, 100, (24, 24, 24))
+    outS = textureFilters.waveletFilter(scan3M, 'db2', 'LHL', level=2)
+    subbandS = textureFilters.getWaveletSubbands(scan3M, 'db2', 2, subbandList=['LHL'])
+    np.testing.assert_allclose(outS['db2_LHL'], subbandS['LHL'])
+
+
+def getRightAngleRotations():
+    """ Axis permutations and flips of the 24 proper right-angle rotations """
+    for permV in permutations(range(3)):
+        parity = np.linalg.det(np.eye(3)[list(permV)])
+        for flipV in product([0, 1], repeat=3):
+            if parity * (-1) ** sum(flipV) > 0:
+                yield permV, tuple(axis for axis in range(3) if flipV[axis])
+
+
+@pytest.mark.parametrize("aggregationMethod", ['avg', 'max', 'std'])
+def test_rotation_invariant_wavelet(aggregationMethod):
+    scan3M = np.random.default_rng(0).normal(0, 100, (16, 18, 20))
+    rotS = {'Dim': '3D', 'AggregationMethod': aggregationMethod}
+    aggFn = {'avg': np.mean, 'max': np.max, 'std': np.std}[aggregationMethod]
+
+    # Filter each rotation of the (S-I flipped) scan and rotate responses back
+    flipScan3M = np.flip(scan3M, axis=2)
+    for subband in ['LLH', 'HLH', 'HHH']:
+        outS = textureFilters.rotationInvariantWaveletFilter(scan3M, 'db2', subband, 2, rotS)
+        rotRespList = []
+        for permV, flipAxes in getRightAngleRotations():
+            rot3M = np.flip(np.transpose(flipScan3M, permV), flipAxes)
+            resp3M = textureFilters.getWaveletSubbands(rot3M, 'db2', 2, '3d', [subband])[subband]
+            rotRespList.append(np.transpose(np.flip(resp3M, flipAxes), np.argsort(permV)))
+        ref3M = np.flip(aggFn(np.stack(rotRespList), axis=0), axis=2)
+        np.testing.assert_allclose(outS['db2_' + subband], ref3M, atol=1e-9, err_msg=subband)